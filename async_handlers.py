@@ -0,0 +1,376 @@
+import asyncio
+import logging
+import time
+import audio_engine
+import config_snapshot
+import signal_filter
+import led_config
+import mode_cache
+import mqtt_handler
+import note_cache
+import offline_cache
+import sensor_data
+import ws_client
+from config import MQTT_MUTE_TOPIC, CONTROL_TOPIC, MOTION_CONTROL_TOPIC
+from async_ws_client import retry_request
+from scheduler import AsyncLanes, CONTROL, HOUSEKEEPING
+from sensor_registry import registry
+from status_aggregator import status
+from topic_router import TopicRouter, DISTANCE_TOPIC, SENSOR_ALIVE_TOPIC, LED_STRIP_ALIVE_TOPIC
+from sound import COOLDOWN_PERIOD
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+SECURITY_FEEDBACK_SECONDS = sensor_data.SECURITY_FEEDBACK_SECONDS
+
+# Control and housekeeping jobs are capped so they never take the server connections readings need
+lanes = AsyncLanes()
+pending_feedback_off = {}  # sensor_id -> loop handle of the switch-off after the latest feedback
+
+class AsyncSensorDispatcher:
+    # asyncio counterpart of dispatcher.SensorDispatcher: one task per busy sensor,
+    # and a new reading replaces the pending one
+    def __init__(self, handler):
+        self.handler = handler
+        self._pending = {}
+        self._tasks = {}
+
+    def submit(self, sensor_id, *args):
+        self._pending[sensor_id] = args
+        if sensor_id not in self._tasks:
+            self._tasks[sensor_id] = asyncio.get_running_loop().create_task(self._drain(sensor_id))
+
+    async def _drain(self, sensor_id):
+        try:
+            while sensor_id in self._pending:
+                args = self._pending.pop(sensor_id)
+                try:
+                    await self.handler(sensor_id, *args)
+                except Exception as e:
+                    logger.error(f"Handler failed for sensor {sensor_id}: {e}")
+        finally:
+            del self._tasks[sensor_id]
+
+async def reload_config(ws):
+    try:
+        if config_snapshot.CONFIG_FILE:
+            raw = config_snapshot.load_from_file(config_snapshot.CONFIG_FILE)
+            source = config_snapshot.CONFIG_FILE
+        else:
+            actions = config_snapshot.SERVER_ACTIONS
+            responses = await asyncio.gather(*(ws.request({"action": action}) for action in actions.values()))
+            raw = {}
+            for key, response_data in zip(actions, responses):
+                if response_data.get("action") != actions[key] or "data" not in response_data:
+                    raise ValueError(f"Invalid response for {actions[key]}: {response_data.get('error', '')}")
+                raw[key] = response_data["data"]
+            source = "server"
+        snapshot = config_snapshot.build_snapshot(raw, source)
+        if source == "server":
+            # File I/O, kept off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, offline_cache.save, "config", raw)
+    except Exception as e:
+        snapshot = config_snapshot.load_cached() if config_snapshot.current().version == 0 else None
+        if snapshot is None:
+            logger.critical(f"Config reload failed, keeping version {config_snapshot.current().version}: {e}")
+            return False
+        logger.warning(f"Config reload failed ({e}), running on the last-known config until the server is back")
+    # Listeners may decode sounds, so the swap runs off the event loop
+    await asyncio.to_thread(config_snapshot.install, snapshot)
+    # Strips that are up get the new config only if it differs from what they have
+    if led_config.publisher is not None:
+        for led_strip_name in status.alive_led_strips():
+            asyncio.get_running_loop().create_task(
+                lanes.run(HOUSEKEEPING, send_config_messages, ws, led_strip_name, led_config.publisher, False))
+    return True
+
+async def load_note_map(ws):
+    keys = note_cache.note_keys()
+    notes = await asyncio.gather(*(ws.request(note_cache.note_request(*key)) for key in keys), return_exceptions=True)
+    note_cache.install_map({key: note if isinstance(note, BaseException) else note_cache.parse_note(note)
+                            for key, note in zip(keys, notes)})
+
+async def refresh_note_map(ws):
+    try:
+        await load_note_map(ws)
+    except Exception as e:
+        logger.error(f"Failed to refresh note mapping: {e}")
+    finally:
+        note_cache.refresh_finished()
+
+async def get_note_id(ws, sensor_id, range_id):
+    # Stale entries keep being served while the refresh runs in its own task
+    if note_cache.expired():
+        note_cache.refresh_in_background()
+    key = (sensor_id, range_id)
+    if key in note_cache.note_map:
+        note_cache.stats["hits"] += 1
+        return note_cache.note_map[key]
+    note_cache.stats["misses"] += 1
+    try:
+        response_data = await ws.request(note_cache.note_request(sensor_id, range_id))
+    except Exception as e:
+        logger.warning("No note for sensor %s at range %s while the server is unavailable: %s", sensor_id, range_id, e)
+        return None
+    note_id = note_cache.parse_note(response_data)
+    note_cache.note_map[key] = note_id
+    return note_id
+
+async def load_led_config(ws, led_strip_names):
+    missing = []
+    for led_strip_name in led_strip_names:
+        response_data = await retry_request(ws, {"action": "determineLEDColor", "payload": {"sensorName": led_strip_name}}, retries=1)
+        if response_data and response_data.get("action") == "determineLEDColor" and "error" not in response_data:
+            led_config.update_strip_colors(led_strip_name, response_data["data"])
+            led_config.stale_strips.discard(led_strip_name)
+        else:
+            missing.append(led_strip_name)
+    led_config.use_cached_colors(missing)
+
+def use_async_client(ws):
+    # Invalidations, TTL expiry and server recovery are noticed on MQTT, timer and config threads;
+    # the refreshes they start run as housekeeping tasks on this loop, through ws
+    loop = asyncio.get_running_loop()
+
+    def on_loop(func, *args):
+        loop.call_soon_threadsafe(lambda: loop.create_task(lanes.run(HOUSEKEEPING, func, ws, *args)))
+
+    note_cache.set_refresher(lambda: on_loop(refresh_note_map))
+    config_snapshot.set_recovery_reload(lambda: on_loop(reload_config))
+    led_config.set_recovery_load(lambda led_strip_names: on_loop(load_led_config, led_strip_names))
+    ws.add_listener(note_cache.NOTE_CACHE_INVALIDATE_ACTION, lambda message: note_cache.invalidate())
+    ws.add_listener(led_config.LED_CONFIG_INVALIDATE_ACTION, lambda message: on_loop(refresh_led_config))
+
+async def send_led_trigger(ws, sensor_id, range_id):
+    if led_config.publish_trigger(sensor_id, range_id) or not ws_client.server_available():
+        return
+    try:
+        payload = {
+            "action": "getLEDTriggerPayload",
+            "payload": {
+                "sensor_id": sensor_id,
+                "distance": range_id
+            }
+        }
+        response_data = await ws.request(payload)
+        logger.debug("Received response for getLEDTriggerPayload: %s", response_data)
+        if response_data.get("action") == "LEDTrigger" and "payload" in response_data:
+            payload = {
+                "action": "sendLEDTrigger",
+                "payload": response_data["payload"]
+            }
+            response_data = await ws.request(payload)
+            logger.debug("Received response for sendLEDTrigger: %s", response_data)
+        else:
+            logger.warning("Failed to get LED trigger payload for sensor %s at range %s.", sensor_id, range_id)
+    except Exception as e:
+        logger.error(f"Unexpected error in send_led_trigger: {e}")
+
+async def send_security_led_trigger(ws, sensor_id, color):
+    if color not in led_config.SECURITY_MESSAGES:
+        color = 'off'
+    if not ws_client.server_available() and led_config.publish_message(sensor_id, led_config.SECURITY_FRAMES[color]):
+        return
+    payload = {
+        "action": "sendLEDTrigger",
+        "payload": {
+            "sensor_id": sensor_id,
+            "message": led_config.SECURITY_MESSAGES[color]
+        }
+    }
+    try:
+        response_data = await ws.request(payload)
+        logger.debug("Received response for sendLEDTrigger: %s", response_data)
+    except Exception as e:
+        logger.error(f"Unexpected error in send_security_led_trigger: {e}")
+
+def schedule_security_feedback(ws, sensor_id, color):
+    # The LED goes back off from a scheduled callback instead of a sleep in the handler; new
+    # feedback replaces a pending switch-off, so it cannot cut the new colour short
+    loop = asyncio.get_running_loop()
+    loop.create_task(lanes.run(CONTROL, send_security_led_trigger, ws, sensor_id, color))
+    previous = pending_feedback_off.get(sensor_id)
+    if previous is not None:
+        previous.cancel()
+    pending_feedback_off[sensor_id] = loop.call_later(
+        SECURITY_FEEDBACK_SECONDS, lambda: loop.create_task(lanes.run(CONTROL, send_security_led_trigger, ws, sensor_id, 'off')))
+
+def check_security_sequence(ws, sensor_id, range_id):
+    result = sensor_data.security_tracker.step(sensor_id, range_id)
+    if result is None:
+        return  # Ignore repeated steps
+
+    matched, completed = result
+    if matched:
+        schedule_security_feedback(ws, sensor_id, 'green')
+        logger.info("Step %s matched, sent green light.", (sensor_id, range_id))
+        for sequence_id in completed:
+            logger.info("Security sequence %s matched successfully.", sequence_id)
+    else:
+        schedule_security_feedback(ws, sensor_id, 'red')
+        logger.info("Step %s did not match, sent red light.", (sensor_id, range_id))
+
+async def fetch_and_play_note_details(ws, sensor_id, distance, is_muted, range_id=None):
+    current_mode = mode_cache.current_mode
+    if current_mode is None:
+        mode_cache.set_mode(mode_cache.last_known_mode(), "last known")
+        current_mode = mode_cache.current_mode
+
+    if range_id is None:
+        with sensor_data.RANGE_CLASSIFICATION_TIME.time():
+            range_id = sensor_data.determine_range_id(distance)
+    if range_id is None:
+        return
+
+    with sensor_data.NOTE_RESOLUTION_TIME.time():
+        note_id = await get_note_id(ws, sensor_id, range_id)
+    if note_id is None:
+        logger.warning("No note details found for sensor %s at range %s.", sensor_id, range_id)
+        return
+
+    sensor_data.log_sensor_data(sensor_id, distance)
+
+    if current_mode == 1:  # Musical Stairs mode
+        asyncio.get_running_loop().create_task(send_led_trigger(ws, sensor_id, range_id))
+        current_time = time.time()
+        sensor_state = registry.sensor(sensor_id)
+        if (note_id != sensor_state.last_note or (current_time - sensor_state.last_note_time) > COOLDOWN_PERIOD) and not is_muted:
+            sensor_state.last_note, sensor_state.last_note_time = note_id, current_time
+            audio_engine.play(sensor_id, note_id)
+            sensor_data.NOTES_PLAYED.inc()
+        else:
+            sensor_data.NOTES_SKIPPED.inc()
+            logger.info("Skipping note %s for sensor %s due to cooldown or mute.", note_id, sensor_id)
+
+    elif current_mode == 2:  # Security mode
+        with sensor_data.SECURITY_CHECK_TIME.time():
+            check_security_sequence(ws, sensor_id, range_id)
+
+async def update_status(ws, action, payload, success_action):
+    try:
+        response_data = await ws.request({"action": action, "payload": payload})
+        logger.debug(f"Received response for {action}: {response_data}")
+        if response_data.get("action") == success_action and "error" not in response_data:
+            logger.info(f"{action} succeeded: {payload}")
+            return True
+        logger.error(f"{action} failed: {response_data.get('error')}")
+    except Exception as e:
+        logger.error(f"Failed to send {action} to server: {e}")
+    return False
+
+async def fetch_config_payloads(ws, led_strip_name):
+    limits = colors = None
+    response_data = await ws.request({"action": "getRangeLimits"})
+    if response_data.get("action") == "getRangeLimits" and "error" not in response_data:
+        limits = (response_data["data"]["closeUpperLimit"], response_data["data"]["midUpperLimit"])
+    else:
+        logger.error(f"Failed to fetch range limits: {response_data.get('error')}")
+
+    response_data = await ws.request({"action": "determineLEDColor", "payload": {"sensorName": led_strip_name}})
+    if response_data.get("action") == "determineLEDColor" and "error" not in response_data:
+        colors = response_data["data"]
+        led_config.update_strip_colors(led_strip_name, colors)
+    else:
+        logger.error(f"Failed to fetch LED color configuration: {response_data.get('error')}")
+    return led_config.build_config_payloads(led_strip_name, limits, colors)
+
+async def send_config_messages(ws, led_strip_name, mqtt, force=True):
+    try:
+        messages = led_config.cached_config_payloads(led_strip_name)
+        if messages is None:
+            messages = await fetch_config_payloads(ws, led_strip_name)
+            if messages is None:
+                return
+        if not led_config.config_changed(led_strip_name, messages) and not force:
+            return
+        led_config.publish_config(mqtt, messages)
+    except Exception as e:
+        logger.error(f"Failed to send config messages: {e}")
+
+async def refresh_led_config(ws):
+    # Strips that are up get the server's current limits and colours if they changed
+    led_config.invalidate()
+    if led_config.publisher is not None:
+        for led_strip_name in status.alive_led_strips():
+            await send_config_messages(ws, led_strip_name, led_config.publisher, False)
+
+async def flush_status(ws):
+    if ws_client.server_available():
+        await status.flush_async(ws.request)
+
+async def handle_mute(ws, mqtt, dispatcher, payload):
+    mqtt_handler.is_muted = payload.lower() == 'mute'
+    logger.info(f"Mute state changed: {'Muted' if mqtt_handler.is_muted else 'Unmuted'}")
+
+async def handle_note_invalidate(ws, mqtt, dispatcher, payload):
+    note_cache.invalidate()
+
+async def handle_led_config_invalidate(ws, mqtt, dispatcher, payload):
+    await lanes.run(HOUSEKEEPING, refresh_led_config, ws)
+
+async def handle_mode(ws, mqtt, dispatcher, payload):
+    mode_cache.handle_mode_message(payload)
+
+async def handle_config_reload(ws, mqtt, dispatcher, payload):
+    await lanes.run(HOUSEKEEPING, reload_config, ws)
+
+async def handle_distance(ws, mqtt, dispatcher, payload, sensor_id):
+    distance = float(payload)
+    if distance == 0:
+        return  # Ignore erroneous reading of 0
+    mqtt_handler.READINGS.inc()
+    sensor_filter = signal_filter.get_filter(sensor_id)
+    with mqtt_handler.RANGE_CLASSIFICATION_TIME.time():
+        filtered = sensor_filter.update(distance, config_snapshot.current().range_index)
+    registry.record_reading(sensor_id, distance, sensor_filter.range_id)
+    if filtered is None:
+        mqtt_handler.READINGS_FILTERED.inc()
+        return
+    distance, range_id = filtered
+    dispatcher.submit(sensor_id, distance, mqtt_handler.is_muted, range_id)
+
+async def handle_sensor_alive(ws, mqtt, dispatcher, payload, sensor_id):
+    registry.touch_sensor(sensor_id)
+    status.sensor_seen(sensor_id, payload.lower() == "alive")
+
+async def handle_led_strip_alive(ws, mqtt, dispatcher, payload, led_strip_name):
+    registry.touch_led_strip(led_strip_name)
+    alive = payload.lower() == "alive"
+    came_up = status.led_strip_seen(led_strip_name, alive)
+    if alive:
+        # Pushed on every heartbeat from the cached payloads, as in mqtt_handler
+        force = came_up or not led_config.LED_CONFIG_BUNDLE
+        await lanes.run(HOUSEKEEPING, send_config_messages, ws, led_strip_name, mqtt, force)
+
+async def handle_control(ws, mqtt, dispatcher, payload):
+    sensors_on = payload.lower() == "wake"
+    logger.info(f"Setting all sensors to {'awake' if sensors_on else 'sleep'}")
+    mqtt.publish(MOTION_CONTROL_TOPIC, "wake" if sensors_on else "sleep")
+    await lanes.run(CONTROL, update_status, ws, "updateSensorStatus", {"sensors_on": sensors_on}, "update_sensor_status")
+
+# Same routes as mqtt_handler.router, whose subscriptions the shared on_connect uses
+router = TopicRouter()
+router.add(MQTT_MUTE_TOPIC, handle_mute)
+router.add(note_cache.NOTE_CACHE_INVALIDATE_TOPIC, handle_note_invalidate)
+router.add(led_config.LED_CONFIG_INVALIDATE_TOPIC, handle_led_config_invalidate)
+router.add(mode_cache.MODE_TOPIC, handle_mode)
+router.add(config_snapshot.CONFIG_RELOAD_TOPIC, handle_config_reload)
+router.add(CONTROL_TOPIC, handle_control)
+router.add(DISTANCE_TOPIC, handle_distance)
+router.add(SENSOR_ALIVE_TOPIC, handle_sensor_alive)
+router.add(LED_STRIP_ALIVE_TOPIC, handle_led_strip_alive)
+
+async def handle_message(ws, mqtt, dispatcher, message):
+    topic = message.topic
+    payload = message.payload.decode()
+    mqtt_handler.MESSAGES.inc()
+    logger.debug("Received message on topic: %s with payload: %s", topic, payload)
+
+    route = router.route(topic)
+    if route is None:
+        mqtt_handler.UNROUTED_MESSAGES.inc()
+        logger.debug("No handler for topic: %s", topic)
+        return
+    handler, params = route
+    await handler(ws, mqtt, dispatcher, payload, **params)
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import socket
+import threading
+import paho.mqtt.client as mqtt
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Delay before reconnecting after the broker connection drops, doubled while it keeps failing
+MQTT_RECONNECT_DELAY = 1
+MQTT_RECONNECT_MAX = 30
+
+class AsyncMQTTClient:
+    # Drives paho from the asyncio event loop: the socket is watched with add_reader/add_writer
+    # instead of a network thread, and received messages are delivered through an asyncio.Queue
+    def __init__(self, on_connect=None):
+        self.loop = asyncio.get_running_loop()
+        self.messages = asyncio.Queue()
+        self.client = mqtt.Client(client_id="", clean_session=True, userdata=None, protocol=mqtt.MQTTv311)
+        self.client.on_connect = on_connect
+        self.client.on_message = lambda client, userdata, message: self.messages.put_nowait(message)
+        self.client.on_socket_open = lambda client, userdata, sock: self._on_loop(self._watch, sock)
+        self.client.on_socket_close = lambda client, userdata, sock: self._on_loop(self._unwatch, sock)
+        self.client.on_socket_register_write = lambda client, userdata, sock: self._on_loop(self.loop.add_writer, sock, client.loop_write)
+        self.client.on_socket_unregister_write = lambda client, userdata, sock: self._on_loop(self.loop.remove_writer, sock)
+        self._loop_thread = threading.get_ident()
+        self._misc_task = None
+        self._reconnect_task = None
+        self._closing = False
+
+    def _on_loop(self, func, *args):
+        # connect() and reconnects open the socket on an executor thread; the loop is only
+        # touched from its own thread
+        if threading.get_ident() == self._loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _watch(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2048)
+        self._misc_task = self.loop.create_task(self._misc_loop())
+
+    def _unwatch(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+        if not self._closing and self._reconnect_task is None:
+            self._reconnect_task = self.loop.create_task(self._reconnect())
+
+    async def _misc_loop(self):
+        # Keepalive pings and retries that paho normally runs from loop()
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def _reconnect(self):
+        # on_connect subscribes again once the broker accepts the new connection
+        delay = MQTT_RECONNECT_DELAY
+        try:
+            while not self._closing:
+                logger.warning(f"MQTT connection lost, reconnecting in {delay}s")
+                await asyncio.sleep(delay)
+                try:
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                    return
+                except (OSError, ValueError) as e:
+                    logger.error(f"MQTT reconnect failed: {e}")
+                    delay = min(delay * 2, MQTT_RECONNECT_MAX)
+        finally:
+            self._reconnect_task = None
+
+    async def connect(self, host, port):
+        # Name lookup and the TCP connect block, so they run off the loop
+        await self.loop.run_in_executor(None, self.client.connect, host, port)
+
+    def subscribe(self, topic):
+        return self.client.subscribe(topic)
+
+    def publish(self, topic, payload, retain=False):
+        return self.client.publish(topic, payload, retain=retain)
+
+    async def next_message(self):
+        return await self.messages.get()
+
+    def disconnect(self):
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        self.client.disconnect()
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import metrics
+from config import WS_SERVER_URL
+from ws_client import (WS_POOL_SIZE, WS_RETRIES, WS_BACKOFF_BASE, WS_BACKOFF_MAX, WS_KEEPALIVE_INTERVAL,
+                       WS_CONNECT_TIMEOUT, WS_RECV_TIMEOUT, WS_ACQUIRE_TIMEOUT, server_breaker)
+
+try:
+    import websockets
+except ImportError:  # only the asyncio runtime needs it
+    websockets = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class PoolExhaustedError(ConnectionError):
+    # Every connection is busy; local contention, not counted against the server
+    pass
+
+class _Slot:
+    def __init__(self):
+        self.ws = None
+
+class AsyncWSClient:
+    def __init__(self, url=WS_SERVER_URL, size=WS_POOL_SIZE, retries=WS_RETRIES):
+        if websockets is None:
+            raise RuntimeError("The asyncio runtime requires the 'websockets' package")
+        self.url = url
+        self.retries = retries
+        self._listeners = {}
+        # Same correlation rule as ws_client: a connection serves one request at a time
+        self._slots = asyncio.Queue()
+        for _ in range(size):
+            self._slots.put_nowait(_Slot())
+
+    def add_listener(self, action, callback):
+        # Best effort: a push that arrives on an idle connection is read by the next request that
+        # takes it; the MQTT mode and note-invalidation topics are what changes rely on
+        self._listeners.setdefault(action, []).append(callback)
+
+    async def _recv_response(self, ws):
+        while True:
+            message = json.loads(await ws.recv())
+            if isinstance(message, dict) and message.get("action") in self._listeners:
+                for callback in self._listeners[message["action"]]:
+                    try:
+                        callback(message)
+                    except Exception as e:
+                        logger.error(f"Push listener for {message['action']} failed: {e}")
+                continue
+            return message
+
+    async def request(self, payload):
+        with metrics.histogram("ws_request_seconds", "WebSocket request round trips, retries included",
+                               action=payload.get("action")).time():
+            return await self._request(payload)
+
+    async def _request(self, payload):
+        data = json.dumps(payload)
+        last_error = None
+        try:
+            slot = await asyncio.wait_for(self._slots.get(), WS_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            metrics.counter("ws_pool_exhausted_total", "WebSocket requests with no free pooled connection",
+                            action=payload.get("action")).inc()
+            raise PoolExhaustedError(f"No free connection within {WS_ACQUIRE_TIMEOUT}s for {payload.get('action')}")
+        try:
+            for attempt in range(self.retries):
+                if not server_breaker.allow():
+                    raise ConnectionError(f"Server unavailable, {payload.get('action')} not sent")
+                try:
+                    if slot.ws is None:
+                        # websockets sends keepalive pings itself
+                        slot.ws = await websockets.connect(self.url, ping_interval=WS_KEEPALIVE_INTERVAL or None,
+                                                           open_timeout=WS_CONNECT_TIMEOUT)
+                    await slot.ws.send(data)
+                    response = await asyncio.wait_for(self._recv_response(slot.ws), WS_RECV_TIMEOUT)
+                    server_breaker.record_success()
+                    return response
+                except (websockets.exceptions.WebSocketException, OSError, asyncio.TimeoutError) as e:
+                    last_error = e
+                    await self._close_slot(slot)
+                    server_breaker.record_failure()
+                    if not server_breaker.available:
+                        continue
+                    delay = min(WS_BACKOFF_BASE * (2 ** attempt), WS_BACKOFF_MAX)
+                    logger.warning(f"WebSocket request {payload.get('action')} failed (attempt {attempt + 1}/{self.retries}): {e}, reconnecting in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                except Exception:
+                    # e.g. a reply that is not JSON: the server answered wrongly, which still ends a trial
+                    await self._close_slot(slot)
+                    server_breaker.record_failure()
+                    raise
+                except asyncio.CancelledError:
+                    # Says nothing about the server; the connection may be mid-frame, so it is dropped
+                    server_breaker.release_trial()
+                    await self._close_slot(slot)
+                    raise
+        finally:
+            self._slots.put_nowait(slot)
+        raise ConnectionError(f"Request {payload.get('action')} failed after {self.retries} attempts: {last_error}")
+
+    async def _close_slot(self, slot):
+        if slot.ws is not None:
+            try:
+                await slot.ws.close()
+            except Exception as e:
+                logger.debug(f"Error closing WebSocket connection: {e}")
+            slot.ws = None
+
+    async def close(self):
+        slots = []
+        while not self._slots.empty():
+            slots.append(self._slots.get_nowait())
+        for slot in slots:
+            await self._close_slot(slot)
+            self._slots.put_nowait(slot)
+
+async def retry_request(client, payload, retries=5, delay=2):
+    for attempt in range(retries):
+        try:
+            return await client.request(payload)
+        except Exception as e:
+            logger.error(f"Request failed (attempt {attempt + 1}/{retries}): {e}")
+            await asyncio.sleep(delay)
+    logger.critical(f"All retries failed for payload: {payload}")
+    return None
@@ -0,0 +1,121 @@
+import logging
+import os
+import queue
+import threading
+import time
+import sound
+import metrics
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+AUDIO_CHANNELS = int(os.getenv('AUDIO_CHANNELS', '32'))
+CHANNELS_PER_SENSOR = int(os.getenv('CHANNELS_PER_SENSOR', '4'))
+
+_STOP = object()
+
+AUDIO_QUEUE_TIME = metrics.stage("audio_queue")  # play() call to the engine thread picking it up
+AUDIO_START_TIME = metrics.stage("audio_start")  # sound lookup, voice choice and Channel.play
+
+class AudioEngine:
+    def __init__(self, num_channels=AUDIO_CHANNELS, channels_per_sensor=CHANNELS_PER_SENSOR):
+        import pygame  # not at module level, so importing the app stays cheap
+        sound.init_mixer()
+        self.channels_per_sensor = channels_per_sensor
+        self.num_blocks = max(1, num_channels // channels_per_sensor)
+        total = self.num_blocks * channels_per_sensor
+        pygame.mixer.set_num_channels(total)
+        # Reserve every channel so pygame never assigns one behind the engine's back
+        pygame.mixer.set_reserved(total)
+        self.channels = [pygame.mixer.Channel(i) for i in range(total)]
+        self.started_at = [0.0] * total
+        self.stats = {"played": 0, "stolen": 0, "missing": 0}
+        # SimpleQueue is the C-level unbounded FIFO: callers never contend on a Python lock
+        self._commands = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info(f"Audio engine started with {total} channels, {channels_per_sensor} per sensor")
+
+    def play(self, sensor_id, note_id, queued_at=None):
+        # queued_at lets a command relayed from another process keep its original perf_counter stamp
+        self._commands.put((sensor_id, note_id, time.perf_counter() if queued_at is None else queued_at))
+
+    def _pick_channel(self, sensor_id):
+        # Each sensor owns a fixed block of channels; several sensors share a block only
+        # when there are more sensors than blocks
+        first = ((sensor_id - 1) % self.num_blocks) * self.channels_per_sensor
+        block = range(first, first + self.channels_per_sensor)
+        for i in block:
+            if not self.channels[i].get_busy():
+                return i
+        # All voices busy: steal the one that has been playing longest
+        oldest = min(block, key=lambda i: self.started_at[i])
+        self.channels[oldest].stop()
+        self.stats["stolen"] += 1
+        return oldest
+
+    def _start(self, sensor_id, note_id):
+        note_sound = sound.get_sound(note_id)
+        if note_sound is None:
+            self.stats["missing"] += 1
+            logger.warning("Sound for note ID %s not found.", note_id)
+            return
+        i = self._pick_channel(sensor_id)
+        self.channels[i].play(note_sound)
+        self.started_at[i] = time.monotonic()
+        self.stats["played"] += 1
+        logger.debug("Playing note %s for sensor %s on channel %s", note_id, sensor_id, i)
+
+    def _run(self):
+        while True:
+            command = self._commands.get()
+            if command is _STOP:
+                return
+            sensor_id, note_id, queued_at = command
+            AUDIO_QUEUE_TIME.observe(time.perf_counter() - queued_at)
+            try:
+                with AUDIO_START_TIME.time():
+                    self._start(sensor_id, note_id)
+            except Exception as e:
+                logger.error(f"Failed to play sound: {e}")
+
+    def stop(self):
+        self._commands.put(_STOP)
+        self._thread.join(2)
+        for channel in self.channels:
+            channel.stop()
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def engine_gauges():
+    engine = _engine
+    if engine is None:
+        return []
+    return [("audio_" + name, {}, value) for name, value in engine.stats.items()]
+
+metrics.add_collector(engine_gauges)
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = AudioEngine()
+    return _engine
+
+def set_engine(engine):
+    # Replaces the engine, e.g. with a sink forwarding play commands to another process
+    global _engine
+    with _engine_lock:
+        _engine = engine
+
+def play(sensor_id, note_id):
+    get_engine().play(sensor_id, note_id)
+
+def stop():
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.stop()
+            _engine = None
@@ -0,0 +1,273 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+# Replays sensor traffic through mqtt_handler.on_message against fake_services and reports
+# per-stage latency, e.g.
+#   python benchmark.py --sensors 8 --duration 30 --ws-latency 0.005
+#   python benchmark.py --traffic recorded.jsonl --speed 0 --baseline last_run.json
+# Traffic files are JSON lines of {"t": seconds from start, "topic": ..., "payload": ...}.
+
+# Settings the app reads at import time
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('MODE_POLL_INTERVAL', '0')
+os.environ.setdefault('WS_KEEPALIVE_INTERVAL', '0')
+
+logger = logging.getLogger("benchmark")
+
+STAGES = ("ingest", "queue", "handler", "led", "sound")
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def synthetic_traffic(num_sensors, duration, rate, alive_interval=10, seed=1):
+    # Each sensor idles out of range and sees a footstep every 0.5-2 s: the reading sweeps
+    # from the far range to the close one and back out, with a little noise
+    rng = random.Random(seed)
+    events = []
+    for sensor_id in range(1, num_sensors + 1):
+        t = rng.uniform(0, 1 / rate)
+        next_step = rng.uniform(0, 1)
+        step_length = 0.6
+        while t < duration:
+            if next_step <= t < next_step + step_length:
+                phase = (t - next_step) / step_length
+                distance = 10 + 130 * abs(1 - 2 * phase) + rng.gauss(0, 2)
+            else:
+                distance = 200 + rng.gauss(0, 2)
+                if t >= next_step + step_length:
+                    next_step = t + rng.uniform(0.5, 2)
+            events.append((t, f"ultrasonic/distance_sensor{sensor_id}", f"{max(distance, 1):.1f}"))
+            t += 1 / rate
+        for t in range(0, int(duration), alive_interval):
+            events.append((t + rng.uniform(0, 1), f"alive/distance_sensor{sensor_id}", "alive"))
+            events.append((t + rng.uniform(0, 1), f"alive/ledstrip{sensor_id}", "alive"))
+    events.sort(key=lambda event: event[0])
+    return events
+
+def load_traffic(path):
+    with open(path) as traffic_file:
+        return [(event["t"], event["topic"], event["payload"])
+                for event in (json.loads(line) for line in traffic_file if line.strip())]
+
+def save_traffic(events, path):
+    with open(path, "w") as traffic_file:
+        for t, topic, payload in events:
+            traffic_file.write(json.dumps({"t": round(t, 4), "topic": topic, "payload": payload}) + "\n")
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}  # stage -> list of seconds
+        self.last_ingest = {}  # sensor_id -> perf_counter of its newest reading
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def since_ingest(self, stage, sensor_id):
+        started = self.last_ingest.get(sensor_id)
+        if started is not None:
+            self.add(stage, time.perf_counter() - started)
+
+    def report(self, elapsed, messages):
+        stages = {}
+        ordered = [stage for stage in STAGES if stage in self.samples] + sorted(set(self.samples) - set(STAGES))
+        for stage in ordered:
+            values = self.samples[stage]
+            stages[stage] = {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+                "max_ms": round(max(values) * 1000, 3),
+                "per_second": round(len(values) / elapsed, 1) if elapsed else None,
+            }
+        return {"messages": messages, "elapsed_s": round(elapsed, 3),
+                "messages_per_second": round(messages / elapsed, 1) if elapsed else None, "stages": stages}
+
+def instrument(recorder, mqtt_handler, sensor_data, audio_engine, ws_client):
+    # Wraps the stage boundaries in place; readings are matched to outputs by sensor, so a
+    # stage's latency runs from the newest reading of that sensor before it
+    def on_message(client, userdata, message):
+        route = mqtt_handler.router.route(message.topic)
+        sensor_id = route[1].get("sensor_id") if route and route[0] is mqtt_handler.handle_distance else None
+        started = time.perf_counter()
+        if sensor_id is not None:
+            recorder.last_ingest[sensor_id] = started
+        mqtt_handler.on_message(client, userdata, message)
+        recorder.add("ingest", time.perf_counter() - started)
+
+    handler = mqtt_handler.dispatcher.handler
+
+    def timed_handler(sensor_id, *args):
+        recorder.since_ingest("queue", sensor_id)
+        started = time.perf_counter()
+        try:
+            return handler(sensor_id, *args)
+        finally:
+            recorder.add("handler", time.perf_counter() - started)
+    mqtt_handler.dispatcher.handler = timed_handler
+
+    send_led_trigger = sensor_data.send_led_trigger
+
+    def timed_led_trigger(sensor_id, range_id):
+        send_led_trigger(sensor_id, range_id)
+        recorder.since_ingest("led", sensor_id)
+    sensor_data.send_led_trigger = timed_led_trigger
+
+    # Playback is measured up to the audio engine command; mixer latency is a hardware setting
+    audio_engine.play = lambda sensor_id, note_id: recorder.since_ingest("sound", sensor_id)
+
+    pool = ws_client.get_pool()
+    request = pool.request
+
+    def timed_request(payload):
+        started = time.perf_counter()
+        try:
+            return request(payload)
+        finally:
+            recorder.add(f"ws:{payload.get('action')}", time.perf_counter() - started)
+    pool.request = timed_request
+    return on_message
+
+def wait_for_drain(dispatcher, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = dict(dispatcher.stats)
+        if stats["handled"] + stats["coalesced"] + stats["dropped"] >= stats["submitted"]:
+            return True
+        time.sleep(0.01)
+    return False
+
+def run(events, num_sensors, ws_latency=0.0, ws_jitter=0.0, action_latency=None, mode=1,
+        speed=1.0, local_led=True):
+    # App modules are imported here so the settings above are in place first
+    from fake_services import FakeBroker, FakeMQTTClient, FakeServerData, FakeWSServer
+    import ws_client
+    import config_snapshot
+    import note_cache
+    import mode_cache
+    import led_config
+    import sensor_log
+    import audio_engine
+    import sensor_data
+    import mqtt_handler
+
+    server = FakeWSServer(FakeServerData(num_sensors=num_sensors, mode=mode), latency=ws_latency,
+                          action_latency=action_latency, jitter=ws_jitter).start()
+    ws_client.set_pool(ws_client.WSPool(url=server.url, keepalive_interval=0))
+    recorder = Recorder()
+    on_message = instrument(recorder, mqtt_handler, sensor_data, audio_engine, ws_client)
+
+    config_snapshot.load(retries=1)
+    note_cache.load_note_map()
+    mode_cache.start()
+    if local_led:
+        led_config.LED_TRIGGER_TOPIC = led_config.LED_TRIGGER_TOPIC or "ledstrip/{led_strip_name}/trigger"
+        led_config.SENSOR_LED_STRIPS.update((sensor_id, f"ledstrip{sensor_id}") for sensor_id in range(1, num_sensors + 1))
+        led_config.load_led_config([f"ledstrip{sensor_id}" for sensor_id in range(1, num_sensors + 1)])
+
+    broker = FakeBroker()
+    client = FakeMQTTClient(broker)
+    client.on_connect = mqtt_handler.on_connect
+    client.on_message = on_message
+    mqtt_handler.mqtt_client = client
+    led_config.set_publisher(client)
+    client.connect()
+
+    started = time.perf_counter()
+    for t, topic, payload in events:
+        if speed:
+            delay = started + t / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        broker.publish(topic, payload)
+    if not wait_for_drain(mqtt_handler.dispatcher):
+        logger.warning("Dispatcher did not drain before the timeout")
+    elapsed = time.perf_counter() - started
+
+    result = recorder.report(elapsed, len(events))
+    result["dispatcher"] = dict(mqtt_handler.dispatcher.stats)
+    result["server_requests"] = dict(server.stats)
+    result["note_cache"] = note_cache.get_stats()
+
+    mqtt_handler.lanes.shutdown()
+    mode_cache.stop()
+    sensor_log.stop()
+    ws_client.close()
+    server.stop()
+    return result
+
+def compare(result, baseline, max_regression):
+    # Stages whose p99 grew by more than max_regression (a fraction) over the baseline run
+    regressions = []
+    for stage, stats in result["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if previous and previous["p99_ms"] and stats["p99_ms"] > previous["p99_ms"] * (1 + max_regression):
+            regressions.append(f"{stage}: p99 {previous['p99_ms']} ms -> {stats['p99_ms']} ms")
+    return regressions
+
+def print_report(result):
+    print(f"{result['messages']} messages in {result['elapsed_s']} s ({result['messages_per_second']} msg/s)")
+    print(f"{'stage':<32}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'per s':>10}")
+    for stage, stats in result["stages"].items():
+        print(f"{stage:<32}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}{stats['per_second']:>10}")
+    print(f"dispatcher: {result['dispatcher']}")
+    print(f"note cache: {result['note_cache']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay sensor traffic through the MQTT pipeline and report stage latency")
+    parser.add_argument("--traffic", help="JSON lines traffic file to replay instead of synthetic traffic")
+    parser.add_argument("--save-traffic", help="Write the replayed traffic to this file")
+    parser.add_argument("--sensors", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of synthetic traffic")
+    parser.add_argument("--rate", type=float, default=20, help="Readings per second per sensor")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--speed", type=float, default=1, help="Replay speed factor, 0 replays as fast as possible")
+    parser.add_argument("--mode", type=int, default=1, help="Active mode reported by the fake server")
+    parser.add_argument("--ws-latency", type=float, default=0.0, help="Seconds the fake server waits before each reply")
+    parser.add_argument("--ws-jitter", type=float, default=0.0, help="Extra random delay of up to this many seconds")
+    parser.add_argument("--action-latency", action="append", default=[], metavar="ACTION=SECONDS",
+                        help="Per-action reply delay, may be repeated")
+    parser.add_argument("--server-led", action="store_true", help="Skip the LED colour preload so triggers go through the server")
+    parser.add_argument("--json", help="Write the report to this file")
+    parser.add_argument("--baseline", help="Report from an earlier run to compare p99 latencies against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed p99 growth over the baseline, as a fraction")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, os.getenv('LOG_LEVEL', 'WARNING').upper()))
+
+    if args.traffic:
+        events = load_traffic(args.traffic)
+        num_sensors = max([args.sensors] + [int(topic.rsplit("sensor", 1)[1]) for _, topic, _ in events
+                                            if topic.startswith("ultrasonic/distance_sensor")])
+    else:
+        events = synthetic_traffic(args.sensors, args.duration, args.rate, seed=args.seed)
+        num_sensors = args.sensors
+    if args.save_traffic:
+        save_traffic(events, args.save_traffic)
+
+    action_latency = {action: float(seconds) for action, seconds in (item.split("=", 1) for item in args.action_latency)}
+    result = run(events, num_sensors, ws_latency=args.ws_latency, ws_jitter=args.ws_jitter,
+                 action_latency=action_latency, mode=args.mode, speed=args.speed, local_led=not args.server_led)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as report_file:
+            json.dump(result, report_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(result, json.load(baseline_file), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
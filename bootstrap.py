@@ -0,0 +1,65 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Startup phases that do not depend on each other run in parallel on this many threads
+STARTUP_WORKERS = int(os.getenv('STARTUP_WORKERS', '4'))
+# Phases range from a cached file read to server fetches with retries
+STARTUP_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class App:
+    # Brings the runtime up in named phases: a phase starts once the phases listed in `after`
+    # have finished, and each one is timed into startup_phase_seconds{phase}
+    def __init__(self, workers=STARTUP_WORKERS):
+        self.started = time.perf_counter()
+        self.timings = {}  # phase -> seconds
+        self._phases = {}  # phase -> Future
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="startup")
+
+    def phase(self, name, func, *args, after=()):
+        # Prerequisites are always submitted first, so a waiting phase never starves them of a worker
+        prerequisites = [self._phases[dependency] for dependency in after]
+        future = self._phases[name] = self._executor.submit(self._run, name, func, args, prerequisites)
+        return future
+
+    def _run(self, name, func, args, prerequisites):
+        for prerequisite in prerequisites:
+            prerequisite.result()
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    async def run_async(self, name, awaitable):
+        # The same timing for a phase that runs on the event loop
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        self.timings[name] = seconds
+        metrics.histogram("startup_phase_seconds", "Time taken by each startup phase",
+                          buckets=STARTUP_BUCKETS, phase=name).observe(seconds)
+        logger.debug(f"Startup phase {name} finished in {seconds:.3f}s")
+
+    def wait(self):
+        # Blocks until every phase has finished; the first failure is raised here
+        for future in list(self._phases.values()):
+            future.result()
+        return self.report()
+
+    def report(self):
+        self._executor.shutdown(wait=False)
+        total = time.perf_counter() - self.started
+        self.record("total", total)
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.timings.items() if name != "total")
+        logger.info(f"Started in {total:.2f}s ({phases})")
+        return dict(self.timings)
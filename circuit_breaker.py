@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    # After failure_threshold consecutive failures calls are refused for reset_timeout seconds;
+    # then a single trial call is let through and its outcome closes or reopens the circuit
+    def __init__(self, name, failure_threshold=3, reset_timeout=10):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.stats = {"opened": 0, "rejected": 0}
+        self._trial_running = False
+        self._listeners = []  # callbacks(state) run when the circuit opens or closes
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    @property
+    def available(self):
+        # True unless the circuit is open and still cooling down
+        return self.state != OPEN or time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._trial_running = False
+            if self.state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def release_trial(self):
+        # For a call that ended without reaching the server (cancelled, or no local connection free):
+        # it says nothing about the server, so the next caller gets the trial instead
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            recovered = self.state != CLOSED
+            self.state = CLOSED
+            self._trial_running = False
+        if recovered:
+            logger.info(f"{self.name} is reachable again, circuit closed")
+            self._notify(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                opened = self.state == CLOSED
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.stats["opened"] += opened
+            else:
+                return
+        if opened:
+            logger.warning(f"{self.name} failed {self.failures} times in a row, circuit open; "
+                           f"retrying every {self.reset_timeout}s")
+            self._notify(OPEN)
+
+    def _notify(self, state):
+        for callback in self._listeners:
+            try:
+                callback(state)
+            except Exception as e:
+                logger.error(f"Circuit listener {getattr(callback, '__name__', callback)} failed: {e}")
@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+import ws_client
+import offline_cache
+from range_index import RangeIndex
+from security import SecurityAutomaton
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# A message on this topic rebuilds the snapshot
+CONFIG_RELOAD_TOPIC = os.getenv('CONFIG_RELOAD_TOPIC', 'config/reload')
+# Seconds between background reloads, 0 disables the timer
+CONFIG_RELOAD_INTERVAL = float(os.getenv('CONFIG_RELOAD_INTERVAL', '0'))
+# Load from this JSON file (keys: ranges, positions, security_sequences, notes) instead of the server
+CONFIG_FILE = os.getenv('CONFIG_FILE')
+
+SERVER_ACTIONS = {
+    "ranges": "getRanges",
+    "positions": "fetchAllPositions",
+    "security_sequences": "fetchAllSecuritySequences",
+    "notes": "getNotes",
+}
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    version: int
+    loaded_at: float
+    source: str
+    ranges: tuple
+    range_index: RangeIndex
+    positions: tuple
+    security_sequences: tuple
+    security_automaton: SecurityAutomaton
+    notes: tuple
+
+EMPTY = ConfigSnapshot(0, 0, "empty", (), RangeIndex([]), (), (), SecurityAutomaton([], []), ())
+
+_snapshot = EMPTY
+_listeners = []
+_reload_lock = threading.Lock()
+_recovery_reload = None  # replaces reload() after a server outage; set by the asyncio runtime
+
+def current():
+    # Readers take one reference and use it for the whole reading, so a swap never tears
+    return _snapshot
+
+def add_listener(callback):
+    _listeners.append(callback)
+
+def fetch_from_server():
+    raw = {}
+    for key, action in SERVER_ACTIONS.items():
+        response_data = ws_client.request({"action": action})
+        if response_data.get("action") != action or "data" not in response_data:
+            raise ValueError(f"Invalid response for {action}: {response_data.get('error', response_data.get('message', ''))}")
+        raw[key] = response_data["data"]
+    return raw
+
+def load_from_file(path):
+    with open(path) as config_file:
+        return json.load(config_file)
+
+def build_snapshot(raw, source):
+    # Validation happens here, off the hot path; any error leaves the current snapshot in place
+    positions = tuple(raw.get("positions", []))
+    for position in positions:
+        for key in ("position_ID", "sensor_ID", "range_ID"):
+            if key not in position:
+                raise ValueError(f"Position {position} is missing {key}")
+    notes = tuple(note for note in raw.get("notes", []) if isinstance(note, dict))
+    for note in notes:
+        if "note_ID" not in note or "note_location" not in note:
+            raise ValueError(f"Note {note} is missing note_ID or note_location")
+    ranges = tuple(raw.get("ranges", []))
+    security_sequences = tuple(raw.get("security_sequences", []))
+    return ConfigSnapshot(
+        version=_snapshot.version + 1,
+        loaded_at=time.time(),
+        source=source,
+        ranges=ranges,
+        range_index=RangeIndex(ranges),
+        positions=positions,
+        security_sequences=security_sequences,
+        security_automaton=SecurityAutomaton(security_sequences, positions),
+        notes=notes,
+    )
+
+def install(snapshot):
+    global _snapshot
+    previous, _snapshot = _snapshot, snapshot
+    logger.info(f"Installed config version {snapshot.version} from {snapshot.source}: "
+                f"{len(snapshot.ranges)} ranges, {len(snapshot.positions)} positions, "
+                f"{snapshot.security_automaton.size} security sequences, {len(snapshot.notes)} notes")
+    for callback in _listeners:
+        try:
+            callback(snapshot, previous)
+        except Exception as e:
+            logger.error(f"Config listener {getattr(callback, '__name__', callback)} failed: {e}")
+
+def load_cached():
+    # Last config fetched from the server, used to start while the server is unreachable
+    raw = offline_cache.load("config")
+    if raw is None:
+        return None
+    try:
+        return build_snapshot(raw, "cache")
+    except Exception as e:
+        logger.error(f"Cached config is invalid: {e}")
+        return None
+
+def reload():
+    with _reload_lock:
+        try:
+            if CONFIG_FILE:
+                raw, source = load_from_file(CONFIG_FILE), CONFIG_FILE
+            else:
+                raw, source = fetch_from_server(), "server"
+            snapshot = build_snapshot(raw, source)
+        except Exception as e:
+            snapshot = load_cached() if _snapshot.version == 0 else None
+            if snapshot is None:
+                logger.critical(f"Config reload failed, keeping version {_snapshot.version}: {e}")
+                return False
+            logger.warning(f"Config reload failed ({e}), running on the last-known config until the server is back")
+        else:
+            if source == "server":
+                offline_cache.save("config", raw)
+        install(snapshot)
+        return True
+
+def set_recovery_reload(func):
+    # func() starts a reload without blocking the timer thread it is called on
+    global _recovery_reload
+    _recovery_reload = func
+
+def on_server_recovery():
+    if _snapshot.source == "cache":
+        (_recovery_reload or reload)()
+
+ws_client.on_recovery(on_server_recovery)
+
+def load(retries=5, delay=2):
+    for attempt in range(retries):
+        if reload():
+            return True
+        logger.error(f"Error loading config, attempt {attempt + 1} of {retries}")
+        time.sleep(delay)
+    logger.critical("Failed to load config after retries.")
+    return False
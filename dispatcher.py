@@ -0,0 +1,66 @@
+import collections
+import logging
+import os
+import threading
+import scheduler
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+DISPATCH_QUEUE_DEPTH = int(os.getenv('DISPATCH_QUEUE_DEPTH', '8'))
+# Keep only the newest pending reading per sensor; older ones are stale by the time a worker is free
+DISPATCH_COALESCE = os.getenv('DISPATCH_COALESCE', '1') == '1'
+
+class SensorDispatcher:
+    def __init__(self, handler, queue_depth=DISPATCH_QUEUE_DEPTH, coalesce=DISPATCH_COALESCE, executor=None):
+        # executor: anything with submit(func, *args); the realtime lane by default, whose worker
+        # count is LANE_WORKERS
+        self.handler = handler
+        self.queue_depth = queue_depth
+        self.coalesce = coalesce
+        self.stats = {"submitted": 0, "handled": 0, "coalesced": 0, "dropped": 0}
+        self._executor = executor or scheduler.get_lanes().executor(scheduler.REALTIME)
+        self._queues = {}  # sensor_id -> deque of pending argument tuples
+        self._draining = set()  # sensors with a worker currently serving their queue
+        self._lock = threading.Lock()
+
+    def submit(self, sensor_id, *args):
+        with self._lock:
+            pending = self._queues.get(sensor_id)
+            if pending is None:
+                pending = self._queues[sensor_id] = collections.deque()
+            if self.coalesce:
+                self.stats["coalesced"] += len(pending)
+                pending.clear()
+            elif len(pending) >= self.queue_depth:
+                pending.popleft()
+                self.stats["dropped"] += 1
+            pending.append(args)
+            self.stats["submitted"] += 1
+            if sensor_id in self._draining:
+                return
+            self._draining.add(sensor_id)
+        self._executor.submit(self._drain, sensor_id)
+
+    def _drain(self, sensor_id):
+        # Only one worker serves a sensor at a time, so its readings are handled in order
+        while True:
+            with self._lock:
+                pending = self._queues[sensor_id]
+                if not pending:
+                    self._draining.discard(sensor_id)
+                    return
+                args = pending.popleft()
+            try:
+                self.handler(sensor_id, *args)
+            except Exception as e:
+                logger.error(f"Handler failed for sensor {sensor_id}: {e}")
+            with self._lock:
+                self.stats["handled"] += 1
+
+    def queue_depths(self):
+        with self._lock:
+            return {sensor_id: len(pending) for sensor_id, pending in self._queues.items()}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
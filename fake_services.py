@@ -0,0 +1,243 @@
+import base64
+import hashlib
+import json
+import logging
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Stand-ins for the Mosquitto broker and the WebSocket server, used by benchmark.py
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+def topic_matches(subscription, topic):
+    sub_levels = subscription.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(sub_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload if isinstance(payload, bytes) else str(payload).encode()
+
+class FakeMQTTClient:
+    # Just enough of paho's Client for mqtt_handler: callbacks, subscribe and publish
+    def __init__(self, broker):
+        self.broker = broker
+        self.on_connect = None
+        self.on_message = None
+
+    def connect(self):
+        self.broker.connect(self)
+
+    def subscribe(self, topic, qos=0):
+        self.broker.subscribe(self, topic)
+        return (0, 1)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.broker.publish(topic, payload, retain=retain)
+
+class FakeBroker:
+    # Delivers publishes synchronously on the publishing thread; every publish is recorded
+    def __init__(self):
+        self.subscriptions = []  # (subscription, client)
+        self.published = []  # (timestamp, topic, payload)
+        self.listeners = []  # callbacks(timestamp, topic, payload) run on every publish
+        self._lock = threading.Lock()
+
+    def connect(self, client):
+        if client.on_connect:
+            client.on_connect(client, None, {}, 0)
+
+    def subscribe(self, client, subscription):
+        with self._lock:
+            if (subscription, client) not in self.subscriptions:
+                self.subscriptions.append((subscription, client))
+
+    def publish(self, topic, payload, retain=False):
+        now = time.perf_counter()
+        with self._lock:
+            self.published.append((now, topic, payload))
+            clients = [client for subscription, client in self.subscriptions if topic_matches(subscription, topic)]
+        for listener in self.listeners:
+            listener(now, topic, payload)
+        # A client subscribed through overlapping filters still gets one copy
+        for client in dict.fromkeys(clients):
+            if client.on_message:
+                client.on_message(client, None, FakeMessage(topic, payload))
+
+class FakeServerData:
+    # Canned server state: ranges tile 0..upper, every sensor has a position in every range
+    def __init__(self, num_sensors=4, num_strips=None, mode=1,
+                 range_limits=((1, 0, 50), (2, 50, 100), (3, 100, 150))):
+        self.num_sensors = num_sensors
+        self.num_strips = num_sensors if num_strips is None else num_strips
+        self.mode = mode
+        self.ranges = [{"range_ID": range_id, "lower_limit": lower, "upper_limit": upper}
+                       for range_id, lower, upper in range_limits]
+        self.positions = [{"position_ID": (sensor_id - 1) * len(self.ranges) + i + 1,
+                           "sensor_ID": sensor_id, "range_ID": range_data["range_ID"]}
+                          for sensor_id in range(1, num_sensors + 1)
+                          for i, range_data in enumerate(self.ranges)]
+        self.colors = {1: (255, 0, 0), 2: (0, 255, 0), 3: (0, 0, 255)}
+
+    def note_id(self, sensor_id, range_id):
+        return sensor_id * 100 + range_id
+
+    def handle(self, request):
+        action = request.get("action")
+        payload = request.get("payload") or {}
+        if action == "getRanges":
+            return {"action": action, "data": self.ranges}
+        if action == "fetchAllPositions":
+            return {"action": action, "data": self.positions}
+        if action == "fetchAllSecuritySequences":
+            return {"action": action, "data": []}
+        if action == "getNotes":
+            return {"action": action, "data": []}  # Nothing to decode; playback is measured at the audio engine
+        if action == "getNoteDetails":
+            return {"action": action, "data": {"note_ID": self.note_id(payload.get("sensor_ID"), payload.get("range_ID"))}}
+        if action == "fetchActiveMode":
+            return {"action": action, "data": {"mode_ID": self.mode}}
+        if action in ("logSensorData", "logSensorDataBatch"):
+            return {"action": action, "message": "ok"}
+        if action == "getLEDTriggerPayload":
+            return {"action": "LEDTrigger", "payload": {"sensor_id": payload.get("sensor_id"), "range_ID": payload.get("distance")}}
+        if action == "sendLEDTrigger":
+            return {"action": "LEDTrigger", "message": payload.get("message", "sent")}
+        if action == "determineLEDColor":
+            return {"action": action, "data": [{"range_ID": range_id, "red": r, "green": g, "blue": b}
+                                               for range_id, (r, g, b) in self.colors.items()]}
+        if action == "getRangeLimits":
+            return {"action": action, "data": {"closeUpperLimit": self.ranges[0]["upper_limit"],
+                                               "midUpperLimit": self.ranges[1]["upper_limit"]}}
+        if action in ("updateSensorAlive", "updateSensorStatus"):
+            return {"action": "update_sensor_status", "message": "ok"}
+        if action in ("updateLedStripStatus", "updateDeviceStatusBatch"):
+            return {"action": action, "message": "ok"}
+        return {"action": action, "error": f"Unknown action {action}"}
+
+class _WSHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server.fake
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if not self._handshake(sock):
+            return
+        while True:
+            try:
+                opcode, data = self._read_frame(sock)
+            except (ConnectionError, OSError):
+                return
+            if opcode == 0x8:  # close
+                self._send_frame(sock, 0x8, data[:2])
+                return
+            if opcode == 0x9:  # ping
+                self._send_frame(sock, 0xA, data)
+                continue
+            if opcode != 0x1:
+                continue
+            request = json.loads(data.decode())
+            server.stats[request.get("action")] = server.stats.get(request.get("action"), 0) + 1
+            delay = server.latency_for(request.get("action"))
+            if delay:
+                time.sleep(delay)
+            self._send_frame(sock, 0x1, json.dumps(server.data.handle(request)).encode())
+
+    def _handshake(self, sock):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return False
+            request += chunk
+        headers = {}
+        for line in request.decode("latin-1").split("\r\n")[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1((headers.get("sec-websocket-key", "") + WS_GUID).encode()).digest()).decode()
+        sock.sendall(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        return True
+
+    def _recv_exact(self, sock, size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Client closed the connection")
+            data += chunk
+        return data
+
+    def _read_frame(self, sock):
+        first, second = self._recv_exact(sock, 2)
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self._recv_exact(sock, 2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._recv_exact(sock, 8))[0]
+        mask = self._recv_exact(sock, 4) if second & 0x80 else None
+        data = self._recv_exact(sock, length)
+        if mask:
+            data = bytes(byte ^ mask[i % 4] for i, byte in enumerate(data))
+        return first & 0x0F, data
+
+    def _send_frame(self, sock, opcode, data):
+        header = bytes([0x80 | opcode])
+        if len(data) < 126:
+            header += bytes([len(data)])
+        elif len(data) < 65536:
+            header += bytes([126]) + struct.pack("!H", len(data))
+        else:
+            header += bytes([127]) + struct.pack("!Q", len(data))
+        sock.sendall(header + data)
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class FakeWSServer:
+    # Minimal RFC 6455 server on localhost answering the actions the app sends, after a
+    # configurable delay per action (seconds, plus up to `jitter` extra)
+    def __init__(self, data=None, latency=0.0, action_latency=None, jitter=0.0, port=0):
+        self.data = data or FakeServerData()
+        self.latency = latency
+        self.action_latency = action_latency or {}
+        self.jitter = jitter
+        self.stats = {}  # action -> requests served
+        self._server = _ThreadingServer(("127.0.0.1", port), _WSHandler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"ws://{host}:{port}"
+
+    def latency_for(self, action):
+        delay = self.action_latency.get(action, self.latency)
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        return delay
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Fake WebSocket server listening on {self.url}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
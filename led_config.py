@@ -0,0 +1,219 @@
+import logging
+import os
+import re
+import threading
+import time
+import ws_client
+import offline_cache
+import config_snapshot
+from config import CONFIG_TOPICS, CONFIG_RANGE_TOPIC
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+NUM_LEDS = 31
+LED_TRIGGER_DURATION = os.getenv('LED_TRIGGER_DURATION', '1000')  # milliseconds
+# Triggers are built by the server (getLEDTriggerPayload/sendLEDTrigger) unless this is set to the
+# topic a strip listens on for trigger frames, e.g. "ledstrip/{led_strip_name}/trigger"; then
+# sensors wired to a strip in SENSOR_LED_STRIPS get their frames published directly
+LED_TRIGGER_TOPIC = os.getenv('LED_TRIGGER_TOPIC', '')
+# Per-strip colour config topic; {led_strip_name} and {strip_number} are filled in per strip.
+# When unset, strip N uses CONFIG_TOPICS[N - 1].
+LED_CONFIG_TOPIC = os.getenv('LED_CONFIG_TOPIC', '')
+# Sensor to strip wiring for direct triggers, e.g. "1:ledstrip1,2:ledstrip1". Sensors not listed
+# keep going through the server.
+SENSOR_LED_STRIPS = dict(
+    (int(sensor_id), led_strip_name)
+    for sensor_id, led_strip_name in (item.split(":") for item in os.getenv('SENSOR_LED_STRIPS', '').split(",") if item)
+)
+# Send a strip's config as one retained message per topic, lines separated by newlines, so the
+# broker hands it to a rebooted strip without us publishing anything; needs strip firmware that
+# splits the lines
+LED_CONFIG_BUNDLE = os.getenv('LED_CONFIG_BUNDLE', '0') == '1'
+# Range limits and colours are not part of the config snapshot: the built config messages are
+# reused for this many seconds, or until the MQTT topic / server push below says they changed
+LED_CONFIG_TTL = float(os.getenv('LED_CONFIG_TTL', '600'))
+LED_CONFIG_INVALIDATE_TOPIC = os.getenv('LED_CONFIG_INVALIDATE_TOPIC', 'config/led_config')
+LED_CONFIG_INVALIDATE_ACTION = "ledConfigChanged"
+
+RANGE_NAMES = {1: "close", 2: "mid", 3: "far"}
+# Security feedback frames never change, so they are built once
+SECURITY_DURATION = 3000  # milliseconds
+SECURITY_COLORS = {'green': '0,255,0', 'red': '255,0,0', 'off': '0,0,0'}
+SECURITY_MESSAGES = {color: f"0-{NUM_LEDS - 1}&{color_code}&{SECURITY_DURATION}" for color, color_code in SECURITY_COLORS.items()}
+SECURITY_FRAMES = {color: message.encode() for color, message in SECURITY_MESSAGES.items()}
+
+strip_colors = {}  # led_strip_name -> {range_ID: "r,g,b"}
+trigger_frames = {}  # led_strip_name -> (trigger topic, {range_ID: payload bytes}), rebuilt with the colours
+config_payloads = {}  # led_strip_name -> (config version, build time, [(topic, payload bytes)])
+pushed_config = {}  # led_strip_name -> config messages last published to the strip
+stale_strips = set()  # strips running on cached colours because the server did not answer
+publisher = None  # MQTT client used for direct publishes, set once the client exists
+
+_lock = threading.Lock()
+_recovery_load = None  # replaces load_led_config after a server outage; set by the asyncio runtime
+
+def set_publisher(client):
+    global publisher
+    publisher = client
+
+def _set_strip_colors(led_strip_name, new_colors):
+    # Trigger payloads are formatted here once instead of on every reading
+    with _lock:
+        strip_colors[led_strip_name] = new_colors
+        if LED_TRIGGER_TOPIC:
+            topic = LED_TRIGGER_TOPIC.format(led_strip_name=led_strip_name)
+            frames = {range_id: f"0-{NUM_LEDS - 1}&{color_code}&{LED_TRIGGER_DURATION}".encode() for range_id, color_code in new_colors.items()}
+            trigger_frames[led_strip_name] = (topic, frames)
+
+def update_strip_colors(led_strip_name, colors):
+    new_colors = {color["range_ID"]: f"{color['red']},{color['green']},{color['blue']}" for color in colors}
+    _set_strip_colors(led_strip_name, new_colors)
+    logger.debug(f"Cached LED colours for {led_strip_name}: {new_colors}")
+
+def fetch_strip_colors(led_strip_name):
+    ws_payload = {
+        "action": "determineLEDColor",
+        "payload": {
+            "sensorName": led_strip_name
+        }
+    }
+    response_data = ws_client.request(ws_payload)
+    if response_data.get("action") == "determineLEDColor" and "error" not in response_data:
+        update_strip_colors(led_strip_name, response_data["data"])
+        return response_data["data"]
+    logger.error(f"Failed to fetch LED color configuration for {led_strip_name}: {response_data.get('error')}")
+    return None
+
+def use_cached_colors(led_strip_names):
+    # Falls back to the colours the strips had last time so triggers can still be built locally
+    cached = offline_cache.load("led_colors") if led_strip_names else None
+    for led_strip_name in led_strip_names:
+        if cached and led_strip_name in cached and led_strip_name not in strip_colors:
+            _set_strip_colors(led_strip_name, {int(range_id): color for range_id, color in cached[led_strip_name].items()})
+        stale_strips.add(led_strip_name)
+    with _lock:
+        offline_cache.save("led_colors", strip_colors)
+
+def load_led_config(led_strip_names):
+    missing = []
+    for led_strip_name in led_strip_names:
+        try:
+            if fetch_strip_colors(led_strip_name) is not None:
+                stale_strips.discard(led_strip_name)
+                continue
+        except Exception as e:
+            logger.error(f"Failed to load LED config for {led_strip_name}: {e}")
+        missing.append(led_strip_name)
+    use_cached_colors(missing)
+
+def set_recovery_load(func):
+    # func(led_strip_names) starts loading their colours without blocking the timer thread
+    global _recovery_load
+    _recovery_load = func
+
+def on_server_recovery():
+    if stale_strips:
+        (_recovery_load or load_led_config)(list(stale_strips))
+
+ws_client.on_recovery(on_server_recovery)
+
+def config_topic_for_strip(led_strip_name):
+    match = re.search(r"(\d+)$", led_strip_name)
+    if match is None:
+        return None
+    strip_number = int(match.group(1))
+    if LED_CONFIG_TOPIC:
+        return LED_CONFIG_TOPIC.format(led_strip_name=led_strip_name, strip_number=strip_number)
+    if 1 <= strip_number <= len(CONFIG_TOPICS):
+        return CONFIG_TOPICS[strip_number - 1]
+    return None
+
+def build_config_payloads(led_strip_name, limits, colors):
+    # limits: (close upper limit, mid upper limit) or None, colors: the server's colour rows or None.
+    # Cached for the current config version and LED_CONFIG_TTL only when complete, so a strip
+    # that comes up again gets the same bytes without asking the server.
+    messages = []  # (topic, payload)
+    if limits is not None:
+        messages.append((CONFIG_RANGE_TOPIC, f"{limits[0]},{limits[1]}".encode()))
+    if colors is not None:
+        config_topic = config_topic_for_strip(led_strip_name)
+        if config_topic is None:
+            logger.error(f"No config topic for LED strip {led_strip_name}")
+            return None
+        for color in colors:
+            range_name = RANGE_NAMES.get(color["range_ID"], "")
+            messages.append((config_topic, f"{range_name}&{color['red']},{color['green']},{color['blue']}".encode()))
+    if LED_CONFIG_BUNDLE:
+        bundled = {}
+        for topic, payload in messages:
+            bundled.setdefault(topic, []).append(payload)
+        messages = [(topic, b"\n".join(payloads)) for topic, payloads in bundled.items()]
+    if limits is not None and colors is not None:
+        with _lock:
+            config_payloads[led_strip_name] = (config_snapshot.current().version, time.time(), messages)
+    return messages
+
+def cached_config_payloads(led_strip_name):
+    # None once the config has been reloaded or the payloads invalidated since they were built, or
+    # when they are older than LED_CONFIG_TTL; old ones are still used while the server is unavailable
+    entry = config_payloads.get(led_strip_name)
+    if entry is None or entry[0] != config_snapshot.current().version:
+        return None
+    _, built_at, messages = entry
+    if time.time() - built_at > LED_CONFIG_TTL and ws_client.server_available():
+        return None
+    return messages
+
+def invalidate():
+    # The next push for each strip asks the server again
+    logger.info("LED config invalidated, refreshing")
+    with _lock:
+        config_payloads.clear()
+
+def publish_config(client, messages):
+    # Back to back on one connection; retained when bundled, so the broker keeps one per topic
+    for topic, payload in messages:
+        client.publish(topic, payload, retain=LED_CONFIG_BUNDLE)
+
+def config_changed(led_strip_name, messages):
+    # Records messages as pushed; False when the strip already has exactly these
+    messages = tuple(messages)
+    with _lock:
+        if pushed_config.get(led_strip_name) == messages:
+            return False
+        pushed_config[led_strip_name] = messages
+    return True
+
+def _frames_for_sensor(sensor_id):
+    # None unless direct triggers are configured and the sensor is wired to a strip with known colours
+    led_strip_name = SENSOR_LED_STRIPS.get(sensor_id)
+    return trigger_frames.get(led_strip_name) if led_strip_name is not None else None
+
+def build_trigger(sensor_id, range_id):
+    strip = _frames_for_sensor(sensor_id)
+    if strip is None:
+        return None
+    topic, frames = strip
+    payload = frames.get(range_id)
+    if payload is None:
+        return None
+    return topic, payload
+
+def publish_message(sensor_id, message):
+    # Sends a ready-made trigger frame straight to the sensor's strip
+    strip = _frames_for_sensor(sensor_id)
+    if strip is None or publisher is None:
+        return False
+    publisher.publish(strip[0], message)
+    return True
+
+def publish_trigger(sensor_id, range_id):
+    # Returns False when the payload cannot be built locally so the caller can fall back to the server
+    trigger = build_trigger(sensor_id, range_id)
+    if trigger is None or publisher is None:
+        return False
+    topic, message = trigger
+    publisher.publish(topic, message)
+    logger.debug("Published LED trigger to %s: %s", topic, message)
+    return True
@@ -0,0 +1,108 @@
+import logging
+import math
+import os
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Resolution of liveness deadlines in seconds, and how often they are checked
+LIVENESS_TICK = float(os.getenv('LIVENESS_TICK', '1'))
+# Buckets on the wheel; deadlines further out than slots * tick wait in their bucket for extra turns
+LIVENESS_WHEEL_SLOTS = 512
+
+class TimerWheel:
+    # Hashed timing wheel: a deadline is filed in the bucket of its tick and a bucket is only looked
+    # at when the wheel passes it, so filing is O(1) and advancing costs one step per elapsed tick
+    # plus the entries that come due
+    def __init__(self, tick=LIVENESS_TICK, slots=LIVENESS_WHEEL_SLOTS, now=None):
+        self.tick = tick
+        self.slots = slots
+        self.buckets = [[] for _ in range(slots)]  # [(tick index, key)]
+        self.current = int((time.time() if now is None else now) // tick)  # last tick advanced past
+        self.size = 0
+
+    def schedule(self, key, deadline):
+        # Rounded up, so an entry never comes due before its deadline
+        tick_index = max(math.ceil(deadline / self.tick), self.current + 1)
+        self.buckets[tick_index % self.slots].append((tick_index, key))
+        self.size += 1
+
+    def advance(self, now):
+        # Keys whose deadline is at or before now, each returned once
+        target = int(now // self.tick)
+        if target <= self.current:
+            return []
+        if target - self.current >= self.slots:
+            indexes = range(self.slots)  # A whole turn or more has gone by: every bucket is due
+        else:
+            indexes = (tick_index % self.slots for tick_index in range(self.current + 1, target + 1))
+        due = []
+        for index in indexes:
+            bucket = self.buckets[index]
+            if not bucket:
+                continue
+            later = [entry for entry in bucket if entry[0] > target]
+            due += [key for tick_index, key in bucket if tick_index <= target]
+            self.buckets[index] = later
+        self.current = target
+        self.size -= len(due)
+        return due
+
+class LivenessTracker:
+    # Each key (a device) has a deadline that every message pushes forward; that is a dict write,
+    # and the wheel holds at most one entry per key, re-filed lazily when it comes due with the
+    # deadline having moved on. A key expires once, and only a new message makes it live again.
+    def __init__(self, timeout, tick=LIVENESS_TICK, now=None):
+        self.timeout = timeout
+        self.deadlines = {}  # key -> time the key expires unless it is touched again
+        self.expired = set()
+        self.stats = {"expired": 0, "revived": 0}
+        self._filed = set()  # keys with an entry on the wheel
+        self._wheel = TimerWheel(tick, now=now)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def touch(self, key, now=None):
+        deadline = (time.time() if now is None else now) + self.timeout
+        with self._lock:
+            if deadline <= self.deadlines.get(key, 0):
+                return  # A late report of older activity
+            self.deadlines[key] = deadline
+            if key in self.expired:
+                self.expired.discard(key)
+                self.stats["revived"] += 1
+            if key not in self._filed:
+                self._filed.add(key)
+                self._wheel.schedule(key, deadline)
+
+    def forget(self, key):
+        with self._lock:
+            self.deadlines.pop(key, None)
+            self.expired.discard(key)
+            # A wheel entry left behind is dropped when it comes due
+
+    def expire(self, now=None):
+        # Keys that went quiet since the last call
+        now = time.time() if now is None else now
+        expired = []
+        with self._lock:
+            for key in self._wheel.advance(now):
+                deadline = self.deadlines.get(key)
+                if deadline is None:
+                    self._filed.discard(key)
+                elif deadline > now:
+                    self._wheel.schedule(key, deadline)
+                else:
+                    self._filed.discard(key)
+                    self.expired.add(key)
+                    expired.append(key)
+            self.stats["expired"] += len(expired)
+        return expired
+
+    def gauges(self, prefix):
+        return [(prefix + "_tracked", {}, len(self.deadlines)), (prefix + "_expired", {}, len(self.expired)),
+                (prefix + "_expiries", {}, self.stats["expired"]), (prefix + "_revivals", {}, self.stats["revived"])]
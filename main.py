@@ -1,44 +1,86 @@
 import logging
 import os
-import time
+import signal
 import threading
-from mqtt_handler import setup_mqtt_client, check_for_inactivity, check_for_alive_messages
-from sound import load_sounds, load_ranges
+from bootstrap import App
+from mqtt_handler import (setup_mqtt_client, check_for_inactivity, check_for_alive_messages, flush_status,
+                          refresh_strip_config, lanes, INACTIVITY_CHECK_PERIOD)
+from status_aggregator import STATUS_FLUSH_INTERVAL
+from scheduler import PeriodicTask, HOUSEKEEPING
+from sensor_registry import registry
+import config_snapshot
+from note_cache import load_note_map
+import mode_cache
+import sensor_log
+import audio_engine
+import led_config
+import ws_client
+import metrics
 
 # Set the logging level based on an environment variable
 log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
 logging.basicConfig(level=getattr(logging, log_level))
 logger = logging.getLogger(__name__)
 
-def main():
+def main(housekeeping=True):
+    # housekeeping=False leaves the installation-wide inactivity check to another process (supervisor.py)
     logger.debug("Starting main function")
 
-    # Load sounds and ranges from the server with retries
-    logger.debug("Loading sounds")
-    load_sounds()
-    logger.debug("Loading ranges")
-    load_ranges()
-
-    # Create and set up MQTT client
-    logger.debug("Setting up MQTT client")
-    client = setup_mqtt_client()
-    
-    # Start the thread to check for alive messages
-    logger.debug("Starting thread to check for alive messages")
-    threading.Thread(target=check_for_alive_messages, daemon=True).start()
-
-    # Start the MQTT loop to handle incoming messages
+    # Independent parts start together: the mixer, the broker connection, the config and the
+    # active mode; the note mapping and LED colours need the config's positions and strips
+    app = App()
+    app.phase("audio", audio_engine.get_engine)
+    app.phase("config", config_snapshot.load)
+    app.phase("mode", mode_cache.start)
+    mqtt_setup = app.phase("mqtt", setup_mqtt_client)
+    app.phase("note_map", load_note_map, after=("config",))
+    # Colours are needed for the strips this process tracks and for those it sends triggers to
+    led_strip_names = sorted(set(registry.led_strips) | set(led_config.SENSOR_LED_STRIPS.values()))
+    app.phase("led_config", lambda: led_config.load_led_config(led_strip_names), after=("config",))
+    app.wait()
+    client = mqtt_setup.result()
+
+    # Strips that are up get changed config pushed to them after a reload
+    config_snapshot.add_listener(refresh_strip_config)
+
+    # Messages are handled on paho's network thread as soon as they arrive
+    logger.debug("Starting MQTT client loop")
+    client.loop_start()
+
+    # Housekeeping runs on its own timers; whatever talks to the server queues in the housekeeping lane
+    logger.debug("Scheduling inactivity and alive checks")
+    tasks = [
+        PeriodicTask(INACTIVITY_CHECK_PERIOD, check_for_alive_messages).start(),
+        PeriodicTask(STATUS_FLUSH_INTERVAL, lanes.submit, HOUSEKEEPING, flush_status, name="flush_status").start(),
+    ]
+    if housekeeping:
+        tasks.append(PeriodicTask(INACTIVITY_CHECK_PERIOD, check_for_inactivity, client).start())
+    if config_snapshot.CONFIG_RELOAD_INTERVAL > 0:
+        tasks.append(PeriodicTask(config_snapshot.CONFIG_RELOAD_INTERVAL, lanes.submit, HOUSEKEEPING,
+                                  config_snapshot.reload, name="config_reload").start())
+    if metrics.METRICS_TOPIC:
+        tasks.append(PeriodicTask(metrics.METRICS_PUBLISH_INTERVAL, metrics.publish, client).start())
+    metrics.add_collector(lanes.gauges)
+    metrics.start_http_server()
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
     try:
-        logger.debug("Starting MQTT client loop")
-        while True:
-            client.loop()
-            check_for_inactivity(client)
-            time.sleep(1)
+        stop_event.wait()
     except KeyboardInterrupt:
         logger.info("MQTT client loop stopped by user.")
     finally:
+        for task in tasks:
+            task.stop()
+        client.loop_stop()
         client.disconnect()
         logger.info("MQTT client disconnected.")
+        lanes.shutdown()
+        mode_cache.stop()
+        sensor_log.stop()
+        audio_engine.stop()
+        ws_client.close()
+        metrics.stop_http_server()
 
 if __name__ == "__main__":
     main()
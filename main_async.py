@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import os
+import signal
+import async_handlers
+import audio_engine
+import config_snapshot
+import led_config
+import mode_cache
+import mqtt_handler
+import sensor_log
+import metrics
+from bootstrap import App
+from async_mqtt import AsyncMQTTClient
+from async_ws_client import AsyncWSClient
+from config import MQTT_BROKER, MQTT_PORT
+from sensor_registry import registry
+from scheduler import HOUSEKEEPING
+from status_aggregator import STATUS_FLUSH_INTERVAL
+from mqtt_handler import check_for_inactivity, INACTIVITY_CHECK_PERIOD
+
+# Set the logging level based on an environment variable
+log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(level=getattr(logging, log_level))
+logger = logging.getLogger(__name__)
+
+async def every(interval, func, *args):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            result = func(*args)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logger.error(f"Scheduled task {func.__name__} failed: {e}")
+
+async def load_config(ws):
+    # The config snapshot fetches its parts concurrently
+    for attempt in range(5):
+        if await async_handlers.reload_config(ws):
+            return True
+        logger.error(f"Error loading config, attempt {attempt + 1} of 5")
+        await asyncio.sleep(2)
+    return False
+
+async def refresh_mode(ws):
+    try:
+        response_data = await ws.request({"action": "fetchActiveMode"})
+    except Exception as e:
+        logger.error(f"Failed to fetch current mode: {e}")
+        return
+    if response_data.get("action") == "fetchActiveMode" and "data" in response_data:
+        mode_cache.set_mode(response_data["data"].get("mode_ID"), "poll")
+
+async def main():
+    logger.debug("Starting asyncio runtime")
+    ws = AsyncWSClient()
+    ws.add_listener(mode_cache.MODE_CHANGED_ACTION, mode_cache.handle_mode_push)
+    async_handlers.use_async_client(ws)
+    # Readings are logged by a task on this loop through ws, not the threaded pipeline
+    sensor_log.set_pipeline(sensor_log.AsyncSensorLogPipeline(ws.request))
+
+    # The mixer opens on a worker thread while the config loads; the broker connection and
+    # the fetches that need the config's positions and strips then run concurrently
+    app = App()
+    audio = asyncio.wrap_future(app.phase("audio", audio_engine.get_engine))
+    await app.run_async("config", load_config(ws))
+    mqtt = AsyncMQTTClient(on_connect=mqtt_handler.on_connect)
+    led_strip_names = sorted(set(registry.led_strips) | set(led_config.SENSOR_LED_STRIPS.values()))
+    await asyncio.gather(app.run_async("note_map", async_handlers.load_note_map(ws)), app.run_async("mode", refresh_mode(ws)),
+                         app.run_async("led_config", async_handlers.load_led_config(ws, led_strip_names)),
+                         app.run_async("mqtt", mqtt.connect(MQTT_BROKER, MQTT_PORT)), audio)
+    app.report()
+    mqtt_handler.mqtt_client = mqtt.client
+    led_config.set_publisher(mqtt.client)
+
+    loop = asyncio.get_running_loop()
+    tasks = [
+        loop.create_task(every(INACTIVITY_CHECK_PERIOD, check_for_inactivity, mqtt.client)),
+        loop.create_task(every(INACTIVITY_CHECK_PERIOD, mqtt_handler.check_for_alive_messages)),
+        loop.create_task(every(STATUS_FLUSH_INTERVAL, async_handlers.lanes.run, HOUSEKEEPING, async_handlers.flush_status, ws)),
+    ]
+    if config_snapshot.CONFIG_RELOAD_INTERVAL > 0:
+        tasks.append(loop.create_task(every(config_snapshot.CONFIG_RELOAD_INTERVAL, async_handlers.lanes.run, HOUSEKEEPING,
+                                            async_handlers.reload_config, ws)))
+    if mode_cache.MODE_POLL_INTERVAL > 0:
+        tasks.append(loop.create_task(every(mode_cache.MODE_POLL_INTERVAL, refresh_mode, ws)))
+    if metrics.METRICS_TOPIC:
+        tasks.append(loop.create_task(every(metrics.METRICS_PUBLISH_INTERVAL, metrics.publish, mqtt.client)))
+    metrics.add_collector(async_handlers.lanes.gauges)
+    metrics.start_http_server()
+
+    stop_event = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+    loop.add_signal_handler(signal.SIGINT, stop_event.set)
+
+    dispatcher = async_handlers.AsyncSensorDispatcher(
+        lambda sensor_id, *args: async_handlers.fetch_and_play_note_details(ws, sensor_id, *args))
+
+    async def consume():
+        while True:
+            message = await mqtt.next_message()
+            task = loop.create_task(async_handlers.handle_message(ws, mqtt, dispatcher, message))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception() is None
+                                   or logger.error(f"Unexpected error in on_message: {t.exception()}"))
+
+    tasks.append(loop.create_task(consume()))
+    try:
+        await stop_event.wait()
+        logger.info("Asyncio runtime stopping.")
+    finally:
+        for task in tasks:
+            task.cancel()
+        mqtt.disconnect()
+        logger.info("MQTT client disconnected.")
+        await sensor_log.stop_async()
+        audio_engine.stop()
+        await ws.close()
+        metrics.stop_http_server()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,198 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Port for the Prometheus text endpoint (/metrics), 0 disables it
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_BIND = os.getenv('METRICS_BIND', '127.0.0.1')
+# MQTT topic the metrics are published to as JSON, empty disables publishing
+METRICS_TOPIC = os.getenv('METRICS_TOPIC', '')
+METRICS_PUBLISH_INTERVAL = float(os.getenv('METRICS_PUBLISH_INTERVAL', '60'))
+METRICS_PREFIX = "musicalstairs_"
+
+# Bucket upper bounds in seconds, from sub-millisecond local work up to slow server round trips
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        # A lost increment under a race is acceptable for a counter; no lock on the hot path
+        self.value += amount
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def time(self):
+        return Span(self)
+
+class Span:
+    # Times a block into a histogram: with NOTE_RESOLUTION_TIME.time(): ...
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+_counters = {}  # (name, labels) -> Counter
+_histograms = {}  # (name, labels) -> Histogram
+_help = {}  # name -> help text
+_collectors = []  # callables returning [(name, labels dict, value)] gauges read at export time
+_lock = threading.Lock()
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def counter(name, help_text="", **labels):
+    key = _key(name, labels)
+    metric = _counters.get(key)
+    if metric is None:
+        with _lock:
+            metric = _counters.setdefault(key, Counter())
+            _help.setdefault(name, help_text)
+    return metric
+
+def histogram(name, help_text="", buckets=DEFAULT_BUCKETS, **labels):
+    key = _key(name, labels)
+    metric = _histograms.get(key)
+    if metric is None:
+        with _lock:
+            metric = _histograms.setdefault(key, Histogram(buckets))
+            _help.setdefault(name, help_text)
+    return metric
+
+def stage(name):
+    # Pipeline stage timings share one histogram family, labelled by stage. Hot paths look the
+    # histogram up once at import and time with .time(), so a span costs two clock reads.
+    return histogram("stage_seconds", "Time spent in each pipeline stage", stage=name)
+
+def add_collector(collector):
+    _collectors.append(collector)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+def render():
+    # Prometheus text exposition format
+    lines = []
+    by_name = {}
+    for (name, labels), metric in list(_counters.items()):
+        by_name.setdefault(("counter", name), []).append((labels, metric))
+    for (name, labels), metric in list(_histograms.items()):
+        by_name.setdefault(("histogram", name), []).append((labels, metric))
+    for (kind, name), series in sorted(by_name.items(), key=lambda item: item[0][1]):
+        full_name = METRICS_PREFIX + name
+        if _help.get(name):
+            lines.append(f"# HELP {full_name} {_help[name]}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for labels, metric in series:
+            if kind == "counter":
+                lines.append(f"{full_name}{_format_labels(labels)} {metric.value}")
+                continue
+            counts, total, count = metric.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(list(metric.buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {count}")
+    for name, labels, value in collect_gauges():
+        lines.append(f"{METRICS_PREFIX}{name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+    return "\n".join(lines) + "\n"
+
+def collect_gauges():
+    gauges = []
+    for collector in _collectors:
+        try:
+            gauges.extend(collector())
+        except Exception as e:
+            logger.error(f"Metrics collector {getattr(collector, '__name__', collector)} failed: {e}")
+    return gauges
+
+def summary():
+    # Compact form for the MQTT topic: counters, histogram count/sum/mean, gauges
+    result = {"counters": {}, "histograms": {}, "gauges": {}}
+    for (name, labels), metric in list(_counters.items()):
+        result["counters"][name + _format_labels(labels)] = metric.value
+    for (name, labels), metric in list(_histograms.items()):
+        counts, total, count = metric.snapshot()
+        result["histograms"][name + _format_labels(labels)] = {
+            "count": count, "sum": round(total, 6), "mean": round(total / count, 6) if count else None}
+    for name, labels, value in collect_gauges():
+        result["gauges"][name + _format_labels(tuple(sorted(labels.items())))] = value
+    return result
+
+def publish(client):
+    if METRICS_TOPIC and client is not None:
+        client.publish(METRICS_TOPIC, json.dumps(summary()))
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request: " + format, *args)
+
+_server = None
+
+def start_http_server(port=METRICS_PORT, bind=METRICS_BIND):
+    global _server
+    if not port or _server is not None:
+        return None
+    _server = ThreadingHTTPServer((bind, port), _MetricsHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on http://{bind}:{port}/metrics")
+    return _server
+
+def stop_http_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
@@ -0,0 +1,76 @@
+import logging
+import os
+import threading
+import ws_client
+import offline_cache
+from utils import get_current_mode
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# MQTT topic and server-push action that announce a new active mode
+MODE_TOPIC = os.getenv('MODE_TOPIC', 'config/mode')
+MODE_CHANGED_ACTION = "activeModeChanged"
+# Fallback poll in seconds in case a push is missed, 0 disables polling
+MODE_POLL_INTERVAL = float(os.getenv('MODE_POLL_INTERVAL', '300'))
+# Mode used when the server has never answered and no mode is cached (1 = Musical Stairs)
+MODE_FALLBACK = int(os.getenv('MODE_FALLBACK', '1'))
+
+current_mode = None
+
+_stop_event = threading.Event()
+_poll_thread = None
+
+def set_mode(mode_id, source):
+    global current_mode
+    if mode_id != current_mode:
+        logger.info(f"Active mode changed from {current_mode} to {mode_id} ({source})")
+        if source != "last known":
+            offline_cache.save("mode", mode_id)
+    current_mode = mode_id
+
+def refresh_mode():
+    mode_id = get_current_mode()
+    if mode_id is not None:
+        set_mode(mode_id, "poll")
+    return mode_id
+
+def last_known_mode():
+    mode_id = offline_cache.load("mode")
+    return MODE_FALLBACK if mode_id is None else mode_id
+
+def get_mode():
+    if current_mode is None and refresh_mode() is None:
+        # Keep playing on the last-known mode; the poll or a push corrects it later
+        set_mode(last_known_mode(), "last known")
+    return current_mode
+
+def handle_mode_message(payload):
+    try:
+        set_mode(int(payload), "mqtt")
+    except ValueError:
+        logger.error(f"Invalid mode payload on {MODE_TOPIC}: {payload}")
+
+def handle_mode_push(message):
+    mode_id = (message.get("data") or {}).get("mode_ID")
+    if mode_id is not None:
+        set_mode(mode_id, "push")
+
+def _poll_loop():
+    while not _stop_event.wait(MODE_POLL_INTERVAL):
+        refresh_mode()
+
+def start():
+    global _poll_thread
+    ws_client.add_listener(MODE_CHANGED_ACTION, handle_mode_push)
+    ws_client.on_recovery(refresh_mode)
+    refresh_mode()
+    if MODE_POLL_INTERVAL > 0 and _poll_thread is None:
+        _stop_event.clear()
+        _poll_thread = threading.Thread(target=_poll_loop, daemon=True)
+        _poll_thread.start()
+
+def stop():
+    global _poll_thread
+    _stop_event.set()
+    _poll_thread = None
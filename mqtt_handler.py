@@ -1,283 +1,282 @@
 import paho.mqtt.client as mqtt
 import logging
-import time
-import threading
 import websocket
 import json
+import ws_client
+import note_cache
+import mode_cache
+import led_config
+import config_snapshot
+import signal_filter
+import metrics
+import scheduler
+from liveness import LIVENESS_TICK
+from sensor_registry import registry, ALIVE_TIMEOUT, IDLE_TIMEOUT
+from status_aggregator import status
 from sensor_data import fetch_and_play_note_details
-from config import (MQTT_BROKER, MQTT_PORT, MQTT_TOPICS, MQTT_MUTE_TOPIC, CONTROL_TOPIC, 
-                    MOTION_CONTROL_TOPIC, CONFIG_RANGE_TOPIC, CONFIG_TOPICS, WS_SERVER_URL)
-from utils import retry_request, get_current_mode
+from dispatcher import SensorDispatcher
+from topic_router import TopicRouter, DISTANCE_TOPIC, SENSOR_ALIVE_TOPIC, LED_STRIP_ALIVE_TOPIC
+from config import MQTT_BROKER, MQTT_PORT, MQTT_MUTE_TOPIC, CONTROL_TOPIC, MOTION_CONTROL_TOPIC
 
 # Configure logging
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
 
 # Mute state
 is_muted = False
-NUM_LEDS = 31
+NUM_LEDS = led_config.NUM_LEDS
 
 # Timeout period for ultrasonic sensors to sleep (in seconds)
-TIMEOUT_PERIOD = 300  # 5 minutes
-ALIVE_CHECK_PERIOD = 60  # Period to check for alive messages (in seconds)
+TIMEOUT_PERIOD = IDLE_TIMEOUT  # 5 minutes
+ALIVE_CHECK_PERIOD = ALIVE_TIMEOUT  # Seconds without an alive message before a device is marked inactive
+# Both checks only collect the deadlines that have passed, so they run every tick
+INACTIVITY_CHECK_PERIOD = LIVENESS_TICK
 
-# Dictionary to track the last activity time for each ultrasonic sensor
-last_activity = {sensor_id: time.time() for sensor_id in range(1, 5)}
+mqtt_client = None
+subscriptions = None  # topics replacing router.subscriptions, set when this process serves one shard
 
-# Dictionary to track the last activity time for each LED strip
-led_strip_last_activity = {f"ledstrip{i}": time.time() for i in range(1, 3)}  # Update based on actual LED strips
+# Nothing but routing runs on the paho network thread: readings, commands and housekeeping
+# go to their own lanes, and readings always get a worker first
+lanes = scheduler.get_lanes()  # its gauges are collected by the runtime that uses it
 
-def update_sensor_alive(sensors_on):
-    payload = {
-        "sensors_on": sensors_on
-    }
-    logger.debug(f"Updating sensor alive status with payload: {payload}")
-    try:
-        ws = websocket.WebSocket()
-        ws.connect(WS_SERVER_URL)
-        ws_payload = {
-            "action": "updateSensorAlive",
-            "payload": payload
-        }
-        ws.send(json.dumps(ws_payload))
-        response = ws.recv()
-        response_data = json.loads(response)
-        logger.debug(f"Received response for updateSensorAlive: {response_data}")
-        if response_data.get("action") == "update_sensor_status" and "error" not in response_data:
-            logger.info(f"Sensor alive status updated successfully: {payload}")
-        else:
-            logger.error(f"Failed to update sensor alive status: {response_data.get('error')}")
-        ws.close()
-    except websocket.WebSocketException as e:
-        logger.error(f"WebSocket error: {e}")
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e} - Response content: {response}")
-    except Exception as e:
-        logger.error(f"Failed to send data to server: {e}")
+# Distance readings are handled in the realtime lane, one ordered queue per sensor
+dispatcher = SensorDispatcher(fetch_and_play_note_details, executor=lanes.executor(scheduler.REALTIME))
+
+# Per-device activity and recent readings live in sensor_registry.registry
+
+# Hot-path timings and counts; logging on the message path is %-style so it is free when disabled
+INGEST_TIME = metrics.stage("ingest")
+RANGE_CLASSIFICATION_TIME = metrics.stage("range_classification")
+MESSAGES = metrics.counter("mqtt_messages_total", "MQTT messages received")
+UNROUTED_MESSAGES = metrics.counter("mqtt_unrouted_messages_total", "MQTT messages with no matching route")
+READINGS = metrics.counter("readings_total", "Distance readings received")
+READINGS_FILTERED = metrics.counter("readings_filtered_total", "Readings dropped by the signal filter")
+
+def dispatcher_gauges():
+    gauges = [("dispatcher_" + name, {}, value) for name, value in dispatcher.stats.items()]
+    gauges += [("dispatcher_queue_depth", {"sensor": sensor_id}, depth) for sensor_id, depth in dispatcher.queue_depths().items()]
+    return gauges
+
+metrics.add_collector(dispatcher_gauges)
 
 def update_sensor_status(sensors_on):
     payload = {
         "sensors_on": sensors_on
     }
     try:
-        ws = websocket.WebSocket()
-        ws.connect(WS_SERVER_URL)
         ws_payload = {
             "action": "updateSensorStatus",
             "payload": payload
         }
-        ws.send(json.dumps(ws_payload))
-        response = ws.recv()
-        response_data = json.loads(response)
+        response_data = ws_client.request(ws_payload)
         logger.debug(f"Received response for updateSensorAlive: {response_data}")
         if response_data.get("action") == "update_sensor_status" and "error" not in response_data:
             logger.info(f"Sensor status updated successfully: {payload}")
         else:
             logger.error(f"Failed to update sensor status: {response_data.get('error')}")
-        ws.close()
     except websocket.WebSocketException as e:
         logger.error(f"WebSocket error: {e}")
     except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e} - Response content: {response}")
+        logger.error(f"JSON decode error: {e}")
     except Exception as e:
         logger.error(f"Failed to send data to server: {e}")
 
-def update_led_strip_status(led_strip_name, alive=None):
-    payload = {
-        "led_strip_name": led_strip_name,
-        "alive": alive,
-        "active": alive
-    }
-    try:
-        ws = websocket.WebSocket()
-        ws.connect(WS_SERVER_URL)
-        ws_payload = {
-            "action": "updateLedStripStatus",
-            "payload": payload
-        }
-        ws.send(json.dumps(ws_payload))
-        response = ws.recv()
-        response_data = json.loads(response)
-        logger.debug(f"Received response for updateLedStripStatus: {response_data}")
-        if response_data.get("action") == "updateLedStripStatus" and "error" not in response_data:
-            logger.info(f"LED strip status updated successfully for {led_strip_name}: {payload}")
-            # If the LED strip is alive, send configuration messages
-            if alive:
-                send_config_messages(ws, led_strip_name, mqtt_client)
-        else:
-            error_msg = response_data.get('error', 'Unknown error')
-            logger.error(f"Failed to update LED strip status for {led_strip_name}: {error_msg}")
-        ws.close()
-    except websocket.WebSocketException as e:
-        logger.error(f"WebSocket error: {e}")
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e} - Response content: {response}")
-    except Exception as e:
-        logger.error(f"Failed to send data to server: {e}")
+def fetch_config_payloads(led_strip_name):
+    # Asks the server for the range limits and the strip's colours and builds the config messages
+    limits = colors = None
+    response_data = ws_client.request({"action": "getRangeLimits"})
+    if response_data.get("action") == "getRangeLimits" and "error" not in response_data:
+        limits = (response_data["data"]["closeUpperLimit"], response_data["data"]["midUpperLimit"])
+        logger.info(f"Received range limits: close={limits[0]}, mid={limits[1]}")
+    else:
+        logger.error(f"Failed to fetch range limits: {response_data.get('error')}")
 
-def send_config_messages(ws, led_strip_name, mqtt_client):
-    try:
-        # Request range limits
-        ws_payload = {
-            "action": "getRangeLimits"
+    # Request LED color configuration
+    ws_payload = {
+        "action": "determineLEDColor",
+        "payload": {
+            "sensorName": led_strip_name
         }
-        ws.send(json.dumps(ws_payload))
-        response = ws.recv()
-        response_data = json.loads(response)
-        if response_data.get("action") == "getRangeLimits" and "error" not in response_data:
-            closeUpperLimit = response_data["data"]["closeUpperLimit"]
-            midUpperLimit = response_data["data"]["midUpperLimit"]
-            logger.info(f"Received range limits: close={closeUpperLimit}, mid={midUpperLimit}")
-            # Send range configuration MQTT message
-            range_message = f"{closeUpperLimit},{midUpperLimit}"
-            mqtt_client.publish(CONFIG_RANGE_TOPIC, range_message)
-        else:
-            logger.error(f"Failed to fetch range limits: {response_data.get('error')}")
+    }
+    response_data = ws_client.request(ws_payload)
+    if response_data.get("action") == "determineLEDColor" and "error" not in response_data:
+        colors = response_data["data"]
+        led_config.update_strip_colors(led_strip_name, colors)
+        logger.info(f"Received LED color configuration for {led_strip_name}: {led_config.strip_colors[led_strip_name]}")
+    else:
+        logger.error(f"Failed to fetch LED color configuration: {response_data.get('error')}")
+    return led_config.build_config_payloads(led_strip_name, limits, colors)
 
-        # Request LED color configuration
-        ws_payload = {
-            "action": "determineLEDColor",
-            "payload": {
-                "sensorName": led_strip_name
-            }
-        }
-        ws.send(json.dumps(ws_payload))
-        response = ws.recv()
-        response_data = json.loads(response)
-        if response_data.get("action") == "determineLEDColor" and "error" not in response_data:
-            colors = response_data["data"]
-            for color in colors:
-                red = color["red"]
-                green = color["green"]
-                blue = color["blue"]
-                range_ID = color["range_ID"]
-                range_name = ""
-                if range_ID == 1:
-                    range_name = "close"
-                elif range_ID == 2:
-                    range_name = "mid"
-                elif range_ID == 3:
-                    range_name = "far"
-                logger.info(f"Received LED color configuration: range_name={range_name}, red={red}, green={green}, blue={blue}")
-                # Send LED color configuration MQTT message
-                led_strip_index = int(led_strip_name[-1]) - 1  # Assumes led_strip_name ends with a number
-                color_message = f"{range_name}&{red},{green},{blue}"
-                mqtt_client.publish(CONFIG_TOPICS[led_strip_index], color_message)
-        else:
-            logger.error(f"Failed to fetch LED color configuration: {response_data.get('error')}")
+def send_config_messages(led_strip_name, mqtt_client, force=True):
+    # Publishes the strip's range and colour config; with force=False only when it differs
+    # from what the strip was last sent. The payloads are cached (see led_config.LED_CONFIG_TTL),
+    # so pushing on every heartbeat costs no server round trips.
+    try:
+        messages = led_config.cached_config_payloads(led_strip_name)
+        if messages is None:
+            messages = fetch_config_payloads(led_strip_name)
+            if messages is None:
+                return
+        if not led_config.config_changed(led_strip_name, messages) and not force:
+            logger.debug("Config for %s unchanged, not republishing", led_strip_name)
+            return
+        led_config.publish_config(mqtt_client, messages)
     except websocket.WebSocketException as e:
         logger.error(f"WebSocket error: {e}")
     except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e} - Response content: {response}")
+        logger.error(f"JSON decode error: {e}")
     except Exception as e:
         logger.error(f"Failed to send config messages: {e}")
 
+def refresh_strip_config(snapshot=None, previous=None):
+    # Config listener: strips that are up get the new config only if it differs
+    if mqtt_client is None:
+        return
+    for led_strip_name in status.alive_led_strips():
+        lanes.submit(scheduler.HOUSEKEEPING, send_config_messages, led_strip_name, mqtt_client, False)
+
+def handle_mute(client, payload):
+    global is_muted
+    is_muted = payload.lower() == 'mute'
+    logger.info(f"Mute state changed: {'Muted' if is_muted else 'Unmuted'}")
+
+def handle_note_invalidate(client, payload):
+    note_cache.invalidate()
+
+def handle_led_config_invalidate(client, payload):
+    # Strips that are up get the server's current limits and colours if they changed
+    led_config.invalidate()
+    refresh_strip_config()
+
+def handle_mode(client, payload):
+    mode_cache.handle_mode_message(payload)
+
+def handle_config_reload(client, payload):
+    lanes.submit(scheduler.HOUSEKEEPING, config_snapshot.reload)
+
+def handle_distance(client, payload, sensor_id):
+    distance = float(payload)
+    if distance == 0:
+        return  # Ignore erroneous reading of 0
+    READINGS.inc()
+    # Smoothing and hysteresis drop readings that would not change the outcome
+    sensor_filter = signal_filter.get_filter(sensor_id)
+    with RANGE_CLASSIFICATION_TIME.time():
+        filtered = sensor_filter.update(distance, config_snapshot.current().range_index)
+    registry.record_reading(sensor_id, distance, sensor_filter.range_id)  # Also updates the last activity time
+    if filtered is None:
+        READINGS_FILTERED.inc()
+        return
+    distance, range_id = filtered
+    dispatcher.submit(sensor_id, distance, is_muted, range_id)
+
+def handle_sensor_alive(client, payload, sensor_id):
+    active = payload.lower() == "alive"
+    logger.debug("Alive message for sensor_id=%s, active=%s", sensor_id, active)
+    registry.touch_sensor(sensor_id)  # Update the last alive time
+    status.sensor_seen(sensor_id, active)  # Sent to the server with the next status flush if it changed
+
+def handle_led_strip_alive(client, payload, led_strip_name):
+    alive = payload.lower() == "alive"
+    logger.debug("Alive message for LED strip: led_strip_name=%s, alive=%s", led_strip_name, alive)
+    registry.touch_led_strip(led_strip_name)  # Update the last alive time
+    came_up = status.led_strip_seen(led_strip_name, alive)
+    if alive:
+        # A strip that reboots between two heartbeats loses its config without ever going quiet,
+        # so every heartbeat pushes it again, from the cached payloads; retained bundles reach a
+        # rebooted strip from the broker and are only published when they change. Pushing is
+        # housekeeping, so a burst of heartbeats never delays a note.
+        force = came_up or not led_config.LED_CONFIG_BUNDLE
+        lanes.submit(scheduler.HOUSEKEEPING, send_config_messages, led_strip_name, client, force)
+
+def handle_control(client, payload):
+    sensors_on = payload.lower() == "wake"
+    logger.info(f"Setting all sensors to {'awake' if sensors_on else 'sleep'}")
+    client.publish(MOTION_CONTROL_TOPIC, "wake" if sensors_on else "sleep")
+    lanes.submit(scheduler.CONTROL, update_sensor_status, sensors_on)
+
+# Device topics are matched by pattern, so new sensors and strips need no code or config changes
+router = TopicRouter()
+router.add(MQTT_MUTE_TOPIC, handle_mute)
+router.add(note_cache.NOTE_CACHE_INVALIDATE_TOPIC, handle_note_invalidate)
+router.add(led_config.LED_CONFIG_INVALIDATE_TOPIC, handle_led_config_invalidate)
+router.add(mode_cache.MODE_TOPIC, handle_mode)
+router.add(config_snapshot.CONFIG_RELOAD_TOPIC, handle_config_reload)
+router.add(CONTROL_TOPIC, handle_control)
+router.add(DISTANCE_TOPIC, handle_distance)
+router.add(SENSOR_ALIVE_TOPIC, handle_sensor_alive)
+router.add(LED_STRIP_ALIVE_TOPIC, handle_led_strip_alive)
+
+def use_subscriptions(topics):
+    # Takes effect on the next (re)connect
+    global subscriptions
+    subscriptions = list(topics)
+
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         logger.info("Connected to MQTT broker successfully")
-        for topic in MQTT_TOPICS:
+        for topic in subscriptions or router.subscriptions:
             client.subscribe(topic)
             logger.info(f"Subscribed to topic: {topic}")
-        client.subscribe(MQTT_MUTE_TOPIC)
-        client.subscribe(CONTROL_TOPIC)
-        logger.info(f"Subscribed to mute topic: {MQTT_MUTE_TOPIC}")
-        logger.info(f"Subscribed to control topic: {CONTROL_TOPIC}")
     else:
         logger.error(f"Failed to connect to MQTT broker, return code {rc}")
 
 def on_message(client, userdata, message):
-    global is_muted
+    with INGEST_TIME.time():
+        handle_message(client, message)
+
+def handle_message(client, message):
     topic = message.topic
-    logger.debug(f"Received message on topic: {topic} with payload: {message.payload}")
+    MESSAGES.inc()
+    logger.debug("Received message on topic: %s with payload: %s", topic, message.payload)
 
-    if topic == MQTT_MUTE_TOPIC:
-        is_muted = message.payload.decode().lower() == 'mute'
-        logger.info(f"Mute state changed: {'Muted' if is_muted else 'Unmuted'}")
+    route = router.route(topic)
+    if route is None:
+        UNROUTED_MESSAGES.inc()
+        logger.debug("No handler for topic: %s", topic)
         return
-
+    handler, params = route
     try:
         payload = message.payload.decode()
-        logger.debug(f"Decoded payload: {payload}")
-        
-        if topic.startswith("ultrasonic/distance_sensor"):
-            distance = float(payload)
-            if distance == 0:
-                return  # Ignore erroneous reading of 0
-            sensor_id = int(topic.split("_")[-1][-1])  # Ensure the extraction is correct
-            fetch_and_play_note_details(sensor_id, distance, is_muted)
-            last_activity[sensor_id] = time.time()  # Update the last activity time
-            
-        elif topic.startswith("alive/distance_sensor"):
-            sensor_id = int(topic.split("_")[-1][-1])
-            active = payload.lower() == "alive"
-            logger.debug(f"Alive message for sensor_id={sensor_id}, active={active}")
-            last_activity[sensor_id] = time.time()  # Update the last alive time
-            update_sensor_status(active)
-            
-        elif topic.startswith("alive/ledstrip"):
-            led_strip_name = topic.split("/")[-1]
-            alive = payload.lower() == "alive"
-            logger.debug(f"Alive message for LED strip: led_strip_name={led_strip_name}, alive={alive}")
-            led_strip_last_activity[led_strip_name] = time.time()  # Update the last alive time
-            update_led_strip_status(led_strip_name, alive=alive)
-            
-        elif topic == CONTROL_TOPIC:
-            sensors_on = payload.lower() == "wake"
-            logger.info(f"Setting all sensors to {'awake' if sensors_on else 'sleep'}")
-            update_sensor_status(sensors_on)
-            client.publish(MOTION_CONTROL_TOPIC, "wake" if sensors_on else "sleep")
-                    
+        handler(client, payload, **params)
     except ValueError as e:
         logger.error(f"Failed to decode message payload: {e}")
     except Exception as e:
         logger.error(f"Unexpected error in on_message: {e}")
 
 def check_for_inactivity(client):
-    current_time = time.time()
-    all_inactive = True  # Flag to check if all sensors are inactive
-
-    for sensor_id, last_time in last_activity.items():
-        if current_time - last_time < TIMEOUT_PERIOD:
-            all_inactive = False  # If any sensor is active, set flag to False
-            break  # No need to check further, as we found an active sensor
-
-    if all_inactive:
+    # Fires once when the last sensor activity is TIMEOUT_PERIOD old; activity re-arms it
+    if registry.idle.expire():
         logger.info(f"All sensors have been inactive for {TIMEOUT_PERIOD} seconds. Sending sleep command.")
         client.publish(CONTROL_TOPIC, "sleep")
         client.publish(MOTION_CONTROL_TOPIC, "motion_wake")
 
 def check_for_alive_messages():
-    while True:
-        current_time = time.time()
-        for sensor_id, last_time in last_activity.items():
-            if current_time - last_time >= ALIVE_CHECK_PERIOD:
-                logger.info(f"Sensor {sensor_id} has not sent an alive message for {ALIVE_CHECK_PERIOD} seconds. Marking as inactive.")
-                update_sensor_alive(False)
-        for led_strip_name, last_time in led_strip_last_activity.items():
-            if current_time - last_time >= ALIVE_CHECK_PERIOD:
-                logger.info(f"LED strip {led_strip_name} has not sent an alive message for {ALIVE_CHECK_PERIOD} seconds. Marking as inactive.")
-                update_led_strip_status(led_strip_name, alive=False)
-        time.sleep(ALIVE_CHECK_PERIOD)
+    # Each device is reported once when it goes quiet, within a tick of its deadline
+    for sensor_id in registry.sensor_liveness.expire():
+        if status.sensor_lost(sensor_id):
+            logger.info(f"Sensor {sensor_id} has not sent an alive message for {ALIVE_CHECK_PERIOD} seconds. Marking as inactive.")
+    for led_strip_name in registry.led_strip_liveness.expire():
+        if status.led_strip_lost(led_strip_name):
+            logger.info(f"LED strip {led_strip_name} has not sent an alive message for {ALIVE_CHECK_PERIOD} seconds. Marking as inactive.")
+
+def liveness_gauges():
+    return (registry.sensor_liveness.gauges("liveness_sensors") + registry.led_strip_liveness.gauges("liveness_led_strips")
+            + registry.idle.gauges("liveness_idle"))
+
+metrics.add_collector(liveness_gauges)
+
+def flush_status():
+    # Changes stay pending while the server is unreachable and go out together afterwards
+    if ws_client.server_available():
+        status.flush(ws_client.request)
 
 def setup_mqtt_client():
+    global mqtt_client
     client = mqtt.Client(client_id="", clean_session=True, userdata=None, protocol=mqtt.MQTTv311)
     client.on_connect = on_connect
     client.on_message = on_message
     client.connect(MQTT_BROKER, MQTT_PORT)
+    mqtt_client = client
+    led_config.set_publisher(client)
+    ws_client.add_listener(led_config.LED_CONFIG_INVALIDATE_ACTION, lambda message: handle_led_config_invalidate(client, None))
     return client
-
-# Initialize and start the MQTT client
-mqtt_client = setup_mqtt_client()
-
-# Start a background thread to check for inactivity
-inactivity_thread = threading.Thread(target=check_for_inactivity, args=(mqtt_client,))
-inactivity_thread.daemon = True
-inactivity_thread.start()
-
-# Start a background thread to check for alive messages
-alive_thread = threading.Thread(target=check_for_alive_messages)
-alive_thread.daemon = True
-alive_thread.start()
-
-# Start the MQTT client loop
-mqtt_client.loop_forever()
@@ -0,0 +1,172 @@
+import logging
+import os
+import threading
+import time
+import ws_client
+import config_snapshot
+import metrics
+import offline_cache
+import scheduler
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Seconds before the mapping is refreshed in the background
+NOTE_CACHE_TTL = float(os.getenv('NOTE_CACHE_TTL', '600'))
+# MQTT topic and server-push action that force a refresh of the mapping
+NOTE_CACHE_INVALIDATE_TOPIC = os.getenv('NOTE_CACHE_INVALIDATE_TOPIC', 'config/note_mapping')
+NOTE_CACHE_INVALIDATE_ACTION = "noteMappingChanged"
+
+note_map = {}  # (sensor_ID, range_ID) -> note_ID, None when the server has no note for that pair
+loaded_at = 0
+stats = {"hits": 0, "misses": 0, "refreshes": 0}
+
+_lock = threading.Lock()
+_refreshing = False
+_listener_registered = False
+_incomplete = False  # Some entries came from the offline cache because the server did not answer
+_refresher = None  # starts a refresh instead of the housekeeping lane; set by the asyncio runtime
+
+def note_request(sensor_id, range_id):
+    return {
+        "action": "getNoteDetails",
+        "payload": {
+            "sensor_ID": sensor_id,
+            "range_ID": range_id
+        }
+    }
+
+def parse_note(response_data):
+    logger.debug("Received response for getNoteDetails: %s", response_data)
+    if response_data.get("action") == "getNoteDetails" and "data" in response_data:
+        return response_data["data"].get("note_ID")
+    return None
+
+def fetch_note_id(sensor_id, range_id):
+    return parse_note(ws_client.request(note_request(sensor_id, range_id)))
+
+def load_cached_map():
+    cached = offline_cache.load("note_map") or []
+    return {(sensor_id, range_id): note_id for sensor_id, range_id, note_id in cached}
+
+def note_keys():
+    return list(dict.fromkeys((position["sensor_ID"], position["range_ID"]) for position in config_snapshot.current().positions))
+
+def install_map(results):
+    # results: (sensor_ID, range_ID) -> note_ID, or the exception fetching it raised.
+    # Entries the server cannot be asked for keep their last-known value.
+    global note_map, loaded_at, _incomplete
+    fallback = dict(note_map) if note_map else load_cached_map()
+    new_map = {}
+    incomplete = False
+    for key, result in results.items():
+        if not isinstance(result, BaseException):
+            new_map[key] = result
+            continue
+        incomplete = True
+        if key in fallback:
+            new_map[key] = fallback[key]
+        else:
+            logger.error(f"Failed to fetch note for sensor {key[0]} at range {key[1]}: {result}")
+
+    with _lock:
+        note_map = new_map
+        loaded_at = time.time()
+        stats["refreshes"] += 1
+        _incomplete = incomplete
+    offline_cache.save("note_map", [[sensor_id, range_id, note_id] for (sensor_id, range_id), note_id in new_map.items()])
+    logger.info(f"Note mapping loaded with {len(new_map)} entries, cache stats: {get_stats()}")
+
+def load_note_map():
+    global _listener_registered
+    if not _listener_registered:
+        ws_client.add_listener(NOTE_CACHE_INVALIDATE_ACTION, lambda message: invalidate())
+        _listener_registered = True
+
+    results = {}
+    for key in note_keys():
+        try:
+            results[key] = fetch_note_id(*key)
+        except Exception as e:
+            results[key] = e
+    install_map(results)
+
+def set_refresher(func):
+    # func() starts a refresh without blocking its caller and calls refresh_finished() when done
+    global _refresher
+    _refresher = func
+
+def refresh_finished():
+    global _refreshing
+    _refreshing = False
+
+def _refresh():
+    try:
+        load_note_map()
+    except Exception as e:
+        logger.error(f"Failed to refresh note mapping: {e}")
+    finally:
+        refresh_finished()
+
+def refresh_in_background():
+    global _refreshing
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+    if _refresher is not None:
+        _refresher()
+    elif not scheduler.get_lanes().submit(scheduler.HOUSEKEEPING, _refresh):
+        refresh_finished()  # Lane full; the next lookup past the TTL tries again
+
+def invalidate():
+    global loaded_at
+    logger.info("Note mapping invalidated, refreshing")
+    loaded_at = 0
+    refresh_in_background()
+
+def expired():
+    return time.time() - loaded_at > NOTE_CACHE_TTL
+
+def get_note_id(sensor_id, range_id):
+    # Stale entries keep being served while the refresh runs off the hot path
+    if expired():
+        refresh_in_background()
+
+    key = (sensor_id, range_id)
+    current_map = note_map
+    if key in current_map:
+        stats["hits"] += 1
+        return current_map[key]
+
+    stats["misses"] += 1
+    try:
+        note_id = fetch_note_id(sensor_id, range_id)
+    except Exception as e:
+        # Not cached, so the pair is asked for again once the server is back
+        logger.warning("No note for sensor %s at range %s while the server is unavailable: %s", sensor_id, range_id, e)
+        return None
+    with _lock:
+        note_map[key] = note_id
+    return note_id
+
+def on_config_change(snapshot, previous):
+    # The initial snapshot is followed by an explicit load_note_map at startup
+    if previous.version and snapshot.positions != previous.positions:
+        invalidate()
+
+config_snapshot.add_listener(on_config_change)
+
+def on_server_recovery():
+    if _incomplete:
+        invalidate()
+
+ws_client.on_recovery(on_server_recovery)
+
+def get_stats():
+    return dict(stats, entries=len(note_map), age=round(time.time() - loaded_at, 1) if loaded_at else None)
+
+def cache_gauges():
+    return [("note_cache_" + name, {}, value) for name, value in get_stats().items() if value is not None]
+
+metrics.add_collector(cache_gauges)
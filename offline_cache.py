@@ -0,0 +1,40 @@
+import json
+import logging
+import os
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Last-known server state (config, note mapping, LED colours, mode) so the stairs can start
+# and keep playing while the server is unreachable; set to an empty string to disable
+OFFLINE_CACHE_DIR = os.getenv('OFFLINE_CACHE_DIR', os.path.expanduser('~/.cache/musicalstairs/state'))
+
+def _path(name):
+    return os.path.join(OFFLINE_CACHE_DIR, f"{name}.json")
+
+def save(name, data):
+    if not OFFLINE_CACHE_DIR:
+        return
+    path = _path(name)
+    try:
+        os.makedirs(OFFLINE_CACHE_DIR, exist_ok=True)
+        # Written aside and renamed so a crash never leaves a truncated file behind; the temporary
+        # name is per process since shard workers share the cache directory
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as cache_file:
+            json.dump(data, cache_file)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.error(f"Failed to save {name} to the offline cache: {e}")
+
+def load(name):
+    if not OFFLINE_CACHE_DIR:
+        return None
+    try:
+        with open(_path(name)) as cache_file:
+            return json.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to read {name} from the offline cache: {e}")
+        return None
@@ -0,0 +1,33 @@
+import bisect
+
+class RangeIndex:
+    def __init__(self, ranges):
+        ordered = sorted(ranges, key=lambda range_data: float(range_data['lower_limit']))
+        for range_data in ordered:
+            if float(range_data['lower_limit']) >= float(range_data['upper_limit']):
+                raise ValueError(f"Range {range_data['range_ID']} has lower limit >= upper limit")
+        # Ranges must tile the distance axis: each upper limit is the next range's lower limit
+        for current, following in zip(ordered, ordered[1:]):
+            upper = float(current['upper_limit'])
+            lower = float(following['lower_limit'])
+            if upper > lower:
+                raise ValueError(f"Ranges {current['range_ID']} and {following['range_ID']} overlap between {lower} and {upper}")
+            if upper < lower:
+                raise ValueError(f"Gap between ranges {current['range_ID']} and {following['range_ID']} from {upper} to {lower}")
+
+        self.lower_limits = [float(range_data['lower_limit']) for range_data in ordered]
+        self.range_ids = [range_data['range_ID'] for range_data in ordered]
+        self.upper_limit = float(ordered[-1]['upper_limit']) if ordered else None
+        self.limits = {range_data['range_ID']: (float(range_data['lower_limit']), float(range_data['upper_limit']))
+                       for range_data in ordered}
+
+    def lookup(self, distance):
+        if not self.range_ids or distance >= self.upper_limit:
+            return None
+        i = bisect.bisect_right(self.lower_limits, distance) - 1
+        if i < 0:
+            return None
+        return self.range_ids[i]
+
+    def __len__(self):
+        return len(self.range_ids)
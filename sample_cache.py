@@ -0,0 +1,83 @@
+import collections
+import hashlib
+import logging
+import os
+import threading
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Directory for pre-decoded PCM buffers; set to an empty string to disable the disk cache
+SOUND_CACHE_DIR = os.getenv('SOUND_CACHE_DIR', os.path.expanduser('~/.cache/musicalstairs/pcm'))
+# Upper bound on decoded audio kept in memory by the lazy LRU
+SOUND_LRU_BYTES = int(os.getenv('SOUND_LRU_BYTES', str(64 * 1024 * 1024)))
+
+def _cache_path(location):
+    # Keyed by file content and mixer format, so an edited file or a different mixer
+    # setup never reuses a stale buffer
+    import pygame
+    digest = hashlib.sha256()
+    with open(location, "rb") as sample_file:
+        for chunk in iter(lambda: sample_file.read(1 << 20), b""):
+            digest.update(chunk)
+    frequency, size, channels = pygame.mixer.get_init()
+    return os.path.join(SOUND_CACHE_DIR, f"{digest.hexdigest()}_{frequency}_{size}_{channels}.pcm")
+
+def decode(location):
+    # pygame is imported on first decode, once the mixer is being opened anyway
+    import pygame
+    if not SOUND_CACHE_DIR:
+        return pygame.mixer.Sound(location)
+
+    path = _cache_path(location)
+    try:
+        with open(path, "rb") as cached:
+            return pygame.mixer.Sound(buffer=cached.read())
+    except FileNotFoundError:
+        pass
+
+    decoded = pygame.mixer.Sound(location)
+    try:
+        os.makedirs(SOUND_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as cached:
+            cached.write(decoded.get_raw())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not write PCM cache for {location}: {e}")
+    return decoded
+
+def _decoded_size(decoded):
+    import pygame
+    frequency, size, channels = pygame.mixer.get_init()
+    return int(decoded.get_length() * frequency * channels * abs(size) // 8)
+
+class SoundLRU:
+    def __init__(self, max_bytes=SOUND_LRU_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()  # note_ID -> (Sound, bytes)
+        self._lock = threading.Lock()
+
+    def get(self, note_id, location):
+        with self._lock:
+            entry = self._entries.get(note_id)
+            if entry is not None:
+                self._entries.move_to_end(note_id)
+                return entry[0]
+
+        decoded = decode(location)
+        nbytes = _decoded_size(decoded)
+        with self._lock:
+            if note_id not in self._entries:
+                self._entries[note_id] = (decoded, nbytes)
+                self.size += nbytes
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.size -= evicted_bytes
+            return self._entries.get(note_id, (decoded,))[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
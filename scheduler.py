@@ -0,0 +1,257 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import metrics
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class PeriodicTask:
+    def __init__(self, interval, func, *args, name=None):
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.name = name or func.__name__
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+
+    def start(self):
+        logger.debug(f"Scheduling {self.name} every {self.interval}s")
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.func(*self.args)
+            except Exception as e:
+                logger.error(f"Scheduled task {self.name} failed: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+
+class TimerHandle:
+    __slots__ = ("cancelled",)
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerQueue:
+    # One thread runs every delayed callback in deadline order, so scheduling never spawns a thread.
+    # Callbacks share that thread and must not block; slow work is handed to a lane.
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="timers", daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle()
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), handle, func, args))
+            self._cond.notify()
+        return handle
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, handle, func, args = heapq.heappop(self._heap)
+            if handle.cancelled:
+                continue
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"Timer callback {getattr(func, '__name__', func)} failed: {e}")
+
+_timers = None
+_timers_lock = threading.Lock()
+
+def call_later(delay, func, *args):
+    global _timers
+    if _timers is None:
+        with _timers_lock:
+            if _timers is None:
+                _timers = TimerQueue()
+    return _timers.call_later(delay, func, *args)
+
+# Work lanes, highest priority first. A free worker always takes the oldest job of the highest
+# lane that has work and is under its concurrency limit, so a queued reading never waits behind
+# heartbeat config pushes, and housekeeping can never hold more than its limit of workers.
+REALTIME = "realtime"  # distance readings
+CONTROL = "control"  # wake/sleep and other operator commands
+HOUSEKEEPING = "housekeeping"  # strip config pushes, status flushes, config reloads
+LANES = (REALTIME, CONTROL, HOUSEKEEPING)
+
+LANE_WORKERS = int(os.getenv('LANE_WORKERS', '6'))
+LANE_LIMITS = {
+    REALTIME: LANE_WORKERS,
+    CONTROL: int(os.getenv('LANE_CONTROL_LIMIT', '1')),
+    HOUSEKEEPING: int(os.getenv('LANE_HOUSEKEEPING_LIMIT', '1')),
+}
+# Jobs queued per lane before submissions are refused. The realtime lane is not bounded here:
+# the sensor dispatcher already keeps at most one job per sensor in it.
+LANE_QUEUE_DEPTH = int(os.getenv('LANE_QUEUE_DEPTH', '1000'))
+
+class Lane:
+    def __init__(self, name, limit, queue_depth):
+        self.name = name
+        self.limit = limit
+        self.queue_depth = queue_depth
+        self.pending = collections.deque()  # (queued_at, func, args)
+        self.running = 0
+        self.stats = {"submitted": 0, "completed": 0, "rejected": 0, "max_depth": 0}
+        self.wait_time = metrics.histogram("lane_wait_seconds", "Time jobs spend queued in each lane", lane=name)
+
+class LaneExecutor:
+    # The submit/shutdown surface of a ThreadPoolExecutor, bound to one lane
+    def __init__(self, scheduler, lane):
+        self.scheduler = scheduler
+        self.lane = lane
+
+    def submit(self, func, *args):
+        return self.scheduler.submit(self.lane, func, *args)
+
+    def shutdown(self, wait=True):
+        pass  # The workers belong to the scheduler
+
+class LaneScheduler:
+    def __init__(self, workers=LANE_WORKERS, limits=LANE_LIMITS, queue_depth=LANE_QUEUE_DEPTH):
+        self.workers = workers
+        self.lanes = {name: Lane(name, limits.get(name, workers), None if name == REALTIME else queue_depth)
+                      for name in LANES}
+        self._order = [self.lanes[name] for name in LANES]
+        self._cond = threading.Condition()
+        self._threads = []  # started with the first job, so creating a scheduler is free
+        self._closed = False
+
+    def executor(self, lane):
+        return LaneExecutor(self, lane)
+
+    def submit(self, lane, func, *args):
+        # False when the lane is full or the scheduler has shut down
+        lane = self.lanes[lane]
+        with self._cond:
+            if self._closed or (lane.queue_depth is not None and len(lane.pending) >= lane.queue_depth):
+                lane.stats["rejected"] += 1
+                logger.warning("Lane %s is full, dropping %s", lane.name, getattr(func, '__name__', func))
+                return False
+            lane.pending.append((time.perf_counter(), func, args))
+            lane.stats["submitted"] += 1
+            lane.stats["max_depth"] = max(lane.stats["max_depth"], len(lane.pending))
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f"lane-worker-{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+        return True
+
+    def _next(self):
+        for lane in self._order:
+            if lane.pending and lane.running < lane.limit:
+                return lane
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                lane = self._next()
+                while lane is None:
+                    if self._closed and not any(lane.pending for lane in self._order):
+                        return
+                    self._cond.wait()
+                    lane = self._next()
+                queued_at, func, args = lane.pending.popleft()
+                lane.running += 1
+            lane.wait_time.observe(time.perf_counter() - queued_at)
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"Job {getattr(func, '__name__', func)} in lane {lane.name} failed: {e}")
+            with self._cond:
+                lane.running -= 1
+                lane.stats["completed"] += 1
+                # A lane that was at its limit may have work another worker can now take
+                self._cond.notify()
+
+    def gauges(self):
+        gauges = []
+        for lane in self._order:
+            labels = {"lane": lane.name}
+            gauges.append(("lane_queue_depth", labels, len(lane.pending)))
+            gauges.append(("lane_running", labels, lane.running))
+            gauges += [("lane_" + name, labels, value) for name, value in lane.stats.items()]
+        return gauges
+
+    def shutdown(self, wait=True):
+        # Jobs already queued still run
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for thread in list(self._threads):
+                thread.join()
+
+_lanes = None
+_lanes_lock = threading.Lock()
+
+def get_lanes():
+    # The process-wide lane scheduler, shared by the dispatcher, MQTT handlers and background refreshes
+    global _lanes
+    if _lanes is None:
+        with _lanes_lock:
+            if _lanes is None:
+                _lanes = LaneScheduler()
+    return _lanes
+
+class AsyncLanes:
+    # asyncio counterpart: every message already runs as its own task and readings are never held
+    # back, so here the lanes cap how many control and housekeeping jobs run at once, and with
+    # that how many server connections they can take from the readings
+    def __init__(self, limits=LANE_LIMITS):
+        self.limits = {name: limits.get(name, LANE_WORKERS) for name in LANES if name != REALTIME}
+        self.waiting = dict.fromkeys(self.limits, 0)
+        self.running = dict.fromkeys(self.limits, 0)
+        self.stats = {name: {"submitted": 0, "completed": 0, "max_depth": 0} for name in self.limits}
+        self._semaphores = {}  # created on first use, inside the running loop
+
+    async def run(self, lane, func, *args):
+        semaphore = self._semaphores.get(lane)
+        if semaphore is None:
+            semaphore = self._semaphores[lane] = asyncio.Semaphore(self.limits[lane])
+        stats = self.stats[lane]
+        stats["submitted"] += 1
+        self.waiting[lane] += 1
+        stats["max_depth"] = max(stats["max_depth"], self.waiting[lane])
+        queued_at = time.perf_counter()
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting[lane] -= 1  # also when cancelled while waiting
+        self.running[lane] += 1
+        metrics.histogram("lane_wait_seconds", "Time jobs spend queued in each lane", lane=lane).observe(time.perf_counter() - queued_at)
+        try:
+            return await func(*args)
+        finally:
+            self.running[lane] -= 1
+            stats["completed"] += 1
+            semaphore.release()
+
+    def gauges(self):
+        gauges = []
+        for lane in self.limits:
+            labels = {"lane": lane}
+            gauges.append(("lane_queue_depth", labels, self.waiting[lane]))
+            gauges.append(("lane_running", labels, self.running[lane]))
+            gauges += [("lane_" + name, labels, value) for name, value in self.stats[lane].items()]
+        return gauges
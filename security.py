@@ -0,0 +1,88 @@
+import logging
+import os
+import re
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Seconds allowed between two steps of a sequence unless the sequence sets its own "timeout"
+SECURITY_STEP_TIMEOUT = float(os.getenv('SECURITY_STEP_TIMEOUT', '10'))
+
+STEP_KEY = re.compile(r"step(\d+)_position_ID$")
+
+class _Node:
+    __slots__ = ("children", "completes", "timeout")
+
+    def __init__(self):
+        self.children = {}  # (sensor_ID, range_ID) -> _Node
+        self.completes = []  # IDs of sequences that end at this node
+        self.timeout = 0  # longest step timeout of any sequence passing through
+
+class SecurityAutomaton:
+    # Trie over (sensor_ID, range_ID) steps built once from the sequences and positions
+    def __init__(self, sequences, positions):
+        position_steps = {position["position_ID"]: (position["sensor_ID"], position["range_ID"]) for position in positions}
+        self.root = _Node()
+        self.size = 0
+        for index, sequence in enumerate(sequences):
+            sequence_id = sequence.get("sequence_ID", index)
+            timeout = float(sequence.get("timeout") or SECURITY_STEP_TIMEOUT)
+            step_keys = sorted((int(match.group(1)), key) for key in sequence
+                               for match in [STEP_KEY.match(key)] if match)
+            steps = [sequence[key] for _, key in step_keys if sequence[key] is not None]
+            if not steps:
+                continue
+            if any(position_id not in position_steps for position_id in steps):
+                logger.error(f"Security sequence {sequence_id} references an unknown position, skipping it")
+                continue
+            node = self.root
+            for position_id in steps:
+                node = node.children.setdefault(position_steps[position_id], _Node())
+                node.timeout = max(node.timeout, timeout)
+            node.completes.append(sequence_id)
+            self.size += 1
+
+class SecurityTracker:
+    def __init__(self, automaton):
+        self.automaton = automaton
+        self.last_step = None
+        self._candidates = []  # (node, deadline) for every partially entered sequence
+        self._lock = threading.Lock()
+
+    def set_automaton(self, automaton):
+        # Partial entries refer to nodes of the old automaton, so they are dropped
+        with self._lock:
+            self.automaton = automaton
+            self._candidates = []
+
+    def reset(self):
+        with self._lock:
+            self._candidates = []
+
+    def step(self, sensor_id, range_id, now=None):
+        # Returns None for a repeated step, otherwise (matched, completed_sequence_IDs)
+        current_step = (sensor_id, range_id)
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if current_step == self.last_step:
+                return None
+            self.last_step = current_step
+
+            advanced = []
+            for node, deadline in self._candidates:
+                if deadline >= now:
+                    child = node.children.get(current_step)
+                    if child is not None:
+                        advanced.append((child, now + child.timeout))
+            start = self.automaton.root.children.get(current_step)
+            if start is not None:
+                advanced.append((start, now + start.timeout))
+
+            completed = [sequence_id for node, _ in advanced for sequence_id in node.completes]
+            if completed or not advanced:
+                self._candidates = []
+            else:
+                self._candidates = [(node, deadline) for node, deadline in advanced if node.children]
+            return bool(advanced), completed
@@ -1,112 +1,96 @@
 import logging
 import json
-import time
 import threading
+import time
 import websocket
-from config import WS_SERVER_URL
-from sound import last_played, COOLDOWN_PERIOD, play_sound
-from utils import get_current_mode, fetch_security_sequences, fetch_all_positions
+import ws_client
+import note_cache
+import mode_cache
+import sensor_log
+import led_config
+import scheduler
+import config_snapshot
+import audio_engine
+import metrics
+from security import SecurityTracker
+from sensor_registry import registry
+from sound import COOLDOWN_PERIOD
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-last_step = None
-current_step_index = 0
-security_sequences = fetch_security_sequences()
-positions = fetch_all_positions()
+SECURITY_FEEDBACK_SECONDS = 2
 
-def reset_user_steps():
-    global current_step_index
-    current_step_index = 0
+# Stage timings; logging below is %-style so disabled levels cost no formatting
+PIPELINE_TIME = metrics.stage("pipeline")
+MODE_LOOKUP_TIME = metrics.stage("mode_lookup")
+RANGE_CLASSIFICATION_TIME = metrics.stage("range_classification")
+NOTE_RESOLUTION_TIME = metrics.stage("note_resolution")
+LED_PUBLISH_TIME = metrics.stage("led_publish")
+SECURITY_CHECK_TIME = metrics.stage("security_check")
+NOTES_PLAYED = metrics.counter("notes_played_total", "Notes sent to the audio engine")
+NOTES_SKIPPED = metrics.counter("notes_skipped_total", "Notes skipped for cooldown or mute")
+
+security_tracker = SecurityTracker(config_snapshot.current().security_automaton)
+pending_feedback_off = {}  # sensor_id -> timer handle of the switch-off after the latest feedback
+_feedback_lock = threading.Lock()
 
 def log_sensor_data(sensor_id, distance):
-    try:
-        ws = websocket.WebSocket()
-        ws.connect(WS_SERVER_URL)
-        payload = {
-            "action": "logSensorData",
-            "payload": {
-                "sensor_ID": sensor_id,
-                "distance": distance
-            }
-        }
-        ws.send(json.dumps(payload))
-        response = ws.recv()
-        response_data = json.loads(response)
-        logger.debug(f"Received response for logSensorData: {response_data}")
-        if response_data.get("action") == "logSensorData" and "error" not in response_data:
-            logger.info(f"Sensor data logged successfully for sensor {sensor_id}: {distance}")
-        else:
-            logger.error(f"Failed to log sensor data for sensor {sensor_id}: {response_data.get('error')}")
-        ws.close()
-    except websocket.WebSocketException as e:
-        logger.error(f"WebSocket error: {e}")
-    except Exception as e:
-        logger.error(f"Failed to send data to server: {e}")
+    # Queued for the background batch logger so it never delays LEDs or playback
+    sensor_log.enqueue(sensor_id, distance)
 
 def determine_range_id(distance):
-    from sound import ranges
-    logger.debug(f"Determining range_id for distance: {distance}")
-    for range_data in ranges:
-        logger.debug(f"Checking range: {range_data}")
-        if range_data['lower_limit'] <= distance < range_data['upper_limit']:
-            logger.debug(f"Distance {distance} falls within range: {range_data}")
-            return range_data['range_ID']
-    logger.warning(f"No matching range found for distance: {distance}")
-    return None
+    range_id = config_snapshot.current().range_index.lookup(distance)
+    if range_id is None:
+        logger.warning("No matching range found for distance: %s", distance)
+    return range_id
     
 def send_led_trigger(sensor_id, range_id):
+    # One local publish when the strip's colours are cached, otherwise ask the server
+    if led_config.publish_trigger(sensor_id, range_id):
+        return
+    if not ws_client.server_available():
+        logger.debug("Server unavailable, no LED trigger for sensor %s", sensor_id)
+        return
     try:
-        ws = websocket.WebSocket()
-        ws.connect(WS_SERVER_URL)
         payload = {
             "action": "getLEDTriggerPayload",
             "payload": {
                 "sensor_id": sensor_id,
-                "distance": range_id  # Correcting the payload to send distance
+                "distance": range_id  # The server reads the range ID from this field
             }
         }
-        ws.send(json.dumps(payload))
-        response = ws.recv()
-        response_data = json.loads(response)
-        logger.debug(f"Received response for getLEDTriggerPayload: {response_data}")
+        response_data = ws_client.request(payload)
+        logger.debug("Received response for getLEDTriggerPayload: %s", response_data)
         if response_data.get("action") == "LEDTrigger" and "payload" in response_data:
             led_payload = response_data["payload"]
-            logger.debug(f"LED Trigger Payload: {led_payload}")
+            logger.debug("LED Trigger Payload: %s", led_payload)
 
             # Now send the LED trigger payload
             payload = {
                 "action": "sendLEDTrigger",
                 "payload": led_payload
             }
-            ws.send(json.dumps(payload))
-            response = ws.recv()
-            response_data = json.loads(response)
-            logger.debug(f"Received response for sendLEDTrigger: {response_data}")
+            response_data = ws_client.request(payload)
+            logger.debug("Received response for sendLEDTrigger: %s", response_data)
         else:
-            logger.warning(f"Failed to get LED trigger payload for sensor {sensor_id} at range {range_id}.")
-        ws.close()
+            logger.warning("Failed to get LED trigger payload for sensor %s at range %s.", sensor_id, range_id)
     except websocket.WebSocketException as e:
         logger.error(f"WebSocket error: {e}")
     except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e} - Response content: {response}")
+        logger.error(f"JSON decode error: {e}")
     except Exception as e:
         logger.error(f"Unexpected error in send_led_trigger: {e}")
 
 def send_security_led_trigger(sensor_id, color):
     try:
-        ws = websocket.WebSocket()
-        ws.connect(WS_SERVER_URL)
-        range_str = '0-30'
-        duration = '3000'  # 3 seconds in milliseconds
-        color_code = '0,0,0'
-
-        if color == 'green':
-            color_code = '0,255,0'  # RGB for green
-        elif color == 'red':
-            color_code = '255,0,0'  # RGB for red
-
-        message = f"{range_str}&{color_code}&{duration}"
+        # Frames are prebuilt in led_config; an unknown colour switches the strip off
+        if color not in led_config.SECURITY_MESSAGES:
+            color = 'off'
+        message = led_config.SECURITY_MESSAGES[color]
+        # Without the server the frame goes straight to the strip when its name is known
+        if not ws_client.server_available() and led_config.publish_message(sensor_id, led_config.SECURITY_FRAMES[color]):
+            return
         payload = {
             "action": "sendLEDTrigger",
             "payload": {
@@ -114,121 +98,105 @@ def send_security_led_trigger(sensor_id, color):
                 "message": message
             }
         }
-        ws.send(json.dumps(payload))
-        response = ws.recv()
-        response_data = json.loads(response)
-        logger.debug(f"Received response for sendLEDTrigger: {response_data}")
+        response_data = ws_client.request(payload)
+        logger.debug("Received response for sendLEDTrigger: %s", response_data)
         if response_data.get("action") == "LEDTrigger" and "message" in response_data:
-            logger.debug(f"LED Trigger message sent: {response_data['message']}")
+            logger.debug("LED Trigger message sent: %s", response_data['message'])
         else:
-            logger.warning(f"Failed to send LED trigger for sensor {sensor_id} with color {color}.")
-        ws.close()
+            logger.warning("Failed to send LED trigger for sensor %s with color %s.", sensor_id, color)
     except websocket.WebSocketException as e:
         logger.error(f"WebSocket error: {e}")
     except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e} - Response content: {response}")
+        logger.error(f"JSON decode error: {e}")
     except Exception as e:
         logger.error(f"Unexpected error in send_security_led_trigger: {e}")
 
-def map_position_id_to_sensor_range(position_id):
-    for position in positions:
-        if position["position_ID"] == position_id:
-            return position["sensor_ID"], position["range_ID"]
-    return None, None
-
-def check_security_sequence(sensor_id, range_id):
-    global last_step, current_step_index, security_sequences
-
-    current_step = (sensor_id, range_id)
-    logger.debug(f"Current step: {current_step}")
-
-    # Ignore repeated steps
-    if current_step == last_step:
-        return
+def on_config_change(snapshot, previous):
+    if snapshot.security_automaton is not previous.security_automaton:
+        security_tracker.set_automaton(snapshot.security_automaton)
 
-    last_step = current_step
+config_snapshot.add_listener(on_config_change)
 
-    for sequence in security_sequences:
-        position_id = sequence[f"step{current_step_index + 1}_position_ID"]
-        expected_sensor_id, expected_range_id = map_position_id_to_sensor_range(position_id)
-        expected_step = (expected_sensor_id, expected_range_id)
-        logger.debug(f"Expected step: {expected_step}")
-
-        if current_step == expected_step:
-            send_security_led_trigger(sensor_id, 'green')
-            time.sleep(2)
-            send_security_led_trigger(sensor_id, 'off')
-            logger.info(f"Step {current_step_index + 1} matched, sent green light.")
-            current_step_index += 1
-
-            if current_step_index == 3:
-                logger.info("Security sequence matched successfully.")
-                reset_user_steps()
-            return
-        else:
-            send_security_led_trigger(sensor_id, 'red')
-            logger.info(f"Step {current_step_index + 1} did not match, sent red light.")
-            time.sleep(2)
-            send_security_led_trigger(sensor_id, 'off')
-            reset_user_steps()
-            return
+def send_security_feedback(sensor_id, color):
+    # The requests run in the control lane, in order; the timer thread only queues the switch-off.
+    # New feedback replaces a pending switch-off, so it cannot cut the new colour short.
+    lanes = scheduler.get_lanes()
+    lanes.submit(scheduler.CONTROL, send_security_led_trigger, sensor_id, color)
+    with _feedback_lock:
+        previous = pending_feedback_off.get(sensor_id)
+        if previous is not None:
+            previous.cancel()
+        pending_feedback_off[sensor_id] = scheduler.call_later(
+            SECURITY_FEEDBACK_SECONDS, lanes.submit, scheduler.CONTROL, send_security_led_trigger, sensor_id, 'off')
 
-def fetch_and_play_note_details(sensor_id, distance, is_muted):
+def check_security_sequence(sensor_id, range_id):
+    result = security_tracker.step(sensor_id, range_id)
+    logger.debug("Security step: %s, result: %s", (sensor_id, range_id), result)
+    if result is None:
+        return  # Ignore repeated steps
+
+    matched, completed = result
+    if matched:
+        send_security_feedback(sensor_id, 'green')
+        logger.info("Step %s matched, sent green light.", (sensor_id, range_id))
+        for sequence_id in completed:
+            logger.info("Security sequence %s matched successfully.", sequence_id)
+    else:
+        send_security_feedback(sensor_id, 'red')
+        logger.info("Step %s did not match, sent red light.", (sensor_id, range_id))
+
+def fetch_and_play_note_details(sensor_id, distance, is_muted, range_id=None):
+    with PIPELINE_TIME.time():
+        _fetch_and_play_note_details(sensor_id, distance, is_muted, range_id)
+
+def _fetch_and_play_note_details(sensor_id, distance, is_muted, range_id):
     try:
-        current_mode = get_current_mode()
+        with MODE_LOOKUP_TIME.time():
+            current_mode = mode_cache.get_mode()
         if current_mode is None:
             logger.error("Could not determine current mode, skipping processing.")
             return
 
-        range_id = determine_range_id(distance)
         if range_id is None:
-            logger.warning(f"No matching range found for distance: {distance}")
-            return
+            with RANGE_CLASSIFICATION_TIME.time():
+                range_id = determine_range_id(distance)
+        if range_id is None:
+            return  # determine_range_id has logged it
 
-        logger.debug(f"Fetching note details for sensor_id: {sensor_id}, range_id: {range_id}")
-        ws = websocket.WebSocket()
-        ws.connect(WS_SERVER_URL)
-        payload = {
-            "action": "getNoteDetails",
-            "payload": {
-                "sensor_ID": sensor_id,
-                "range_ID": range_id
-            }
-        }
-        ws.send(json.dumps(payload))
-        response = ws.recv()
-        response_data = json.loads(response)
-        logger.debug(f"Received response for getNoteDetails: {response_data}")
-        if response_data.get("action") == "getNoteDetails" and "data" in response_data:
-            note_details = response_data["data"]
-            logger.debug(f"Note details received: {note_details}")
-            note_id = note_details.get("note_ID")
+        logger.debug("Resolving note for sensor_id: %s, range_id: %s", sensor_id, range_id)
+        with NOTE_RESOLUTION_TIME.time():
+            note_id = note_cache.get_note_id(sensor_id, range_id)
+        if note_id is not None:
+            logger.debug("Note resolved: %s", note_id)
 
             log_sensor_data(sensor_id, distance)
 
             if current_mode == 1:  # Musical Stairs mode
-                send_led_trigger(sensor_id, distance)
+                with LED_PUBLISH_TIME.time():
+                    send_led_trigger(sensor_id, range_id)
                 current_time = time.time()
-                last_note, last_time = last_played.get(sensor_id, (None, 0))
+                sensor_state = registry.sensor(sensor_id)
 
-                if (note_id != last_note or (current_time - last_time) > COOLDOWN_PERIOD) and not is_muted:
-                    last_played[sensor_id] = (note_id, current_time)
-                    threading.Thread(target=play_sound, args=(note_id,)).start()
+                if (note_id != sensor_state.last_note or (current_time - sensor_state.last_note_time) > COOLDOWN_PERIOD) and not is_muted:
+                    sensor_state.last_note, sensor_state.last_note_time = note_id, current_time
+                    audio_engine.play(sensor_id, note_id)
+                    NOTES_PLAYED.inc()
                 else:
-                    logger.info(f"Skipping note {note_id} for sensor {sensor_id} due to cooldown or mute.")
+                    NOTES_SKIPPED.inc()
+                    logger.info("Skipping note %s for sensor %s due to cooldown or mute.", note_id, sensor_id)
 
             elif current_mode == 2:  # Security mode
-                check_security_sequence(sensor_id, range_id)
+                with SECURITY_CHECK_TIME.time():
+                    check_security_sequence(sensor_id, range_id)
 
             # Add more modes as needed
 
         else:
-            logger.warning(f"No note details found for sensor {sensor_id} at range {range_id}.")
-        ws.close()
+            logger.warning("No note details found for sensor %s at range %s.", sensor_id, range_id)
     except websocket.WebSocketException as e:
         logger.error(f"WebSocket error: {e}")
     except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e} - Response content: {response}")
+        logger.error(f"JSON decode error: {e}")
     except Exception as e:
         logger.error(f"Unexpected error in fetch_and_play_note_details: {e}")
 
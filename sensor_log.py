@@ -0,0 +1,379 @@
+import asyncio
+import atexit
+import collections
+import json
+import logging
+import os
+import threading
+import time
+import ws_client
+import metrics
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+SENSOR_LOG_BATCH_SIZE = int(os.getenv('SENSOR_LOG_BATCH_SIZE', '50'))
+SENSOR_LOG_FLUSH_INTERVAL = float(os.getenv('SENSOR_LOG_FLUSH_INTERVAL', '1.0'))  # seconds
+SENSOR_LOG_QUEUE_SIZE = int(os.getenv('SENSOR_LOG_QUEUE_SIZE', '10000'))
+# Readings that cannot be delivered are appended here as JSON lines and replayed later; unset disables spooling
+SENSOR_LOG_SPOOL_PATH = os.getenv('SENSOR_LOG_SPOOL_PATH')
+# Readings are sent one logSensorData request each. Servers that accept a whole batch in one
+# request can name that action here (e.g. logSensorDataBatch, payload {"readings": [...]}); if the
+# server answers it with an error the pipeline goes back to one request per reading.
+SENSOR_LOG_BATCH_ACTION = os.getenv('SENSOR_LOG_BATCH_ACTION', '')
+
+# Overflow policy: the queue holds at most SENSOR_LOG_QUEUE_SIZE readings. When it is full the
+# oldest pending reading is dropped to make room and counted in stats["dropped"], so logging
+# never blocks the caller. Batches that fail to send go to the spool file when one is configured,
+# otherwise they are put back at the front of the queue under the same drop-oldest policy.
+class SensorLogPipeline:
+    def __init__(self, batch_size=SENSOR_LOG_BATCH_SIZE, flush_interval=SENSOR_LOG_FLUSH_INTERVAL,
+                 queue_size=SENSOR_LOG_QUEUE_SIZE, spool_path=SENSOR_LOG_SPOOL_PATH):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.spool_path = spool_path
+        self.batch_action = SENSOR_LOG_BATCH_ACTION
+        self.stats = {"queued": 0, "sent": 0, "dropped": 0, "rejected": 0, "spooled": 0, "batches": 0}
+        self._queue = collections.deque(maxlen=queue_size)
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._start()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _notify(self):
+        # Called with self._cond held
+        self._cond.notify()
+
+    def enqueue(self, sensor_id, distance):
+        reading = {"sensor_ID": sensor_id, "distance": distance, "timestamp": time.time()}
+        with self._cond:
+            if len(self._queue) == self.queue_size:
+                self.stats["dropped"] += 1
+            self._queue.append(reading)
+            self.stats["queued"] += 1
+            if len(self._queue) >= self.batch_size:
+                self._notify()
+
+    def wake(self):
+        # Sends whatever is queued now instead of at the next interval
+        with self._cond:
+            self._notify()
+
+    def _take_batch(self):
+        with self._cond:
+            deadline = time.time() + self.flush_interval
+            while len(self._queue) < self.batch_size and not self._stopping:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            count = min(len(self._queue), self.batch_size)
+            return [self._queue.popleft() for _ in range(count)]
+
+    def _send_steps(self, batch):
+        # Yields each request and is sent back its reply, or the exception it raised; returns the
+        # readings that could not be delivered, to be retried later
+        if self.batch_action:
+            response_data = yield {"action": self.batch_action, "payload": {"readings": batch}}
+            if isinstance(response_data, Exception):
+                logger.error(f"Failed to send sensor data batch of {len(batch)} readings: {response_data}")
+                return batch
+            if response_data.get("action") == self.batch_action and "error" not in response_data:
+                self.stats["sent"] += len(batch)
+                self.stats["batches"] += 1
+                logger.debug("Logged batch of %s sensor readings", len(batch))
+                return []
+            logger.error(f"{self.batch_action} rejected ({response_data.get('error')}), logging readings one by one")
+            self.batch_action = ''
+        for index, reading in enumerate(batch):
+            payload = {
+                "action": "logSensorData",
+                "payload": {
+                    "sensor_ID": reading["sensor_ID"],
+                    "distance": reading["distance"]
+                }
+            }
+            response_data = yield payload
+            if isinstance(response_data, Exception):
+                logger.error(f"Failed to send sensor data, {len(batch) - index} readings pending: {response_data}")
+                return batch[index:]
+            if response_data.get("action") == "logSensorData" and "error" not in response_data:
+                self.stats["sent"] += 1
+            else:
+                # Rejected by the server: sending it again would not help
+                self.stats["rejected"] += 1
+                logger.error(f"Failed to log sensor data for sensor {reading['sensor_ID']}: {response_data.get('error')}")
+        self.stats["batches"] += 1
+        return []
+
+    def _send(self, batch):
+        if not ws_client.server_available():
+            return batch  # Kept queued or spooled until the server is back
+        steps = self._send_steps(batch)
+        response_data = None
+        try:
+            while True:
+                payload = steps.send(response_data)
+                try:
+                    response_data = ws_client.request(payload)
+                except Exception as e:
+                    response_data = e
+        except StopIteration as done:
+            return done.value
+
+    def _requeue(self, batch):
+        with self._cond:
+            pending = batch + list(self._queue)
+            overflow = max(0, len(pending) - self.queue_size)
+            self.stats["dropped"] += overflow
+            self._queue = collections.deque(pending[overflow:], maxlen=self.queue_size)
+
+    def _spool(self, batch):
+        try:
+            with open(self.spool_path, "a") as spool:
+                for reading in batch:
+                    spool.write(json.dumps(reading) + "\n")
+            self.stats["spooled"] += len(batch)
+            return True
+        except OSError as e:
+            logger.error(f"Failed to spool sensor data to {self.spool_path}: {e}")
+            return False
+
+    def _replay_batches(self):
+        # Yields each batch of spooled readings and is sent back the readings of it left unsent
+        if not self.spool_path:
+            return
+        # Move the spool aside first so readings spooled during the replay are not lost.
+        # A replay file left behind by an interrupted replay is finished before the next spool.
+        replay_path = self.spool_path + ".replay"
+        try:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spool_path):
+                    return
+                os.replace(self.spool_path, replay_path)
+            with open(replay_path) as spool:
+                readings = [json.loads(line) for line in spool if line.strip()]
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read sensor data spool: {e}")
+            return
+        logger.info(f"Replaying {len(readings)} spooled sensor readings")
+        for start in range(0, len(readings), self.batch_size):
+            unsent = yield readings[start:start + self.batch_size]
+            if unsent:
+                if not self._spool(unsent + readings[start + self.batch_size:]):
+                    return
+                break
+        os.remove(replay_path)
+
+    def _replay_spool(self):
+        steps = self._replay_batches()
+        unsent = None
+        try:
+            while True:
+                unsent = self._send(steps.send(unsent))
+        except StopIteration:
+            pass
+
+    def _handle_failure(self, batch):
+        if not (self.spool_path and self._spool(batch)):
+            self._requeue(batch)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                unsent = self._send(batch)
+                if not unsent:
+                    self._replay_spool()
+                else:
+                    self._handle_failure(unsent)
+                    if self._stopping:
+                        return
+                    time.sleep(self.flush_interval)
+            if self._stopping:
+                with self._cond:
+                    if not self._queue:
+                        return
+
+    def stop(self, timeout=5):
+        # Flush everything still queued; whatever cannot be delivered in time is spooled
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        with self._cond:
+            remaining, self._queue = list(self._queue), collections.deque(maxlen=self.queue_size)
+        if remaining and self.spool_path:
+            self._spool(remaining)
+        elif remaining:
+            logger.warning(f"Discarding {len(remaining)} unsent sensor readings on shutdown")
+        logger.info(f"Sensor log pipeline stopped: {self.stats}")
+
+class AsyncSensorLogPipeline(SensorLogPipeline):
+    # asyncio counterpart for main_async: a task on the running loop sends the batches through an
+    # awaitable request(payload), e.g. AsyncWSClient.request; spool file I/O runs in the executor
+    def __init__(self, request, **kwargs):
+        self.request = request
+        super().__init__(**kwargs)
+
+    def _start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run_async())
+
+    def _notify(self):
+        # enqueue runs on the loop, wake on whichever thread noticed the server is back
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _take_batch_async(self):
+        deadline = self._loop.time() + self.flush_interval
+        while len(self._queue) < self.batch_size and not self._stopping:
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        with self._cond:
+            count = min(len(self._queue), self.batch_size)
+            return [self._queue.popleft() for _ in range(count)]
+
+    async def _send_async(self, batch):
+        if not ws_client.server_available():
+            return batch
+        steps = self._send_steps(batch)
+        response_data = None
+        try:
+            while True:
+                payload = steps.send(response_data)
+                try:
+                    response_data = await self.request(payload)
+                except Exception as e:
+                    response_data = e
+        except StopIteration as done:
+            return done.value
+
+    async def _replay_spool_async(self):
+        if not self.spool_path:
+            return
+        steps = self._replay_batches()
+        unsent = None
+        while True:
+            batch = await self._loop.run_in_executor(None, _advance, steps, unsent)
+            if batch is None:
+                return
+            unsent = await self._send_async(batch)
+
+    async def _handle_failure_async(self, batch):
+        if self.spool_path:
+            await self._loop.run_in_executor(None, self._handle_failure, batch)
+        else:
+            self._requeue(batch)
+
+    async def _run_async(self):
+        while True:
+            batch = await self._take_batch_async()
+            if batch:
+                unsent = await self._send_async(batch)
+                if not unsent:
+                    await self._replay_spool_async()
+                else:
+                    await self._handle_failure_async(unsent)
+                    if self._stopping:
+                        return
+                    await asyncio.sleep(self.flush_interval)
+            if self._stopping and not self._queue:
+                return
+
+    def stop(self, timeout=5):
+        # Off the loop there is nothing to wait for: the task is cancelled with the loop
+        with self._cond:
+            self._stopping = True
+        self._task.cancel()
+
+    async def stop_async(self, timeout=5):
+        with self._cond:
+            self._stopping = True
+            self._notify()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        with self._cond:
+            remaining, self._queue = list(self._queue), collections.deque(maxlen=self.queue_size)
+        if remaining and self.spool_path:
+            await self._loop.run_in_executor(None, self._spool, remaining)
+        elif remaining:
+            logger.warning(f"Discarding {len(remaining)} unsent sensor readings on shutdown")
+        logger.info(f"Sensor log pipeline stopped: {self.stats}")
+
+def _advance(steps, value):
+    # Generator step for run_in_executor, which cannot carry StopIteration back to the loop
+    try:
+        return steps.send(value)
+    except StopIteration:
+        return None
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+def get_pipeline():
+    global _pipeline
+    if _pipeline is None:
+        with _pipeline_lock:
+            if _pipeline is None:
+                _pipeline = SensorLogPipeline()
+                atexit.register(stop)
+    return _pipeline
+
+def set_pipeline(pipeline):
+    # Replaces the shared pipeline, e.g. with an AsyncSensorLogPipeline in the asyncio runtime
+    global _pipeline
+    with _pipeline_lock:
+        previous, _pipeline = _pipeline, pipeline
+    if previous is not None:
+        previous.stop()
+
+def enqueue(sensor_id, distance):
+    get_pipeline().enqueue(sensor_id, distance)
+
+def get_stats():
+    return dict(get_pipeline().stats)
+
+def on_server_recovery():
+    pipeline = _pipeline
+    if pipeline is not None:
+        pipeline.wake()
+
+ws_client.on_recovery(on_server_recovery)
+
+def pipeline_gauges():
+    pipeline = _pipeline
+    if pipeline is None:
+        return []
+    return [("sensor_log_" + name, {}, value) for name, value in pipeline.stats.items()]
+
+metrics.add_collector(pipeline_gauges)
+
+def stop():
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is not None:
+            _pipeline.stop()
+            _pipeline = None
+
+async def stop_async():
+    # stop() for the asyncio runtime, whose pipeline flushes through the loop
+    global _pipeline
+    with _pipeline_lock:
+        pipeline, _pipeline = _pipeline, None
+    if isinstance(pipeline, AsyncSensorLogPipeline):
+        await pipeline.stop_async()
+    elif pipeline is not None:
+        await asyncio.to_thread(pipeline.stop)
@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+from array import array
+import config_snapshot
+import metrics
+from liveness import LivenessTracker
+
+# Readings kept per sensor; memory per sensor is fixed at about 20 bytes per slot
+SENSOR_HISTORY = int(os.getenv('SENSOR_HISTORY', '64'))
+# LED strips registered before they first report, so a strip that never comes up is still noticed;
+# their colours are loaded, but triggers only bypass the server for led_config.SENSOR_LED_STRIPS
+LED_STRIPS = [name for name in os.getenv('LED_STRIPS', 'ledstrip1,ledstrip2').split(",") if name]
+# Seconds without a message before a device counts as gone, and without any sensor activity
+# before the installation counts as idle
+ALIVE_TIMEOUT = float(os.getenv('ALIVE_TIMEOUT', '60'))
+IDLE_TIMEOUT = float(os.getenv('IDLE_TIMEOUT', '300'))
+# Seconds of recent readings summarised per sensor in the metrics, 0 leaves them out
+SENSOR_STATS_WINDOW = float(os.getenv('SENSOR_STATS_WINDOW', '60'))
+ANY_SENSOR = "any"  # the single key of the idle tracker
+
+NO_RANGE = -1  # range_ids slot value for a reading outside every range
+
+class SensorState:
+    __slots__ = ("sensor_id", "timestamps", "distances", "range_ids", "next_slot", "count",
+                 "last_activity", "last_note", "last_note_time")
+
+    def __init__(self, sensor_id, history=SENSOR_HISTORY, now=None):
+        self.sensor_id = sensor_id
+        # Preallocated ring buffers written in place, oldest slot overwritten first
+        self.timestamps = array('d', bytes(8 * history))
+        self.distances = array('d', bytes(8 * history))
+        self.range_ids = array('i', [NO_RANGE] * history)
+        self.next_slot = 0
+        self.count = 0
+        self.last_activity = time.time() if now is None else now
+        self.last_note = None
+        self.last_note_time = 0.0
+
+    def record(self, timestamp, distance, range_id):
+        slot = self.next_slot
+        self.timestamps[slot] = timestamp
+        self.distances[slot] = distance
+        self.range_ids[slot] = NO_RANGE if range_id is None else range_id
+        self.next_slot = (slot + 1) % len(self.timestamps)
+        self.count = min(self.count + 1, len(self.timestamps))
+        self.last_activity = timestamp
+
+    def recent(self, seconds, now=None):
+        # Slots of readings newer than `seconds`, newest first
+        now = time.time() if now is None else now
+        size = len(self.timestamps)
+        for offset in range(1, self.count + 1):
+            slot = (self.next_slot - offset) % size
+            if now - self.timestamps[slot] > seconds:
+                return
+            yield slot
+
+    def window_stats(self, seconds, now=None):
+        slots = list(self.recent(seconds, now))
+        if not slots:
+            return {"count": 0}
+        distances = [self.distances[slot] for slot in slots]
+        range_ids = [self.range_ids[slot] for slot in slots]
+        return {
+            "count": len(slots),
+            "mean": sum(distances) / len(distances),
+            "min": min(distances),
+            "max": max(distances),
+            "range_changes": sum(1 for newer, older in zip(range_ids, range_ids[1:]) if newer != older),
+        }
+
+class DeviceRegistry:
+    def __init__(self, history=SENSOR_HISTORY, alive_timeout=ALIVE_TIMEOUT, idle_timeout=IDLE_TIMEOUT):
+        self.history = history
+        self.sensors = {}  # sensor_ID -> SensorState
+        self.led_strips = {}  # led_strip_name -> last activity time
+        self.sensor_scope = None  # sensor_IDs this process tracks from the config, None for all
+        # Deadlines pushed forward by every message; expiries are collected by mqtt_handler's checks
+        self.sensor_liveness = LivenessTracker(alive_timeout)
+        self.led_strip_liveness = LivenessTracker(alive_timeout)
+        self.idle = LivenessTracker(idle_timeout)
+        self.idle.touch(ANY_SENSOR)
+        self._lock = threading.Lock()
+
+    def sensor(self, sensor_id):
+        state = self.sensors.get(sensor_id)
+        if state is None:
+            with self._lock:
+                state = self.sensors.get(sensor_id)
+                if state is None:
+                    state = self.sensors[sensor_id] = SensorState(sensor_id, self.history)
+                    # A sensor that never reports is noticed too
+                    self.sensor_liveness.touch(sensor_id, state.last_activity)
+        return state
+
+    def discover_sensors(self, sensor_ids):
+        for sensor_id in sensor_ids:
+            if self.sensor_scope is None or sensor_id in self.sensor_scope:
+                self.sensor(sensor_id)
+
+    def restrict(self, sensor_ids, led_strip_names):
+        # A shard worker only watches its own devices; others it still hears from are added as they report
+        with self._lock:
+            self.sensor_scope = set(sensor_ids)
+            self.sensors = {sensor_id: state for sensor_id, state in self.sensors.items() if sensor_id in self.sensor_scope}
+            self.led_strips = {name: last_time for name, last_time in self.led_strips.items() if name in led_strip_names}
+        for sensor_id in list(self.sensor_liveness.deadlines):
+            if sensor_id not in self.sensor_scope:
+                self.sensor_liveness.forget(sensor_id)
+        for led_strip_name in list(self.led_strip_liveness.deadlines):
+            if led_strip_name not in led_strip_names:
+                self.led_strip_liveness.forget(led_strip_name)
+
+    def touch_sensor(self, sensor_id, now=None):
+        now = time.time() if now is None else now
+        self.sensor(sensor_id).last_activity = now
+        self.sensor_liveness.touch(sensor_id, now)
+        self.idle.touch(ANY_SENSOR, now)
+
+    def record_reading(self, sensor_id, distance, range_id, now=None):
+        now = time.time() if now is None else now
+        self.sensor(sensor_id).record(now, distance, range_id)
+        self.sensor_liveness.touch(sensor_id, now)
+        self.idle.touch(ANY_SENSOR, now)
+
+    def touch_led_strip(self, led_strip_name, now=None):
+        now = time.time() if now is None else now
+        self.led_strips[led_strip_name] = now
+        self.led_strip_liveness.touch(led_strip_name, now)
+
+    def sensor_activity(self):
+        return [(sensor_id, state.last_activity) for sensor_id, state in list(self.sensors.items())]
+
+    def led_strip_activity(self):
+        return list(self.led_strips.items())
+
+registry = DeviceRegistry()
+for led_strip_name in LED_STRIPS:
+    registry.touch_led_strip(led_strip_name)
+
+def on_config_change(snapshot, previous):
+    registry.discover_sensors({position["sensor_ID"] for position in snapshot.positions})
+
+config_snapshot.add_listener(on_config_change)
+
+def registry_gauges(now=None):
+    now = time.time() if now is None else now
+    gauges = []
+    for sensor_id, state in list(registry.sensors.items()):
+        gauges.append(("sensor_last_activity_age_seconds", {"sensor": sensor_id}, round(now - state.last_activity, 1)))
+        if SENSOR_STATS_WINDOW > 0:
+            for name, value in state.window_stats(SENSOR_STATS_WINDOW, now).items():
+                gauges.append(("sensor_window_" + name, {"sensor": sensor_id}, value))
+    for led_strip_name, last_time in registry.led_strip_activity():
+        gauges.append(("led_strip_last_activity_age_seconds", {"led_strip": led_strip_name}, round(now - last_time, 1)))
+    return gauges
+
+metrics.add_collector(registry_gauges)
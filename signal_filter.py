@@ -0,0 +1,65 @@
+import collections
+import os
+import statistics
+import threading
+
+# Median window in readings, 1 disables median smoothing. A window of n delays a range change by
+# up to n // 2 readings, so it is off unless configured.
+FILTER_MEDIAN_WINDOW = int(os.getenv('FILTER_MEDIAN_WINDOW', '1'))
+# EMA weight of the newest reading, 1 disables EMA smoothing
+FILTER_EMA_ALPHA = float(os.getenv('FILTER_EMA_ALPHA', '1'))
+# Distance a reading must move past a range boundary before the range changes, 0 disables hysteresis.
+# The band only widens inner boundaries; a reading outside every range is never given one.
+FILTER_HYSTERESIS = float(os.getenv('FILTER_HYSTERESIS', '0'))
+# Only pass readings on when the (hysteresis-adjusted) range changes. Off by default: someone
+# standing in one range keeps retriggering its note, as without the filter.
+FILTER_EMIT_ON_CHANGE = os.getenv('FILTER_EMIT_ON_CHANGE', '0') == '1'
+
+class SensorFilter:
+    def __init__(self, median_window=FILTER_MEDIAN_WINDOW, ema_alpha=FILTER_EMA_ALPHA,
+                 hysteresis=FILTER_HYSTERESIS, emit_on_change=FILTER_EMIT_ON_CHANGE):
+        self.median_window = median_window
+        self.ema_alpha = ema_alpha
+        self.hysteresis = hysteresis
+        self.emit_on_change = emit_on_change
+        self.window = collections.deque(maxlen=max(1, median_window))
+        self.ema = None
+        self.range_id = None
+
+    def _classify(self, range_index, distance):
+        # Stay in the current range until the reading is more than the hysteresis margin outside it
+        if self.range_id is not None and self.hysteresis:
+            limits = range_index.limits.get(self.range_id)
+            if limits and range_index.lower_limits[0] <= distance < range_index.upper_limit:
+                if limits[0] - self.hysteresis <= distance < limits[1] + self.hysteresis:
+                    return self.range_id
+        return range_index.lookup(distance)
+
+    def update(self, distance, range_index):
+        # Returns (smoothed_distance, range_ID) to process, or None to drop the reading
+        self.window.append(distance)
+        smoothed = statistics.median(self.window) if self.median_window > 1 else distance
+        if self.ema_alpha < 1:
+            self.ema = smoothed if self.ema is None else self.ema_alpha * smoothed + (1 - self.ema_alpha) * self.ema
+            smoothed = self.ema
+
+        range_id = self._classify(range_index, smoothed)
+        changed = range_id != self.range_id
+        self.range_id = range_id
+        if range_id is None or (self.emit_on_change and not changed):
+            return None
+        return smoothed, range_id
+
+_filters = {}
+_lock = threading.Lock()
+
+def get_filter(sensor_id):
+    sensor_filter = _filters.get(sensor_id)
+    if sensor_filter is None:
+        with _lock:
+            sensor_filter = _filters.setdefault(sensor_id, SensorFilter())
+    return sensor_filter
+
+def reset():
+    with _lock:
+        _filters.clear()
@@ -1,47 +1,55 @@
-import pygame
 import logging
-import websocket
-import json
+import os
+import threading
 import time
-from config import WS_SERVER_URL
+from concurrent.futures import ThreadPoolExecutor
+import ws_client
+import sample_cache
+import config_snapshot
 
-# Initialize pygame mixer for playing sound
-pygame.mixer.init()
+# Mixer format; a small buffer keeps the delay between a play command and audible output low
+MIXER_FREQUENCY = int(os.getenv('MIXER_FREQUENCY', '44100'))
+MIXER_SIZE = int(os.getenv('MIXER_SIZE', '-16'))
+MIXER_CHANNELS = int(os.getenv('MIXER_CHANNELS', '2'))
+MIXER_BUFFER = int(os.getenv('MIXER_BUFFER', '256'))
+
+# Decode notes on a worker pool at startup, or on first use when SOUND_LAZY is set
+SOUND_LOAD_WORKERS = int(os.getenv('SOUND_LOAD_WORKERS', str(os.cpu_count() or 4)))
+SOUND_LAZY = os.getenv('SOUND_LAZY', '0') == '1'
 
 # Global dictionaries
 sounds = {}
-ranges = []
-last_played = {}  # Dictionary to track last played note and timestamp for each sensor
+note_locations = {}  # note_ID -> file, used by lazy decoding
+lazy_sounds = sample_cache.SoundLRU()
+last_played = {}  # Dictionary to track the last play time for each note ID, per-sensor state is in sensor_registry
 
 # Cooldown period in seconds
 COOLDOWN_PERIOD = 1
 is_muted = False  # Mute state
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+_mixer_lock = threading.Lock()
+
+def init_mixer():
+    # Opens the audio device on first use rather than at import; safe to call from any thread.
+    # pygame itself is imported here too, so importing the app does not pay for it.
+    import pygame
+    with _mixer_lock:
+        if pygame.mixer.get_init() is None:
+            started = time.perf_counter()
+            pygame.mixer.init(frequency=MIXER_FREQUENCY, size=MIXER_SIZE, channels=MIXER_CHANNELS, buffer=MIXER_BUFFER)
+            logger.info(f"Mixer initialised in {time.perf_counter() - started:.2f}s")
+
 def load_sounds(retries=5, delay=2):
     for attempt in range(retries):
         try:
-            ws = websocket.WebSocket()
-            ws.connect(WS_SERVER_URL)
             payload = {"action": "getNotes"}
-            ws.send(json.dumps(payload))
-            response = ws.recv()
-            logger.debug(f"Received raw response for getNotes: {response}")
-            response_data = json.loads(response)
-            logger.debug(f"Parsed response for getNotes: {response_data}")
+            response_data = ws_client.request(payload)
+            logger.debug("Parsed response for getNotes: %s", response_data)
             if response_data and response_data.get("action") == "getNotes":
-                notes = response_data.get("data", [])
-                for note in notes:
-                    if isinstance(note, dict):
-                        sounds[note["note_ID"]] = pygame.mixer.Sound(note["note_location"])
-                    else:
-                        logger.error(f"Unexpected note format: {note}")
-                logger.info("Sounds loaded successfully")
-                logger.debug(f"Loaded sounds: {sounds}")
-                ws.close()
+                apply_notes(response_data.get("data", []))
                 return
             else:
                 logger.critical(f"Failed to load sounds: Invalid response format: {response_data.get('message', '')}")
@@ -50,30 +58,53 @@ def load_sounds(retries=5, delay=2):
             time.sleep(delay)
     logger.critical("Failed to load sounds after retries.")
 
-def load_ranges(retries=5, delay=2):
-    global ranges
-    for attempt in range(retries):
+def apply_notes(notes):
+    global note_locations
+    new_locations = {}
+    for note in notes:
+        if isinstance(note, dict):
+            new_locations[note["note_ID"]] = note["note_location"]
+        else:
+            logger.error(f"Unexpected note format: {note}")
+    # Only notes that are new or point at a different file need decoding
+    changed = {note_ID: location for note_ID, location in new_locations.items()
+               if note_locations.get(note_ID) != location or note_ID not in sounds}
+    if not SOUND_LAZY:
+        decode_sounds(changed)
+    note_locations = new_locations
+    for note_ID in [note_ID for note_ID in sounds if note_ID not in new_locations]:
+        del sounds[note_ID]
+    if changed:
+        lazy_sounds.clear()
+    logger.info(f"Sounds loaded successfully ({len(new_locations)} notes, {len(changed)} changed, lazy={SOUND_LAZY})")
+
+def on_config_change(snapshot, previous):
+    if snapshot.notes != previous.notes:
+        apply_notes(snapshot.notes)
+
+def decode_sounds(locations):
+    init_mixer()
+    started = time.time()
+
+    def decode(item):
+        note_ID, location = item
         try:
-            ws = websocket.WebSocket()
-            ws.connect(WS_SERVER_URL)
-            payload = {"action": "getRanges"}
-            ws.send(json.dumps(payload))
-            response = ws.recv()
-            logger.debug(f"Received raw response for getRanges: {response}")
-            response_data = json.loads(response)
-            logger.debug(f"Parsed response for getRanges: {response_data}")
-            if response_data and response_data.get("action") == "getRanges":
-                ranges = response_data.get("data", [])
-                logger.info("Ranges loaded successfully")
-                logger.debug(f"Loaded ranges: {ranges}")
-                ws.close()
-                return
-            else:
-                logger.critical(f"Failed to load ranges: Invalid response format: {response_data.get('message', '')}")
+            return note_ID, sample_cache.decode(location)
         except Exception as e:
-            logger.error(f"Error loading ranges, attempt {attempt + 1} of {retries}: {e}")
-            time.sleep(delay)
-    logger.critical("Failed to load ranges after retries.")
+            logger.error(f"Failed to decode sound for note ID {note_ID} from {location}: {e}")
+            return note_ID, None
+
+    with ThreadPoolExecutor(max_workers=SOUND_LOAD_WORKERS) as executor:
+        for note_ID, decoded in executor.map(decode, list(locations.items())):
+            if decoded is not None:
+                sounds[note_ID] = decoded
+    logger.info(f"Decoded {len(locations)} sounds in {time.time() - started:.2f}s")
+
+def get_sound(note_ID):
+    sound = sounds.get(note_ID)
+    if sound is None and note_ID in note_locations:
+        sound = lazy_sounds.get(note_ID, note_locations[note_ID])
+    return sound
 
 def play_sound(note_ID):
     if is_muted:
@@ -88,7 +119,7 @@ def play_sound(note_ID):
         return
     
     try:
-        sound = sounds.get(note_ID)
+        sound = get_sound(note_ID)
         if sound:
             sound.play()
             last_played[note_ID] = current_time
@@ -98,9 +129,12 @@ def play_sound(note_ID):
     except Exception as e:
         logger.error(f"Failed to play sound: {e}")
 
+# Decode new or changed notes whenever a new config snapshot is installed
+config_snapshot.add_listener(on_config_change)
+
 def main():
+    init_mixer()
     load_sounds()
-    load_ranges()
 
     # Example of playing a sound with a specific note ID
     play_sound(1)
@@ -0,0 +1,170 @@
+import logging
+import os
+import threading
+import metrics
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Seconds between status flushes; heartbeats in between only update local state
+STATUS_FLUSH_INTERVAL = float(os.getenv('STATUS_FLUSH_INTERVAL', '2'))
+# Status goes out through the per-device updateSensorStatus/updateSensorAlive/updateLedStripStatus
+# actions. Servers that take every changed device in one request can name that action here
+# (e.g. updateDeviceStatusBatch); an error reply to it falls back to the per-device actions.
+STATUS_BATCH_ACTION = os.getenv('STATUS_BATCH_ACTION', '')
+
+class StatusAggregator:
+    # Tracks the state of every sensor and strip and sends only what changed since the server
+    # last confirmed it, at most once per flush
+    def __init__(self, batch_action=STATUS_BATCH_ACTION):
+        self.batch_action = batch_action
+        self.sensors = {}  # sensor_ID -> (alive, active)
+        self.led_strips = {}  # led_strip_name -> alive
+        self.reported_sensors = {}
+        self.reported_led_strips = {}
+        self.stats = {"heartbeats": 0, "flushes": 0, "requests": 0, "failures": 0}
+        self._lock = threading.Lock()
+
+    def sensor_seen(self, sensor_id, active):
+        with self._lock:
+            self.stats["heartbeats"] += 1
+            self.sensors[sensor_id] = (True, active)
+
+    def sensor_lost(self, sensor_id):
+        # True when the sensor was alive (or never reported) until now
+        with self._lock:
+            alive, active = self.sensors.get(sensor_id, (None, False))
+            self.sensors[sensor_id] = (False, active)
+        return alive is not False
+
+    def led_strip_seen(self, led_strip_name, alive):
+        # True when the strip has just come up: first heartbeat, or the first since it went quiet
+        with self._lock:
+            self.stats["heartbeats"] += 1
+            came_up = alive and not self.led_strips.get(led_strip_name, False)
+            self.led_strips[led_strip_name] = alive
+        return came_up
+
+    def led_strip_lost(self, led_strip_name):
+        with self._lock:
+            alive = self.led_strips.get(led_strip_name)
+            self.led_strips[led_strip_name] = False
+        return alive is not False
+
+    def alive_led_strips(self):
+        return [led_strip_name for led_strip_name, alive in list(self.led_strips.items()) if alive]
+
+    def _changes(self):
+        with self._lock:
+            sensors = {sensor_id: state for sensor_id, state in self.sensors.items()
+                       if self.reported_sensors.get(sensor_id) != state}
+            led_strips = {led_strip_name: alive for led_strip_name, alive in self.led_strips.items()
+                          if self.reported_led_strips.get(led_strip_name) != alive}
+        return sensors, led_strips
+
+    def _requests(self, sensors, led_strips):
+        # (payload, success action, state it confirms)
+        if self.batch_action:
+            payload = {
+                "action": self.batch_action,
+                "payload": {
+                    "sensors": [{"sensor_ID": sensor_id, "alive": alive, "active": active}
+                                for sensor_id, (alive, active) in sensors.items()],
+                    "led_strips": [{"led_strip_name": led_strip_name, "alive": alive, "active": alive}
+                                   for led_strip_name, alive in led_strips.items()],
+                }
+            }
+            return [(payload, self.batch_action, ("batch", (sensors, led_strips)))]
+
+        # One request per sensor that changed: a lost sensor is reported through updateSensorAlive,
+        # one that is (back) up or switched through updateSensorStatus, as the heartbeats were
+        requests = []
+        for sensor_id, (alive, active) in sensors.items():
+            if alive:
+                payload = {"action": "updateSensorStatus", "payload": {"sensors_on": active}}
+            else:
+                payload = {"action": "updateSensorAlive", "payload": {"sensors_on": False}}
+            requests.append((payload, "update_sensor_status", ("sensor", (sensor_id, (alive, active)))))
+        for led_strip_name, alive in led_strips.items():
+            payload = {"led_strip_name": led_strip_name, "alive": alive, "active": alive}
+            requests.append(({"action": "updateLedStripStatus", "payload": payload},
+                             "updateLedStripStatus", ("led_strip", (led_strip_name, alive))))
+        return requests
+
+    def _confirm(self, kind, value):
+        with self._lock:
+            if kind == "batch":
+                sensors, led_strips = value
+                self.reported_sensors.update(sensors)
+                self.reported_led_strips.update(led_strips)
+            elif kind == "sensor":
+                self.reported_sensors[value[0]] = value[1]
+            elif kind == "led_strip":
+                self.reported_led_strips[value[0]] = value[1]
+
+    def _handle_response(self, payload, success_action, response_data):
+        if response_data.get("action") == success_action and "error" not in response_data:
+            return True
+        if payload["action"] == self.batch_action:
+            logger.warning(f"Server rejected {self.batch_action} ({response_data.get('error')}), "
+                           f"falling back to per-device status updates")
+            self.batch_action = ""
+        else:
+            logger.error(f"{payload['action']} failed: {response_data.get('error')}")
+        return False
+
+    def _flush_steps(self):
+        # Yields each payload to send and is sent back its response, or the exception it raised
+        sensors, led_strips = self._changes()
+        if not sensors and not led_strips:
+            return
+        self.stats["flushes"] += 1
+        for payload, success_action, (kind, value) in self._requests(sensors, led_strips):
+            self.stats["requests"] += 1
+            STATUS_REQUESTS.inc()
+            response_data = yield payload
+            if isinstance(response_data, Exception):
+                logger.error(f"Failed to send {payload['action']} to server: {response_data}")
+            elif response_data is not None and self._handle_response(payload, success_action, response_data):
+                self._confirm(kind, value)
+                logger.info(f"{payload['action']} sent: {payload['payload']}")
+                continue
+            self.stats["failures"] += 1
+        # Anything unconfirmed is still a change and goes out with the next flush
+
+    def flush(self, request):
+        # request(payload) -> response dict, e.g. ws_client.request
+        steps = self._flush_steps()
+        response_data = None
+        try:
+            while True:
+                payload = steps.send(response_data)
+                try:
+                    response_data = request(payload)
+                except Exception as e:
+                    response_data = e
+        except StopIteration:
+            pass
+
+    async def flush_async(self, request):
+        # Same as flush for an awaitable request(payload)
+        steps = self._flush_steps()
+        response_data = None
+        try:
+            while True:
+                payload = steps.send(response_data)
+                try:
+                    response_data = await request(payload)
+                except Exception as e:
+                    response_data = e
+        except StopIteration:
+            pass
+
+STATUS_REQUESTS = metrics.counter("status_requests_total", "Device status requests sent to the server")
+
+status = StatusAggregator()
+
+def status_gauges():
+    return [("status_" + name, {}, value) for name, value in status.stats.items()]
+
+metrics.add_collector(status_gauges)
@@ -0,0 +1,262 @@
+import argparse
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import struct
+import sys
+import threading
+import time
+
+# Runs a large installation as several processes, e.g.
+#   SHARDS="1-8;9-16" python supervisor.py
+#   python supervisor.py --shards "1-6;7-12;13-18"
+# Each shard worker is the normal runtime (main.main) limited to its own sensors: it has its own
+# MQTT connection subscribed to just their topics, its own WebSocket pool, and publishes its own
+# LED frames; the first shard also tracks the strips in LED_STRIPS. Notes go over a pipe to a single
+# output process that owns the audio device, together with per-sensor activity for the
+# installation-wide inactivity check, which runs there as well.
+# Shards are ';'-separated; each is a ','-separated list of sensor IDs, ID ranges and extra MQTT
+# topic filters. Security sequences are matched within a shard, so shard by staircase.
+SHARDS = os.getenv('SHARDS', '')
+# Seconds between activity reports from a worker to the output process
+SHARD_ACTIVITY_INTERVAL = float(os.getenv('SHARD_ACTIVITY_INTERVAL', '1'))
+# Delay before a process that exited is started again, doubled while it keeps failing
+SHARD_RESTART_DELAY = 1
+SHARD_RESTART_MAX = 30
+
+# One fixed-size record per message; writes this small are atomic on a pipe, so a worker that
+# dies mid-send never leaves a torn frame behind
+FRAME = struct.Struct("=Biid")  # kind, sensor_ID, note_ID, timestamp
+PLAY = 0  # timestamp is the perf_counter stamp of the play call (CLOCK_MONOTONIC, shared across processes)
+ACTIVITY = 1  # timestamp is the sensor's last activity time
+
+logger = logging.getLogger("supervisor")
+
+def parse_shards(spec):
+    # "1-8;9-12,debug/stairs2" -> [({1, ..., 8}, []), ({9, ..., 12}, ["debug/stairs2"])]
+    shards = []
+    for shard in spec.split(";"):
+        sensor_ids, topics = set(), []
+        for item in (item.strip() for item in shard.split(",")):
+            if not item:
+                continue
+            first, _, last = item.partition("-")
+            if first.isdigit() and (not last or last.isdigit()):
+                sensor_ids.update(range(int(first), int(last or first) + 1))
+            else:
+                topics.append(item)
+        if sensor_ids or topics:
+            shards.append((sensor_ids, topics))
+    return shards
+
+class AudioSink:
+    # Stands in for the audio engine in a worker: play commands are written to the output process
+    def __init__(self, conn):
+        self.conn = conn
+        self.stats = {"sent": 0, "dropped": 0}
+        self._lock = threading.Lock()  # dispatcher threads share the pipe
+
+    def play(self, sensor_id, note_id):
+        self.send(PLAY, sensor_id, note_id, time.perf_counter())
+
+    def send(self, kind, sensor_id, note_id, timestamp):
+        frame = FRAME.pack(kind, sensor_id, note_id, timestamp)
+        try:
+            with self._lock:
+                self.conn.send_bytes(frame)
+            self.stats["sent"] += 1
+        except (OSError, ValueError) as e:
+            self.stats["dropped"] += 1
+            logger.error("Could not reach the output process: %s", e)
+
+    def stop(self):
+        self.conn.close()
+
+def _prepare_child(name, metrics_offset, **settings):
+    # Runs first in a spawned process, before any app module reads its settings
+    os.environ.update(settings)
+    metrics_port = int(os.getenv('METRICS_PORT', '0'))
+    if metrics_port:
+        os.environ['METRICS_PORT'] = str(metrics_port + metrics_offset)
+    log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    logging.basicConfig(level=getattr(logging, log_level), format=f"%(asctime)s {name} %(levelname)s %(name)s: %(message)s")
+
+def shard_subscriptions(sensor_ids, topics, led_strips=False):
+    import config_snapshot
+    import led_config
+    import mode_cache
+    import note_cache
+    from config import MQTT_MUTE_TOPIC
+    from sensor_registry import LED_STRIPS
+    from topic_router import topic_for, DISTANCE_TOPIC, SENSOR_ALIVE_TOPIC, LED_STRIP_ALIVE_TOPIC
+
+    # The control topic is left to the output process, so a wake or sleep is acted on once
+    subscriptions = [MQTT_MUTE_TOPIC, note_cache.NOTE_CACHE_INVALIDATE_TOPIC, mode_cache.MODE_TOPIC,
+                     config_snapshot.CONFIG_RELOAD_TOPIC]
+    for sensor_id in sorted(sensor_ids):
+        subscriptions.append(topic_for(DISTANCE_TOPIC, sensor_id=sensor_id))
+        subscriptions.append(topic_for(SENSOR_ALIVE_TOPIC, sensor_id=sensor_id))
+    # Strips are not wired to shards: exactly one worker tracks all of LED_STRIPS and pushes their
+    # config, so each strip's status is reported once
+    led_strip_names = list(LED_STRIPS) if led_strips else []
+    if led_strips:
+        subscriptions.append(led_config.LED_CONFIG_INVALIDATE_TOPIC)
+        subscriptions += [topic_for(LED_STRIP_ALIVE_TOPIC, led_strip_name=name) for name in led_strip_names]
+    return subscriptions + list(topics), led_strip_names
+
+def run_worker(index, sensor_ids, topics, conn):
+    # Workers never touch the mixer: notes are only looked up, not decoded
+    _prepare_child(f"shard{index}", index + 1, SOUND_LAZY='1')
+    import audio_engine
+    import main
+    import mqtt_handler
+    from scheduler import PeriodicTask
+    from sensor_registry import registry
+
+    sink = AudioSink(conn)
+    audio_engine.set_engine(sink)
+    # Status goes to the server per device, so shards never overwrite each other's: each reports its
+    # own sensors' transitions, and the first shard the LED strips'
+    subscriptions, led_strip_names = shard_subscriptions(sensor_ids, topics, led_strips=index == 0)
+    mqtt_handler.use_subscriptions(subscriptions)
+    registry.restrict(sensor_ids, led_strip_names)
+    logger.info(f"Shard {index} serving sensors {sorted(sensor_ids)} on {len(subscriptions)} topics")
+
+    reported = {}
+
+    def report_activity():
+        for sensor_id, last_time in registry.sensor_activity():
+            if reported.get(sensor_id) != last_time:
+                sink.send(ACTIVITY, sensor_id, 0, last_time)
+                reported[sensor_id] = last_time
+
+    PeriodicTask(SHARD_ACTIVITY_INTERVAL, report_activity).start()
+    main.main(housekeeping=False)
+
+def run_output(conns):
+    _prepare_child("output", 0)
+    import audio_engine
+    import config_snapshot
+    import metrics
+    import mqtt_handler
+    import sensor_log
+    from bootstrap import App
+    from config import CONTROL_TOPIC
+    from scheduler import PeriodicTask, HOUSEKEEPING
+    from sensor_registry import registry
+
+    mqtt_handler.use_subscriptions([CONTROL_TOPIC, config_snapshot.CONFIG_RELOAD_TOPIC])
+    app = App()
+    app.phase("audio", audio_engine.get_engine)
+    app.phase("config", config_snapshot.load)
+    mqtt_setup = app.phase("mqtt", mqtt_handler.setup_mqtt_client)
+    app.wait()
+    client = mqtt_setup.result()
+    client.loop_start()
+    tasks = [PeriodicTask(mqtt_handler.INACTIVITY_CHECK_PERIOD, mqtt_handler.check_for_inactivity, client).start()]
+    if config_snapshot.CONFIG_RELOAD_INTERVAL > 0:
+        tasks.append(PeriodicTask(config_snapshot.CONFIG_RELOAD_INTERVAL, mqtt_handler.lanes.submit, HOUSEKEEPING,
+                                  config_snapshot.reload, name="config_reload").start())
+    metrics.add_collector(mqtt_handler.lanes.gauges)
+
+    engine = audio_engine.get_engine()
+    conns = list(conns)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while conns:
+            for conn in multiprocessing.connection.wait(conns):
+                try:
+                    kind, sensor_id, note_id, timestamp = FRAME.unpack(conn.recv_bytes())
+                except EOFError:
+                    conns.remove(conn)  # Only happens once the supervisor itself has gone
+                    continue
+                if kind == PLAY:
+                    engine.play(sensor_id, note_id, timestamp)
+                elif kind == ACTIVITY:
+                    registry.touch_sensor(sensor_id, timestamp)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for task in tasks:
+            task.stop()
+        client.loop_stop()
+        client.disconnect()
+        mqtt_handler.lanes.shutdown()
+        sensor_log.stop()
+        audio_engine.stop()
+
+class Supervisor:
+    # Starts the output process and one worker per shard, and restarts any that exit. The parent
+    # keeps both ends of every pipe, so a restarted process picks up the same channel.
+    def __init__(self, shards):
+        self.context = multiprocessing.get_context("spawn")  # no threads or sockets inherited from this process
+        self.pipes = [self.context.Pipe(duplex=False) for _ in shards]  # (reader, writer) per shard
+        self.specs = {"output": (run_output, ([reader for reader, _ in self.pipes],))}
+        for index, (sensor_ids, topics) in enumerate(shards):
+            self.specs[f"shard{index}"] = (run_worker, (index, sensor_ids, topics, self.pipes[index][1]))
+        self.processes = {}
+        self.started_at = {}
+        self.restart_delays = {name: SHARD_RESTART_DELAY for name in self.specs}
+        self._stop_event = threading.Event()
+
+    def _start(self, name):
+        target, args = self.specs[name]
+        process = self.processes[name] = self.context.Process(target=target, args=args, name=name)
+        process.start()
+        self.started_at[name] = time.monotonic()
+        logger.info(f"Started {name} (pid {process.pid})")
+
+    def run(self):
+        for name in self.specs:
+            self._start(name)
+        while not self._stop_event.wait(0.5):
+            for name, process in list(self.processes.items()):
+                if process.is_alive():
+                    continue
+                # A process that ran for a while gets the short delay again
+                if time.monotonic() - self.started_at[name] > SHARD_RESTART_MAX:
+                    self.restart_delays[name] = SHARD_RESTART_DELAY
+                delay = self.restart_delays[name]
+                logger.error(f"{name} exited with code {process.exitcode}, restarting in {delay}s")
+                if self._stop_event.wait(delay):
+                    break
+                self.restart_delays[name] = min(delay * 2, SHARD_RESTART_MAX)
+                self._start(name)
+        self.shutdown()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def shutdown(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for name, process in self.processes.items():
+            process.join(5)
+            if process.is_alive():
+                logger.warning(f"{name} did not stop, killing it")
+                process.kill()
+        logger.info("All shards stopped.")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run sensor shards and a shared output process")
+    parser.add_argument("--shards", default=SHARDS, help='e.g. "1-8;9-16" (default: $SHARDS)')
+    args = parser.parse_args(argv)
+
+    log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    logging.basicConfig(level=getattr(logging, log_level), format="%(asctime)s supervisor %(levelname)s %(name)s: %(message)s")
+    shards = parse_shards(args.shards)
+    if not shards:
+        parser.error("no shards given; set SHARDS or pass --shards")
+    from sensor_registry import LED_STRIPS
+    if not LED_STRIPS:
+        parser.error("no LED strips configured; set LED_STRIPS to the strip names the first shard tracks")
+    supervisor = Supervisor(shards)
+    signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: supervisor.stop())
+    supervisor.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import logging
+import re
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Device topic patterns; {name} captures one topic level, {name:int} an integer,
+# {name:regex} a level matching the regex
+DISTANCE_TOPIC = "ultrasonic/distance_sensor{sensor_id:int}"
+SENSOR_ALIVE_TOPIC = "alive/distance_sensor{sensor_id:int}"
+LED_STRIP_ALIVE_TOPIC = "alive/{led_strip_name:ledstrip\\d+}"
+
+ROUTE_CACHE_SIZE = 10000
+PLACEHOLDER = re.compile(r"\{(\w+)(?::([^}]+))?\}")
+
+def compile_pattern(pattern):
+    regex = []
+    converters = {}
+    position = 0
+    for match in PLACEHOLDER.finditer(pattern):
+        regex.append(re.escape(pattern[position:match.start()]))
+        name, spec = match.group(1), match.group(2)
+        if spec == "int":
+            regex.append(f"(?P<{name}>\\d+)")
+            converters[name] = int
+        else:
+            regex.append(f"(?P<{name}>{spec or '[^/+#]+'})")
+        position = match.end()
+    regex.append(re.escape(pattern[position:]))
+    return re.compile("".join(regex) + "$"), converters
+
+def subscription_for(pattern):
+    # Every level that holds a placeholder becomes a single-level wildcard
+    return "/".join("+" if PLACEHOLDER.search(level) else level for level in pattern.split("/"))
+
+def topic_for(pattern, **params):
+    # The concrete topic of one device, e.g. topic_for(DISTANCE_TOPIC, sensor_id=3)
+    return PLACEHOLDER.sub(lambda match: str(params[match.group(1)]), pattern)
+
+class TopicRouter:
+    def __init__(self):
+        self._exact = {}  # topic -> handler
+        self._patterns = []  # (regex, converters, handler)
+        self._cache = {}  # topic -> (handler, params), so each topic is matched against the patterns once
+        self.subscriptions = []
+
+    def add(self, pattern, handler):
+        if PLACEHOLDER.search(pattern):
+            regex, converters = compile_pattern(pattern)
+            self._patterns.append((regex, converters, handler))
+        else:
+            self._exact[pattern] = handler
+        subscription = subscription_for(pattern)
+        if subscription not in self.subscriptions:
+            self.subscriptions.append(subscription)
+        self._cache.clear()
+
+    def route(self, topic):
+        # Returns (handler, params) or None when no route matches
+        route = self._cache.get(topic)
+        if route is not None:
+            return route
+        handler = self._exact.get(topic)
+        if handler is not None:
+            route = (handler, {})
+        else:
+            for regex, converters, pattern_handler in self._patterns:
+                match = regex.match(topic)
+                if match:
+                    params = {name: converters.get(name, str)(value) for name, value in match.groupdict().items()}
+                    route = (pattern_handler, params)
+                    break
+        if route is not None and len(self._cache) < ROUTE_CACHE_SIZE:
+            self._cache[topic] = route
+        return route
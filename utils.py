@@ -1,21 +1,15 @@
 import time
 import logging
 import json
-import websocket
-from config import WS_SERVER_URL
+import ws_client
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 def fetch_all_positions():
     try:
-        ws = websocket.WebSocket()
-        ws.connect(WS_SERVER_URL)
         payload = {"action": "fetchAllPositions"}
-        ws.send(json.dumps(payload))
-        response = ws.recv()
-        response_data = json.loads(response)
-        ws.close()
+        response_data = ws_client.request(payload)
 
         if response_data.get("action") == "fetchAllPositions" and "data" in response_data:
             return response_data["data"]
@@ -48,13 +42,8 @@ def log_response(response):
 
 def get_current_mode():
     try:
-        ws = websocket.WebSocket()
-        ws.connect(WS_SERVER_URL)
         payload = {"action": "fetchActiveMode"}
-        ws.send(json.dumps(payload))
-        response = ws.recv()
-        response_data = json.loads(response)
-        ws.close()
+        response_data = ws_client.request(payload)
         if response_data.get("action") == "fetchActiveMode" and "data" in response_data:
             return response_data["data"].get("mode_ID")
         else:
@@ -66,13 +55,8 @@ def get_current_mode():
 
 def fetch_security_sequences():
     try:
-        ws = websocket.WebSocket()
-        ws.connect(WS_SERVER_URL)
         payload = {"action": "fetchAllSecuritySequences"}
-        ws.send(json.dumps(payload))
-        response = ws.recv()
-        response_data = json.loads(response)
-        ws.close()
+        response_data = ws_client.request(payload)
         
         if response_data.get("action") == "fetchAllSecuritySequences" and "data" in response_data:
             return response_data["data"]
@@ -0,0 +1,305 @@
+import json
+import logging
+import os
+import select
+import threading
+import time
+import websocket
+import metrics
+import scheduler
+from circuit_breaker import CircuitBreaker, CLOSED
+from config import WS_SERVER_URL
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Pool tuning, overridable from the environment
+WS_POOL_SIZE = int(os.getenv('WS_POOL_SIZE', '4'))
+WS_KEEPALIVE_INTERVAL = float(os.getenv('WS_KEEPALIVE_INTERVAL', '20'))  # seconds between pings on idle connections
+# Longest a frame the server pushes on an idle connection waits before it is read
+WS_PUSH_POLL = float(os.getenv('WS_PUSH_POLL', '0.5'))
+# Attempts per request; only a request that never reached the server is retried, since one
+# that timed out waiting for its reply may have been applied
+WS_RETRIES = int(os.getenv('WS_RETRIES', '3'))
+WS_BACKOFF_BASE = 0.1  # first reconnect delay in seconds, doubled on each attempt
+WS_BACKOFF_MAX = 5
+# A slow or dead server must never hang the caller: every wait is bounded
+WS_CONNECT_TIMEOUT = float(os.getenv('WS_CONNECT_TIMEOUT', '2'))
+WS_RECV_TIMEOUT = float(os.getenv('WS_RECV_TIMEOUT', '2'))
+WS_ACQUIRE_TIMEOUT = float(os.getenv('WS_ACQUIRE_TIMEOUT', '2'))  # waiting for a free pooled connection
+# Consecutive failures before requests fail fast, and seconds before the server is tried again
+WS_BREAKER_THRESHOLD = int(os.getenv('WS_BREAKER_THRESHOLD', '3'))
+WS_BREAKER_RESET = float(os.getenv('WS_BREAKER_RESET', '10'))
+
+class CircuitOpenError(websocket.WebSocketException):
+    pass
+
+class PoolExhaustedError(websocket.WebSocketTimeoutException):
+    # Every pooled connection is busy; local contention, not counted against the server
+    pass
+
+# Shared by every pool and the asyncio client, since they all talk to the same server
+server_breaker = CircuitBreaker("WebSocket server", WS_BREAKER_THRESHOLD, WS_BREAKER_RESET)
+
+class WSConnection:
+    def __init__(self, url):
+        self.url = url
+        self.ws = None
+        self.last_used = 0
+
+    @property
+    def connected(self):
+        return self.ws is not None and self.ws.connected
+
+    def connect(self):
+        self.ws = websocket.WebSocket()
+        self.ws.connect(self.url, timeout=WS_CONNECT_TIMEOUT)
+        self.ws.settimeout(WS_RECV_TIMEOUT)
+        self.last_used = time.time()
+        logger.debug(f"Opened WebSocket connection to {self.url}")
+
+    def send(self, data):
+        self.ws.send(data)
+        self.last_used = time.time()
+
+    def recv(self):
+        response = self.ws.recv()
+        self.last_used = time.time()
+        return response
+
+    def recv_frame(self):
+        # Like recv, but a control frame (e.g. the pong to a keepalive ping) returns None
+        # instead of waiting for the next data frame
+        opcode, data = self.ws.recv_data(control_frame=True)
+        self.last_used = time.time()
+        if opcode in (websocket.ABNF.OPCODE_TEXT, websocket.ABNF.OPCODE_BINARY):
+            return data
+        return None
+
+    def ping(self):
+        self.ws.ping()
+        self.last_used = time.time()
+
+    def close(self):
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except Exception as e:
+                logger.debug(f"Error closing WebSocket connection: {e}")
+            self.ws = None
+
+class WSPool:
+    def __init__(self, url=WS_SERVER_URL, size=WS_POOL_SIZE, retries=WS_RETRIES,
+                 keepalive_interval=WS_KEEPALIVE_INTERVAL, breaker=None):
+        self.url = url
+        self.size = size
+        self.retries = retries
+        self.breaker = breaker if breaker is not None else server_breaker
+        self.keepalive_interval = keepalive_interval
+        self._idle = []  # connections not currently owned by a request, most recently used last
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._listeners = {}  # action -> list of callbacks for server-pushed messages
+        self._closed = threading.Event()
+        self._keepalive_thread = None
+        self._push_thread = None  # started with the first listener
+        if keepalive_interval:
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+            self._keepalive_thread.start()
+
+    def add_listener(self, action, callback):
+        with self._lock:
+            self._listeners.setdefault(action, []).append(callback)
+            if self._push_thread is None:
+                self._push_thread = threading.Thread(target=self._push_loop, name="ws-push", daemon=True)
+                self._push_thread.start()
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=WS_ACQUIRE_TIMEOUT):
+            raise PoolExhaustedError(f"No free connection within {WS_ACQUIRE_TIMEOUT}s")
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return WSConnection(self.url)
+
+    def _release(self, conn):
+        self._return_idle(conn)
+        self._slots.release()
+
+    def _return_idle(self, conn):
+        with self._lock:
+            if conn.connected and not self._closed.is_set() and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _dispatch_push(self, message):
+        with self._lock:
+            callbacks = list(self._listeners.get(message.get("action"), ()))
+        for callback in callbacks:
+            try:
+                callback(message)
+            except Exception as e:
+                logger.error(f"Push listener for {message.get('action')} failed: {e}")
+
+    def _recv_response(self, conn):
+        # A connection is owned by exactly one request between send and recv, so the
+        # next frame that is not a registered server push is the reply to that request.
+        while True:
+            message = json.loads(conn.recv())
+            if isinstance(message, dict) and message.get("action") in self._listeners:
+                self._dispatch_push(message)
+                continue
+            return message
+
+    def request(self, payload):
+        action = payload.get("action")
+        with metrics.histogram("ws_request_seconds", "WebSocket request round trips, retries included", action=action).time():
+            return self._request(payload, action)
+
+    def _request(self, payload, action):
+        data = json.dumps(payload)
+        last_error = None
+        for attempt in range(self.retries):
+            if not self.breaker.allow():
+                metrics.counter("ws_rejected_total", "WebSocket requests refused while the circuit is open", action=action).inc()
+                raise CircuitOpenError(f"Server unavailable, {action} not sent" + (f": {last_error}" if last_error else ""))
+            try:
+                conn = self._acquire()
+            except PoolExhaustedError:
+                self.breaker.release_trial()
+                metrics.counter("ws_pool_exhausted_total", "WebSocket requests with no free pooled connection", action=action).inc()
+                raise
+            sent = False
+            try:
+                if not conn.connected:
+                    conn.connect()
+                conn.send(data)
+                sent = True
+                response = self._recv_response(conn)
+            except (websocket.WebSocketException, OSError) as e:
+                last_error = e
+                conn.close()
+                self._release(conn)
+                self.breaker.record_failure()
+                if sent:
+                    # The server may have acted on it, and a hung server would hang every retry too
+                    metrics.counter("ws_failures_total", "WebSocket requests that failed after all retries", action=action).inc()
+                    raise websocket.WebSocketException(f"No reply to {action}: {e}") from e
+                metrics.counter("ws_retries_total", "WebSocket requests retried after a connection error", action=action).inc()
+                if not self.breaker.available:
+                    continue  # Fails fast on the next attempt instead of backing off
+                delay = min(WS_BACKOFF_BASE * (2 ** attempt), WS_BACKOFF_MAX)
+                logger.warning(f"WebSocket request {action} failed (attempt {attempt + 1}/{self.retries}): {e}, reconnecting in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            except Exception:
+                # e.g. a reply that is not JSON: the server answered wrongly, which still ends a trial
+                conn.close()
+                self._release(conn)
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                conn.close()
+                self._release(conn)
+                self.breaker.release_trial()
+                raise
+            self._release(conn)
+            self.breaker.record_success()
+            return response
+        metrics.counter("ws_failures_total", "WebSocket requests that failed after all retries", action=action).inc()
+        raise websocket.WebSocketException(f"Request {action} failed after {self.retries} attempts: {last_error}")
+
+    def _keepalive_loop(self):
+        while not self._closed.wait(self.keepalive_interval):
+            now = time.time()
+            with self._lock:
+                stale = [conn for conn in self._idle if now - conn.last_used >= self.keepalive_interval]
+                self._idle = [conn for conn in self._idle if conn not in stale]
+            for conn in stale:
+                try:
+                    conn.ping()
+                except Exception as e:
+                    logger.debug(f"Keepalive ping failed, dropping connection: {e}")
+                    conn.close()
+                    continue
+                with self._lock:
+                    self._idle.append(conn)
+
+    def _push_loop(self):
+        # A request reads pushes that arrive on its own connection; this reads the ones that arrive
+        # on idle connections, which would otherwise wait for the next request to take them
+        while not self._closed.is_set():
+            with self._lock:
+                idle = {conn.ws.sock: conn for conn in self._idle if conn.connected and conn.ws.sock is not None}
+            if not idle:
+                self._closed.wait(WS_PUSH_POLL)
+                continue
+            try:
+                readable, _, _ = select.select(list(idle), [], [], WS_PUSH_POLL)
+            except (OSError, ValueError):
+                continue  # A connection was closed meanwhile
+            for sock in readable:
+                conn = idle[sock]
+                with self._lock:
+                    if conn not in self._idle:
+                        continue  # Taken by a request, which reads the frame itself
+                    self._idle.remove(conn)
+                try:
+                    frame = conn.recv_frame()
+                    message = json.loads(frame) if frame is not None else None
+                except Exception as e:
+                    logger.debug(f"Idle WebSocket connection dropped: {e}")
+                    conn.close()
+                    continue
+                if isinstance(message, dict) and message.get("action") in self._listeners:
+                    self._dispatch_push(message)
+                elif message is not None:
+                    logger.warning(f"Unexpected message on an idle WebSocket connection: {message}")
+                self._return_idle(conn)
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = WSPool()
+    return _pool
+
+def set_pool(pool):
+    # Replaces the shared pool, e.g. to point the app at another server
+    global _pool
+    with _pool_lock:
+        previous, _pool = _pool, pool
+    if previous is not None:
+        previous.close()
+
+def request(payload):
+    return get_pool().request(payload)
+
+def server_available():
+    return server_breaker.available
+
+def on_recovery(callback):
+    # callback() runs in the housekeeping lane once the server answers again after an outage
+    server_breaker.add_listener(lambda state: state == CLOSED and scheduler.get_lanes().submit(scheduler.HOUSEKEEPING, callback))
+
+def add_listener(action, callback):
+    get_pool().add_listener(action, callback)
+
+def close():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None